@@ -0,0 +1,39 @@
+import logging
+import transaction
+from babble.server.interfaces import IChatService
+
+log = logging.getLogger(__name__)
+
+def enable_fanout(service):
+    """ Enable fan-out on write and fill the users' inboxes with the 
+        existing messages. We commit after every batch to keep the
+        transactions (and their conflict windows) small.
+    """
+    total = 0
+    for count in service._enableFanout():
+        transaction.commit()
+        total += count
+    transaction.commit()
+    return total
+
+
+def run(self):
+    """ Enable fan-out on write for the chat services (see 
+        ChatService._setFanout).
+
+    Sending a message then adds a pointer to it to the inbox of every
+    recipient, and getNewMessages reads the user's inbox instead of all his
+    conversations and chatrooms.
+    """
+    services = []
+    for o in self.objectValues():
+        if IChatService.providedBy(o):
+            services.append(o)
+
+    total = 0
+    for service in services:
+        count = enable_fanout(service)
+        log.info('Added %d messages to the inboxes of %s' % (count, service.getId()))
+        total += count
+
+    return "Succesfully enabled fan-out for %d messages" % total
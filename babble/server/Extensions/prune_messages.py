@@ -0,0 +1,41 @@
+import logging
+import transaction
+from babble.server.interfaces import IChatService
+
+log = logging.getLogger(__name__)
+
+def prune_messages(service):
+    """ Delete the expired messages of the service's conversations and 
+        chatrooms. We commit after every batch to keep the transactions
+        (and their conflict windows) small.
+    """
+    total = 0
+    for count in service._pruneMessages():
+        transaction.commit()
+        total += count
+    transaction.commit()
+    return total
+
+
+def run(self):
+    """ Delete the messages that are older than the retention period of the
+        chat services (see config.RETENTION_DAYS).
+
+    * Conversations expire after ChatService.retention_days.
+    * Chatrooms expire after ChatRoom.retention_days, if set.
+
+    Meant to be run regularly, e.g. from a clock server or cron job.
+    """
+    services = []
+    for o in self.objectValues():
+        if IChatService.providedBy(o):
+            services.append(o)
+
+    total = 0
+    for service in services:
+        count = prune_messages(service)
+        log.info('Deleted %d expired messages from %s' % (count, service.getId()))
+        total += count
+
+    return "Succesfully deleted %d expired messages" % total
+
@@ -0,0 +1,155 @@
+import transaction
+from Acquisition import aq_base
+from babble.server import config
+from babble.server.interfaces import IChatService
+from babble.server.Extensions.enable_fanout import enable_fanout
+from babble.server.utils import date_to_key
+from babble.server.utils import hashed
+
+def rebuild_conversation_index(service):
+    """ Index the existing conversations by the hashed usernames of their
+        partners.
+    """
+    service._rebuildConversationIndex()
+
+
+def migrate_chatroom_participants(service):
+    """ Move the participants of the existing chatrooms from lists into
+        OOTreeSets.
+    """
+    for chatroom in service._getChatRoomsFolder().objectValues():
+        chatroom._migrateParticipants()
+
+
+def rebuild_chatroom_index(service):
+    """ Index the existing chatrooms by the hashed usernames of their
+        participants.
+    """
+    service._rebuildChatRoomIndex()
+
+
+def migrate_messageboxes(service):
+    """ Convert the Message objects in MessageBoxes, stored as folder items
+        or in the integer-keyed LOBTree, into compact records in the LOBTree.
+        We commit after every messagebox to keep the transactions small.
+    """
+    for folder in [service._getConversationsFolder(), 
+                   service._getChatRoomsFolder()]:
+        for container in folder.objectValues():
+            for mbox in container.objectValues():
+                if mbox._migrateMessages():
+                    transaction.commit()
+
+
+def build_chatroom_timelines(service):
+    """ Give the existing chatrooms a timeline of their messages, if
+        config.CHATROOM_TIMELINES is set.
+    """
+    if not config.CHATROOM_TIMELINES:
+        return
+    for chatroom in service._getChatRoomsFolder().objectValues():
+        if chatroom._timeline is None:
+            chatroom._enableTimeline()
+            transaction.commit()
+
+
+def initialize_message_counts(service):
+    """ Count the messages in the existing conversations, chatrooms and
+        their MessageBoxes, from which the unread counts are calculated.
+    """
+    for folder in [service._getConversationsFolder(), 
+                   service._getChatRoomsFolder()]:
+        for container in folder.objectValues():
+            container._getMessageCount()
+            for mbox in container.objectValues():
+                mbox._getMessageCount()
+            transaction.commit()
+
+
+def initialize_sequences(service):
+    """ Give the existing conversations and chatrooms a Sequence, which
+        holds the key of their last message, so that containers without
+        new messages are skipped without loading their MessageBoxes.
+
+        Empty containers, which older versions created in bulk, are left
+        alone: a Sequence would move their high-water mark from 
+        config.NULL_KEY to the key after it.
+    """
+    for folder in [service._getConversationsFolder(), 
+                   service._getChatRoomsFolder()]:
+        for container in folder.objectValues():
+            if container._sequence is None:
+                last_key = container._lastKey(config.MAX_KEY)
+                if last_key == config.NULL_KEY:
+                    continue
+                container._getSequence().next(last_key)
+                transaction.commit()
+
+
+def rebuild_inboxes(service):
+    """ Fill the users' inboxes with the migrated messages, if fan-out is
+        enabled.
+    """
+    if service.fanout:
+        enable_fanout(service)
+
+
+def migrate_clearance_dates(service):
+    """ Move the users' last_cleared_date from the user objects in 
+        acl_users into read cursors for each of their conversations and
+        chatrooms.
+    """
+    cursors = service._getReadCursors()
+    for user in service.acl_users.getUsers():
+        user = aq_base(user)
+        if not hasattr(user, 'last_cleared_date'):
+            continue
+        username = user.getUserName()
+        until = date_to_key(user.last_cleared_date)
+        for containers in service._getContainers(username, '*', '*'):
+            for container in containers:
+                key = container._lastKey(until)
+                if key > config.NULL_KEY and \
+                        cursors.get(hashed(username), container.id) is None:
+                    count = container._receivedCountUntil(username, key)
+                    cursors.set(hashed(username), container.id, key, count)
+        del user.last_cleared_date
+        transaction.commit()
+
+
+def run(self):
+    """
+    * Build the index of conversations per user.
+    * Store the participants of chatrooms in OOTreeSets.
+    * Build the index of chatrooms per participant.
+    * Convert the messages in MessageBoxes into records in integer-keyed
+      LOBTrees.
+    * Build the timelines of chatrooms.
+    * Count the messages in conversations, chatrooms and MessageBoxes.
+    * Store the key of the last message of conversations and chatrooms.
+    * Rebuild the users' inboxes, if fan-out is enabled.
+    * Move the users' clearance dates into read cursors per conversation
+      and chatroom.
+    """
+    services = []
+    for o in self.objectValues():
+        if IChatService.providedBy(o):
+            services.append(o)
+
+    for service in services:
+        rebuild_conversation_index(service)
+        migrate_chatroom_participants(service)
+        transaction.commit()
+        rebuild_chatroom_index(service)
+        transaction.commit()
+        migrate_messageboxes(service)
+        transaction.commit()
+        build_chatroom_timelines(service)
+        initialize_message_counts(service)
+        initialize_sequences(service)
+        rebuild_inboxes(service)
+        transaction.commit()
+        migrate_clearance_dates(service)
+
+    return "Succesfully upgraded the chat services"
+
@@ -1,31 +1,88 @@
 import logging
 from zExceptions import Unauthorized
 from zope.interface import implements
-from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
-from messagebox import MessageBox
+from BTrees.OOBTree import OOTreeSet
+from container import MessageContainer
 from interfaces import IChatRoom
-from utils import hashed
+import config
 
 log = logging.getLogger(__name__)
 
-class ChatRoom(BTreeFolder2):
-    """ A conversation between multiple people in a virtual room """
+class ChatRoom(MessageContainer):
+    """ A conversation between multiple people in a virtual room 
+
+        The participants are stored in an OOTreeSet, which resolves 
+        conflicts between concurrent additions and removals and allows 
+        membership to be checked in O(log n). 
+        
+        Every participant sees the chatroom under its client_path, so we
+        don't store a partner mapping like Conversations do.
+    """
     implements(IChatRoom)
+    # The amount of days after which messages are deleted. None means that
+    # the ChatService's retention period applies.
+    retention_days = None
+    _participants = None
 
 
     def __init__(self, id, client_path, participants=[]):
         super(ChatRoom, self).__init__(id)
-        self.participants = participants
-        self.partner = {}
         self.client_path = client_path
-        for p in participants:
-            self.partner[p] = self.client_path
+        self._participants = OOTreeSet(participants)
+        if config.CHATROOM_TIMELINES:
+            self._enableTimeline()
+
+
+    def _getParticipants(self):
+        """ Return the participants, sorted by username """
+        if self._participants is None:
+            # BBB: Chatrooms created by older versions store their
+            # participants in a list. See _migrateParticipants
+            return OOTreeSet(self.__dict__.get('participants', ()))
+        return self._participants
+
+
+    def _isParticipant(self, user):
+        return user in self._getParticipants()
 
 
     def _addParticipant(self, user):
         """ """
-        self.participants.append(user)
-        self.partner[user] = self.client_path
+        self._migrateParticipants()
+        self._participants.insert(user)
+
+
+    def _removeParticipant(self, user):
+        """ """
+        self._migrateParticipants()
+        if user in self._participants:
+            self._participants.remove(user)
+
+
+    def _migrateParticipants(self):
+        """ Move the participants of chatrooms created by older versions
+            from their list into an OOTreeSet, and remove the partner 
+            mapping. Returns True if the chatroom was migrated.
+        """
+        if self._participants is not None:
+            return False
+        self._participants = OOTreeSet(self.__dict__.get('participants', ()))
+        for name in ['participants', 'partner']:
+            if self.__dict__.has_key(name):
+                delattr(self, name)
+        return True
+
+
+    def _hasPartner(self, username):
+        return self._isParticipant(username)
+
+
+    def _getPartnerName(self, username):
+        return self.client_path
+
+
+    def _getPartners(self):
+        return self._getParticipants()
 
 
     def _getMessageBox(self, owner):
@@ -34,18 +91,7 @@ class ChatRoom(BTreeFolder2):
 
             Each user has his own messagebox to aviod conflicts.
         """
-        if owner not in self.participants:
+        if not self._isParticipant(owner):
             raise Unauthorized
-
-        owner = hashed(owner)
-        if owner not in self.objectIds():
-            self._setObject(owner, MessageBox(owner))
-        return self._getOb(owner)
-
-
-    def addMessage(self, text, author, fullname):
-        """ Add a message to the Conversation """
-        mbox = self._getMessageBox(author)
-        return mbox.addMessage(text, author, fullname)
-
+        return super(ChatRoom, self)._getMessageBox(owner)
 
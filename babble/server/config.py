@@ -4,10 +4,74 @@ AUTH_FAIL = -1
 TIMEOUT = 1
 ERROR = SERVER_FAULT = 2
 NOT_FOUND = 3
+NOT_MODIFIED = 4
+
+# The amount of seconds for which a session token, as returned by
+# IChatService.login, remains valid.
+TOKEN_LIFETIME = 3600
+
+# The maximum amount of seconds that IChatService.waitForNewMessages waits
+# for a message to arrive, and the interval at which it looks for messages
+# sent via other ZEO clients while waiting.
+MAX_WAIT_TIMEOUT = 60
+WAIT_INTERVAL = 5
+
+# A user is considered online for PRESENCE_WINDOW seconds after he was last
+# confirmed as online. Confirmations within PRESENCE_THROTTLE seconds of the
+# previous one are not recorded.
+PRESENCE_WINDOW = 60
+PRESENCE_THROTTLE = 30
+
+# The amount of seconds for which the ephemeral events published via
+# IChatService.setTyping and IChatService.setStatus are delivered.
+TYPING_TTL = 10
+STATUS_TTL = 300
+
+# Whether new chatrooms keep a timeline of their messages, so that they 
+# can be read without loading the MessageBox of every author. See
+# MessageContainer._enableTimeline
+CHATROOM_TIMELINES = True
+
+# The upper bounds (in seconds) of the buckets of the latency histograms
+# returned by IChatService.getStats
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The maximum amount of messages that IChatService.sendMessages sends in
+# one call (and transaction).
+MAX_BATCH_SIZE = 1000
+
+# Messages older than RETENTION_DAYS days are deleted by the pruning job
+# (see Extensions/prune_messages.py), unless the ChatService or ChatRoom has
+# its own retention_days. None means that messages are kept forever. 
+# The job deletes at most PRUNE_BATCH_SIZE messages per transaction.
+RETENTION_DAYS = None
+PRUNE_BATCH_SIZE = 1000
+
+# When fan-out is enabled, the existing messages are added to the inboxes
+# in transactions of at most FANOUT_BATCH_SIZE messages (see 
+# Extensions/enable_fanout.py).
+FANOUT_BATCH_SIZE = 1000
+
+# The first call of IChatService.sync (without a cursor) returns at most
+# SYNC_HISTORY of the newest messages of every conversation and chatroom.
+SYNC_HISTORY = 50
 
 from datetime import datetime
 from pytz import utc
 NULL_DATE = datetime.min.replace(tzinfo=utc).isoformat()
+# NULL_DATE as an integer message key, see utils.date_to_key
+NULL_KEY = -62135596800000000
+# The largest message key that fits into an LOBTree
+MAX_KEY = 2**63 - 1
+# The key of the largest date that utils.key_to_date can convert it to
+MAX_DATE_KEY = 253402300799999999
+
+# A message is assumed to be committed within COMMIT_WINDOW seconds after 
+# its key was handed out. Concurrent senders don't conflict on the keys, so
+# a message may be committed after one with a larger key that was already
+# returned. Cursors therefore look at the messages of the last
+# COMMIT_WINDOW seconds before their position again.
+COMMIT_WINDOW = 10
 
 import re
 # 2011-09-30T15:49:35.417693+00:00
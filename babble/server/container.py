@@ -0,0 +1,287 @@
+import logging
+import time
+from persistent import Persistent
+from BTrees.LOBTree import LOBTree
+from BTrees.Length import Length
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
+from messagebox import MessageBox
+from utils import hashed
+from utils import iter_backwards
+from utils import merge
+from utils import timestamp_to_key
+import config
+
+log = logging.getLogger(__name__)
+
+class Sequence(Persistent):
+    """ Hands out the increasing message keys of a container.
+
+        Keys are timestamps (see utils.timestamp_to_key), but every key is
+        larger than the previous one, even when two messages are sent in the
+        same microsecond or the clock goes backwards. 
+
+        Concurrent senders don't conflict here: the larger of their values
+        wins. Their keys are therefore not necessarily in commit order, a
+        message may be committed after one with a larger key. Cursors take
+        this into account, see config.COMMIT_WINDOW.
+    """
+    value = config.NULL_KEY
+
+    def next(self, key):
+        """ Return the next key, which is 'key' if that is large enough """
+        if key <= self.value:
+            key = self.value + 1
+        self.value = key
+        return key
+
+
+    def _p_resolveConflict(self, old, committed, new):
+        """ The larger value wins """
+        resolved = dict(new)
+        resolved['value'] = max(committed.get('value', config.NULL_KEY), 
+                                new.get('value', config.NULL_KEY))
+        return resolved
+
+
+class MessageContainer(BTreeFolder2):
+    """ Base class for conversations and chatrooms. 
+
+        The messages are stored in MessageBoxes, one per author.
+    """
+    _sequence = None
+    _message_count = None
+    _timeline = None
+
+    def _hasPartner(self, username):
+        """ Return whether the user takes part in the container """
+        return self.partner.has_key(username)
+
+
+    def _getPartnerName(self, username):
+        """ Return the name under which the user sees the container, i.e
+            his conversation partner or the chatroom's path.
+        """
+        return self.partner[username]
+
+
+    def _getPartners(self):
+        """ Return the users that take part in the container """
+        return self.partner.keys()
+
+
+    def _getMessageBox(self, owner):
+        """ The MessageBox is a container that stores
+            the messages sent by a user.
+
+            We store the messages of each author in a different messagebox,
+            instead of in the container itself, to avoid conflict errors.
+        """
+        owner = hashed(owner)
+        if owner not in self.objectIds():
+            self._setObject(owner, MessageBox(owner))
+        return self._getOb(owner)
+
+
+    def _getSequence(self):
+        if self._sequence is None:
+            self._sequence = Sequence()
+        return self._sequence
+
+
+    def _highWaterMark(self):
+        """ Return the key of the last message that was added to the
+            container, without loading its MessageBoxes.
+
+            This is the last key handed out by the container's Sequence. 
+            Messages may have been pruned since, so it can be larger than
+            the key of the last message that still exists, but no message
+            with a larger key exists.
+        """
+        if self._sequence is None:
+            # BBB: Containers without messages, or created by older versions
+            return self._lastKey(config.MAX_KEY)
+        return self._sequence.value
+
+
+    def addMessage(self, text, author, fullname):
+        """ Add a message to the container """
+        mbox = self._getMessageBox(author)
+        key = self._getSequence().next(timestamp_to_key(time.time()))
+        self._getMessageCount().change(1)
+        message = mbox.addMessage(text, author, fullname, key)
+        if self._timeline is not None:
+            self._timeline[message.key] = mbox.id
+        return message
+
+
+    def _enableTimeline(self):
+        """ Keep a timeline of the container's messages: an LOBTree that
+            maps the key of every message to the id of its MessageBox.
+
+            Messages are then fetched with one range scan over the timeline,
+            instead of one per MessageBox, and only the MessageBoxes of the
+            authors of the returned messages are loaded. This matters for
+            chatrooms with many authors. The messages themselves stay in 
+            the MessageBoxes. 
+
+            Concurrent senders add different keys to the timeline, which the
+            LOBTree resolves, unless they split the same bucket.
+
+            The MessageBoxes must have been migrated (see 
+            MessageBox._migrateMessages).
+        """
+        timeline = LOBTree()
+        for mbox in self.values():
+            for key, message in mbox._iterMessages(config.NULL_KEY, config.MAX_KEY):
+                timeline[key] = mbox.id
+        self._timeline = timeline
+
+
+    def _disableTimeline(self):
+        self._timeline = None
+
+
+    def _messageCount(self):
+        """ Return the amount of messages that were added to the container """
+        if self._message_count is None:
+            # BBB: Containers created by older versions don't count their
+            # messages
+            return sum([mbox._messageCount() for mbox in self.values()])
+        return self._message_count()
+
+
+    def _getMessageCount(self):
+        """ The message count is a BTrees.Length, which resolves conflicts
+            between concurrent senders.
+        """
+        if self._message_count is None:
+            self._message_count = Length(self._messageCount())
+        return self._message_count
+
+
+    def _receivedCount(self, username):
+        """ Return the amount of messages that were sent to the user, i.e
+            that were added by the other participants.
+        """
+        count = self._messageCount()
+        mbox = self._getOb(hashed(username), None)
+        if mbox is not None:
+            count -= mbox._messageCount()
+        return count
+
+
+    def _receivedCountUntil(self, username, until):
+        """ Return the amount of messages that were sent to the user up to
+            and including 'until' (an integer message key).
+        """
+        count = self._receivedCount(username)
+        if until >= self._highWaterMark():
+            return count
+        for key, message in self._iterMessages(until, config.MAX_KEY):
+            if message.author != username:
+                count -= 1
+        return count
+
+
+    def _unreadCount(self, username, cleared_count=0):
+        """ Return the amount of messages sent to the user since he last
+            cleared the container, at which point he had received 
+            'cleared_count' messages.
+
+            Rather than keeping a counter per participant, which would have
+            to be updated for every participant whenever a message is sent,
+            we store how many messages the user had received when he last
+            cleared the container (see readcursors.py).
+        """
+        return max(self._receivedCount(username) - cleared_count, 0)
+
+
+    def _pruneMessages(self, until, limit):
+        """ Delete at most 'limit' of the messages sent up to and including
+            'until'. Returns (key, messagebox id) tuples for the deleted
+            messages.
+
+            The message counts aren't decreased: they are compared with the
+            counts in the read cursors, which include the pruned messages.
+            The pruned messages therefore count as unread until the user
+            clears them.
+        """
+        self._getMessageCount()
+        pruned = []
+        for mbox in self.values():
+            if len(pruned) >= limit:
+                break
+            keys = mbox._pruneMessages(until, limit - len(pruned))
+            pruned.extend([(key, mbox.id) for key in keys])
+
+        if self._timeline is not None:
+            for key, mbox_id in pruned:
+                if self._timeline.has_key(key):
+                    del self._timeline[key]
+        return pruned
+
+
+    def _iterMessages(self, since, until, limit=None, reverse=False):
+        """ Yield (key, message) tuples, ordered by key, for the messages
+            sent after 'since' and up to and including 'until'.
+            If reverse is True, the newest messages come first.
+
+            The messageboxes are each already ordered by key, so we merge
+            them instead of collecting and sorting all their messages.
+            If the container has a timeline, we scan it instead.
+        """
+        if self._timeline is not None:
+            return self._iterTimeline(since, until, limit, reverse)
+
+        if reverse:
+            iterables = [mbox._iterMessagesBackwards(since, until) 
+                         for mbox in self.values()]
+        else:
+            iterables = [mbox._iterMessages(since, until) 
+                         for mbox in self.values()]
+        return merge(iterables, limit, reverse)
+
+
+    def _iterTimeline(self, since, until, limit=None, reverse=False):
+        """ Yield (key, message) tuples like _iterMessages, using the
+            timeline to find the messages.
+        """
+        if reverse:
+            items = iter_backwards(self._timeline, since, until)
+        else:
+            items = self._timeline.items(since+1, until)
+
+        mboxes = {}
+        count = 0
+        for key, mbox_id in items:
+            if limit is not None and count >= limit:
+                return
+            mbox = mboxes.get(mbox_id)
+            if mbox is None:
+                mbox = mboxes[mbox_id] = self._getOb(mbox_id)
+            message = mbox._getMessage(key)
+            if message is None:
+                log.warn(u"The message '%s' in the timeline of '%s' doesn't "
+                         u"exist. This shouldn't happen!" % (key, self.id))
+                continue
+            yield key, message
+            count += 1
+
+
+    def _lastKey(self, until):
+        """ Return the key of the last message sent up to and including
+            'until', or config.NULL_KEY if there isn't any.
+        """
+        if self._timeline is not None:
+            try:
+                return self._timeline.maxKey(until)
+            except ValueError:
+                return config.NULL_KEY
+
+        last_key = config.NULL_KEY
+        for mbox in self.values():
+            key = mbox._lastKey(until)
+            if key is not None and key > last_key:
+                last_key = key
+        return last_key
+
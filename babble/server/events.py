@@ -0,0 +1,73 @@
+import heapq
+import logging
+import threading
+import time
+from zope.component import queryUtility
+from zope.interface import implements
+from interfaces import IEventChannel
+
+log = logging.getLogger(__name__)
+
+class MemoryEvents(object):
+    """ Keeps the ephemeral events in memory.
+
+        Like presence.MemoryPresence, it is shared by all the threads of the
+        Zope process, but not between ZEO clients.
+
+        Every recipient has a dict of his events, keyed by their sender,
+        type and chatroom, so that a new event replaces the previous one
+        (e.g. a user that stops typing). The expiry dates are kept in a
+        heap, so that expired events are evicted without having to look
+        at the others.
+    """
+    implements(IEventChannel)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self._heap = []
+
+
+    def _evict(self, now):
+        """ Forget the events that have expired. Must be called with the
+            lock held.
+        """
+        while self._heap and self._heap[0][0] <= now:
+            expires, recipient, key = heapq.heappop(self._heap)
+            events = self._events.get(recipient)
+            if events is None or key not in events or events[key][0] != expires:
+                # The event has been replaced in the meantime
+                continue
+            del events[key]
+            if not events:
+                del self._events[recipient]
+
+
+    def publish(self, recipients, event, expires):
+        """ See interfaces.IEventChannel """
+        key = (event['sender'], event['type'], event.get('chatroom'))
+        with self._lock:
+            for recipient in recipients:
+                self._events.setdefault(recipient, {})[key] = (expires, event)
+                heapq.heappush(self._heap, (expires, recipient, key))
+            self._evict(time.time())
+
+
+    def events(self, recipient, now):
+        """ See interfaces.IEventChannel """
+        with self._lock:
+            self._evict(now)
+            events = self._events.get(recipient, {})
+            return [event for key, (expires, event) in sorted(events.items())]
+
+
+_default = MemoryEvents()
+
+def get_channel():
+    """ Return the registered IEventChannel utility, or, if there is none,
+        the process-wide MemoryEvents.
+    """
+    channel = queryUtility(IEventChannel)
+    if channel is None:
+        return _default
+    return channel
@@ -0,0 +1,85 @@
+import logging
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from peruser import PerUserStorage
+
+log = logging.getLogger(__name__)
+
+class Inboxes(PerUserStorage):
+    """ The users' inboxes, for when messages are fanned out on write.
+
+        Every user has an OOTreeSet with a pointer to every message sent to
+        a conversation or chatroom that he takes part in. A pointer is a
+        (key, folder_id, container_id, mbox_id) tuple, so the inbox is 
+        ordered by message key and the new messages can be found with a
+        single range scan.
+
+        Inserting different pointers into the same inbox doesn't conflict,
+        thanks to the OOTreeSet's conflict resolution.
+    """
+
+    def add(self, key, pointer):
+        """ Add a pointer to the inbox of key """
+        self._getTree(key, OOTreeSet).insert(pointer)
+
+
+    def remove(self, key, pointer):
+        """ Remove a pointer from the inbox of key """
+        inbox = self._getTree(key)
+        if inbox is not None and pointer in inbox:
+            inbox.remove(pointer)
+
+
+    def pointers(self, key, since, until):
+        """ Return the pointers in the inbox of key, to the messages sent
+            after 'since' and up to and including 'until' (integer message
+            keys).
+        """
+        inbox = self._getTree(key)
+        if inbox is None:
+            return ()
+        # Pointers are longer tuples, so (since+1,) sorts before all pointers
+        # with key since+1, and (until+1,) after all pointers with key until.
+        return inbox.keys((since+1,), (until+1,))
+
+
+    def lastKey(self, key, until):
+        """ Return the key of the last message in the inbox of key, sent up
+            to and including 'until', or None.
+        """
+        inbox = self._getTree(key)
+        if inbox is None:
+            return None
+        try:
+            return inbox.maxKey((until+1,))[0]
+        except ValueError:
+            return None
+
+
+class JoinKeys(PerUserStorage):
+    """ Stores, per user and per chatroom, the key of the last message that
+        was sent before he joined the chatroom, while fan-out was enabled.
+
+        These messages aren't in his inbox. Adding them when he joins would
+        write the chatroom's whole history in one transaction, which 
+        conflicts with every sender. They are read from the chatroom itself
+        instead (see ChatService._getMessagesFromInbox).
+    """
+
+    def getAll(self, user):
+        """ Return the user's join keys, keyed by chatroom id """
+        return self._getTree(user) or {}
+
+
+    def set(self, user, container_id, key):
+        """ Set the user's join key for the chatroom """
+        keys = self._getTree(user, OOBTree)
+        if keys.get(container_id) != key:
+            keys[container_id] = key
+
+
+    def remove(self, user, container_id):
+        """ Remove the user's join key for the chatroom """
+        keys = self._getTree(user)
+        if keys is not None and container_id in keys:
+            del keys[container_id]
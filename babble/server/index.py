@@ -0,0 +1,26 @@
+import logging
+from BTrees.OOBTree import OOTreeSet
+from peruser import PerUserStorage
+
+log = logging.getLogger(__name__)
+
+class ReverseIndex(PerUserStorage):
+    """ Maps a key (usually a hashed username) to the set of ids of the
+        objects (conversations, chatrooms) that it belongs to.
+    """
+
+    def index(self, key, value):
+        """ Add value to the set stored under key """
+        self._getTree(key, OOTreeSet).insert(value)
+
+
+    def unindex(self, key, value):
+        """ Remove value from the set stored under key """
+        values = self._getTree(key)
+        if values is not None and value in values:
+            values.remove(value)
+
+
+    def get(self, key):
+        """ Return the values stored under key """
+        return self._getTree(key) or ()
@@ -10,6 +10,11 @@ class IChatService(Interface):
         TIMEOUT = 1
         ERROR = SERVER_FAULT = 2
         NOT_FOUND = 3
+        NOT_MODIFIED = 4
+
+        Wherever a password is required, the session token returned by
+        'login' may be passed in instead. Tokens are much cheaper to verify
+        than passwords, so clients that poll should use them.
     """
 
     def createChatRoom(username, password, path, participants):
@@ -41,9 +46,40 @@ class IChatService(Interface):
             participants:   list of strings
         """
 
+    def setChatRoomRetention(username, password, id, days):
+        """ Set the amount of days after which the chatroom's messages are
+            deleted by the pruning job (see Extensions/prune_messages.py).
+
+            username:       string
+            password:       string
+            id:             string  (the chat room's id)
+            days:           None or a non-negative integer. None means that
+                            the ChatService's retention period applies.
+        """
+
+    def setRetention(days):
+        """ Set the amount of days after which the messages of the 
+            conversations, and of the chatrooms without their own retention
+            period, are deleted by the pruning job.
+
+            days:           None or a non-negative integer. None means that
+                            config.RETENTION_DAYS applies.
+        """
+
     def removeChatRoom(username, password, id):
         """ Delete a chatroom """
 
+    def login(username, password):
+        """ Authenticate the user and return a session token, signed by the
+            server, in the 'token' field, and its expiry date in the 
+            'expires' field.
+
+            The token can be used instead of the password until it expires
+            (see config.TOKEN_LIFETIME), after which the methods return 
+            AUTH_FAIL and the client must log in again. Changing the user's
+            password, or unregistering him, invalidates his tokens.
+        """
+
     def confirmAsOnline(username):
         """ Confirm that the user is currently online by updating the 'user
             access dict'
@@ -53,11 +89,19 @@ class IChatService(Interface):
         """ Register a user with the babble.server's acl_users
         """
 
+    def unregister(username):
+        """ Remove the user from the babble.server's acl_users, and 
+            invalidate his session tokens. The status is NOT_FOUND if he
+            isn't registered.
+        """
+
     def isRegistered(username):
         """ Check whether the user is registered via acl_users """
 
     def setUserPassword(username, password):
-        """ Set the user's password """
+        """ Set the user's password, which invalidates his session tokens
+            (see login).
+        """
 
     def getOnlineUsers():
         """ Determine and return the (probable) online users from the 'user access dict'.
@@ -73,6 +117,24 @@ class IChatService(Interface):
             message:    string
         """
 
+    def sendMessages(username, password, fullname, recipients, messages):
+        """ Sends every message to every recipient, in one transaction
+        
+            username:   string
+            password:   string
+            fullname:   string (The sender's full name)
+            recipients: string or list of strings (The message recipients)
+            messages:   string or list of strings
+
+            At most config.MAX_BATCH_SIZE messages can be sent at once. 
+            If there are no recipients or messages, or a message isn't a
+            string, nothing is sent and an error is returned.
+
+            The 'results' field of the returned dict is a list with a dict
+            per message (or invalid recipient), containing the 'recipient',
+            its 'status' and, if it was sent, its 'last_msg_date'.
+        """
+
     def sendChatRoomMessage(username, password, fullname, room_name, message):
         """ Sends a message to a chatroom 
         
@@ -83,7 +145,8 @@ class IChatService(Interface):
             message:    string
         """
 
-    def getMessages(username, password, partner, chatrooms, since, until):
+    def getMessages(username, password, partner, chatrooms, since, until,
+                    limit=None, newest_first=False):
         """ Returns messages from conversation partners or chatrooms,  
             optionally within a certain date range.
 
@@ -94,25 +157,121 @@ class IChatService(Interface):
                 - None: ignore partners
                 - *   : match all partners   
 
-            chatrooms:  list of strings
+            chatrooms:  None or '*' or list of strings
+                - None: ignore chatrooms
+                - *   : match all chatrooms
 
             since: iso8601 date string or None 
             until: iso8601 date string or None
+
+            limit: None or a positive integer. If given, at most that many
+                   messages are returned per conversation and chatroom, and
+                   the 'more' field tells whether any of them has more 
+                   messages between 'since' and 'until'.
+            newest_first: boolean. Return the messages newest first, and
+                   with a limit, return the last messages instead of the
+                   first ones.
+
+            To page through the history of a conversation, use 
+            getMessagesByCursor.
+        """
+
+    def getMessagesByCursor(username, password, partner, chatrooms, cursor,
+                            limit=None, newest_first=False):
+        """ Returns messages from conversation partners or chatrooms that
+            were sent after the position in the cursor.
+
+            username:   string
+            password:   string
+
+            partner:    None or '*' or a username. 
+                - None: ignore partners
+                - *   : match all partners   
+
+            chatrooms:  None or '*' or list of strings (see getMessages)
+
+            cursor: None or an opaque string, as returned in the 'next_cursor'
+                    field of a previous call. If None, all messages are
+                    returned.
+
+            limit:  None or a positive integer. At most that many messages 
+                    are returned per conversation and chatroom (see
+                    getMessages).
+
+            newest_first: boolean. Page backwards: return the messages sent
+                    *before* the positions in the cursor, newest first.
+
+            The returned dict has the same fields as getMessages, plus
+            'next_cursor', which must be passed in to get the messages
+            that are sent afterwards (or with newest_first, the next page of
+            older messages). Unlike with dates, no messages get lost or 
+            returned twice when messages are sent at the same time.
+
+            A cursor returned with newest_first must only be passed in 
+            again with newest_first, and vice versa.
         """
 
-    def getNewMessages(username, password, since):
+    def getNewMessagesByCursor(username, password, cursor):
+        """ Get all messages, from all conversations and chatrooms, sent
+            after the position in the cursor.
+
+            username:   string
+            password:   string
+            cursor:     None or an opaque string, as returned in the 
+                        'next_cursor' field of a previous call.
+
+            See getMessagesByCursor.
+        """
+
+    def getNewMessages(username, password, since, version=None):
         """ Get all messages since a certain date.
             
             username:   string
             password:   string
             since:      iso8601 date string or None
+            version:    None or the 'version' returned by a previous call
+
+            If since=None, get all messages. If since=config.NULL_DATE, get
+            the messages that haven't been cleared yet (see 
+            getUnclearedMessages).
+
+            The 'version' field of the returned dict changes whenever a 
+            message is sent to one of the user's conversations or 
+            chatrooms, he clears his messages or joins or leaves a chatroom.
+            If the version passed in is still the current one, nothing has
+            changed since the call that returned it, and the status is
+            NOT_MODIFIED, without any messages. This is much cheaper than
+            looking for new messages, so clients that poll should pass in
+            the version (together with the 'last_msg_date' of the same
+            call as 'since').
+        """
+
+    def waitForNewMessages(username, password, since, timeout):
+        """ Like getNewMessages, but if there are no new messages yet, wait
+            until one arrives or until 'timeout' has passed.
+
+            username:   string
+            password:   string
+            since:      iso8601 date string or None
+            timeout:    the amount of seconds to wait (a number, or a 
+                        string containing one), at most 
+                        config.MAX_WAIT_TIMEOUT. None means the maximum.
 
-            If since=None, get all messages.
+            If no messages arrived in time, the status is TIMEOUT. The
+            returned dict has a 'version' field, like with getNewMessages.
+
+            Every waiting request occupies a Zope worker thread, so the
+            number of threads must be configured accordingly.
         """
 
-    def getUnclearedMessages(username, password, partner, chatrooms, until, clear):
+    def getUnclearedMessages(username, password, partner, chatrooms, until, clear,
+                             limit=None, newest_first=False):
         """ Get all messages since the last clearance date. 
-            Optionally mark them as cleared.
+            Optionally mark them as cleared, which also resets the unread 
+            counts of the conversations and chatrooms (see getUnreadCounts).
+
+            Messages are cleared per conversation and chatroom, so clearing
+            the messages of one partner doesn't clear those of the others.
 
             username:   string
             password:   string
@@ -120,10 +279,168 @@ class IChatService(Interface):
             partner: None or '*' or a string
                 - None: ignore partners
                 - *   : match all partners   
-            chatrooms: '*' or list   
+            chatrooms: None or '*' or list   
+                - None: ignore chatrooms
                 - *   : match all chatrooms
             until: iso8601 date string or None
             clear: boolean
+            limit, newest_first: see getMessages. Only the returned 
+                   messages are cleared: with a limit, a conversation or
+                   chatroom is cleared up to its last returned message, 
+                   and with newest_first, one that has more uncleared 
+                   messages than the limit isn't cleared at all.
+        """
+
+    def getUnreadCounts(username, password):
+        """ Returns the amount of messages that the user received since he
+            last cleared them via getUnclearedMessages, per conversation
+            partner and chatroom.
+
+            username:   string
+            password:   string
+
+            The returned dict contains the fields 'messages' and
+            'chatroom_messages', which map conversation partners and 
+            chatrooms to their (non-zero) unread counts.
+        """
+
+    def sync(username, password, cursor, clear=False, online_cursor=None):
+        """ Do what a polling client needs in one call: confirm that the
+            user is online, get his new messages and which users came 
+            online or went offline.
+
+            username:       string
+            password:       string
+            cursor:         None or an opaque string, as returned in the
+                            'next_cursor' field of a previous call (or of
+                            getNewMessagesByCursor).
+            clear:          boolean. Mark the returned messages, and all
+                            the ones before them, as cleared (see 
+                            getUnclearedMessages).
+            online_cursor:  None or an opaque string, as returned in the
+                            'online_cursor' field of a previous call.
+
+            The returned dict has the same fields as getNewMessagesByCursor,
+            plus 'came_online' and 'went_offline', which list the users that
+            came online or went offline since the call that returned 
+            'online_cursor', and the new 'online_cursor'. If online_cursor
+            is None, or the changes since it are no longer known (see 
+            IPresenceBackend.changes), 'came_online' lists all the online 
+            users instead and 'online_reset' is True.
+
+            Without a cursor, only the newest config.SYNC_HISTORY messages 
+            of every conversation and chatroom are returned. The returned
+            'history_cursor' can then be passed to getMessagesByCursor with
+            newest_first, to page back through the older messages.
+        """
+
+    def setStatus(username, password, status):
+        """ Tell the users with whom the user has a conversation or shares
+            a chatroom that his status changed.
+
+            username:   string
+            password:   string
+            status:     one of config.USER_STATUS
+
+            Like typing notifications, status changes are ephemeral events:
+            they are kept in memory for config.STATUS_TTL seconds and are
+            never stored in the ZODB. They are returned in the 'events' 
+            field of getNewMessages, getNewMessagesByCursor, 
+            waitForNewMessages and sync, as dicts with the 'sender', 'type'
+            ('status' or 'typing'), 'value' and 'chatroom' (or None) of the
+            event. A newer event of the same sender, type and chatroom 
+            replaces the older one.
+        """
+
+    def setTyping(username, password, partner, chatroom, typing):
+        """ Tell the conversation partner, or the other participants of 
+            the chatroom, whether the user is typing a message.
+
+            username:   string
+            password:   string
+            partner:    None or a username
+            chatroom:   None or the chatroom's path. Either partner or 
+                        chatroom must be given.
+            typing:     boolean
+
+            The event is delivered for config.TYPING_TTL seconds, or until
+            the user stops typing. See setStatus.
+        """
+
+    def getStats():
+        """ Returns the metrics of the chat service, in the Prometheus text
+            format (and not as JSON).
+
+            For every public method (and some internal ones) it includes the
+            amount of calls, a histogram of their durations (see
+            config.METRICS_BUCKETS) and, per call of the public methods, 
+            the amount of conversations/chatrooms scanned and skipped 
+            (because they have no new messages), of messages scanned, the
+            size of the response and the amount of objects loaded from the
+            ZODB.
+
+            The metrics are kept in memory per Zope process.
+        """
+
+
+class IPresenceBackend(Interface):
+    """ Stores when users were last confirmed as being online. 
+
+        The backend is shared by all the threads of a Zope process, and
+        possibly also between processes. Register a utility providing this
+        interface to replace the default in-memory backend. 
+        See babble.server.presence.py
+
+        Backends may forget users that were last confirmed as online more
+        than config.PRESENCE_WINDOW seconds ago.
+    """
+
+    def confirm(username, now):
+        """ Record that the user was online at 'now' (a time.time() 
+            timestamp).
+        """
+
+    def lastSeen(username):
+        """ Return the timestamp at which the user was last confirmed as
+            online, or None.
+        """
+
+    def users(since):
+        """ Return the users that were confirmed as online after the 
+            timestamp 'since'.
+        """
+
+    def changes(since):
+        """ Return a (now, came_online, went_offline) tuple, where 'now' is
+            the current timestamp, came_online lists the users that are 
+            online and came online after the timestamp 'since', and 
+            went_offline the users that went offline after it and are still
+            offline. 
+
+            Return None if the backend can't tell, e.g. because 'since' is
+            older than config.PRESENCE_WINDOW seconds.
+        """
+
+
+class IEventChannel(Interface):
+    """ Delivers ephemeral events, like typing notifications, which
+        expire and are never stored in the ZODB.
+
+        Like the IPresenceBackend, the channel is shared by all the threads
+        of a Zope process. Register a utility providing this interface to
+        share the events between ZEO clients. 
+        See babble.server.events.py
+    """
+
+    def publish(recipients, event, expires):
+        """ Deliver the event (a dict) to the recipients until 'expires' (a
+            time.time() timestamp). It replaces their previous event with 
+            the same 'sender', 'type' and 'chatroom'.
+        """
+
+    def events(recipient, now):
+        """ Return the recipient's events that haven't expired at 'now',
+            in a stable order.
         """
 
 
@@ -4,20 +4,56 @@ from datetime import datetime
 from zope.interface import implements
 from OFS.SimpleItem import SimpleItem
 from interfaces import IMessage
+from utils import key_to_date
 
 class Message(SimpleItem):
     """ A message """
 
     implements(IMessage)
 
-    def __init__(self, message, author, fullname):
+    def __init__(self, message, author, fullname, key=None):
         """ Initialize message 
+
+            key is the optional integer message key (microseconds since the
+            epoch) under which the message is stored in its MessageBox.
         """
         self._cleared = False
         self.author = author
         self.text = message
         self.fullname = fullname
 
-        ts = time.time()
-        self.id = '%f' % ts
-        self.time = datetime.utcfromtimestamp(ts).replace(tzinfo=utc).isoformat()
+        if key is None:
+            ts = time.time()
+            self.id = '%f' % ts
+            self.time = datetime.utcfromtimestamp(ts).replace(tzinfo=utc).isoformat()
+        else:
+            self.id = str(key)
+            self.time = key_to_date(key)
+
+
+class MessageRecord(object):
+    """ A message as stored in a MessageBox.
+
+        MessageBoxes don't store a persistent Message object per message, but
+        only the tuple returned by 'pack', which is pickled together with the
+        other messages in the same LOBTree bucket. MessageRecords are
+        created on the fly when messages are read.
+    """
+
+    implements(IMessage)
+
+    __slots__ = ('key', 'author', 'text', 'fullname')
+
+    def __init__(self, key, author, text, fullname):
+        self.key = key
+        self.author = author
+        self.text = text
+        self.fullname = fullname
+
+    @property
+    def time(self):
+        return key_to_date(self.key)
+
+    def pack(self):
+        """ Return the tuple that gets stored in the MessageBox """
+        return (self.author, self.text, self.fullname)
@@ -1,18 +1,220 @@
 import logging
+import time
+from itertools import islice
 from zope.interface import implements
+from BTrees.LOBTree import LOBTree
+from BTrees.Length import Length
 from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
-from message import Message
+from message import MessageRecord
 from interfaces import IMessageBox
+from utils import date_to_key
+from utils import iter_backwards
+from utils import timestamp_to_key
+import config
 
 log = logging.getLogger(__name__)
 
 class MessageBox(BTreeFolder2):
-    """ A container for messages """
+    """ A container for messages 
+
+        Messages are stored in an LOBTree, keyed by the integer amount of
+        microseconds since the epoch at which they were sent (see
+        utils.timestamp_to_key). This allows messages to be fetched by date
+        range without having to inspect every message in the box.
+
+        The values are plain (author, text, fullname) tuples (see
+        message.MessageRecord) and not persistent objects, so they are
+        pickled inside the LOBTree's buckets. A bucket of messages is
+        therefore loaded and cached as one object.
+
+        MessageBoxes created by earlier versions stored Message objects,
+        either in the LOBTree or as folder items with '%f' % time.time()
+        string ids. These are still returned, but should be converted by
+        calling _migrateMessages (see Extensions/upgrade_to_1_2.py).
+    """
     implements(IMessageBox)
 
-    def addMessage(self, text, author, fullname):
-        """ Add a message to the MessageBox """
-        message = Message(text, author, fullname)
-        self._setObject(message.id, message)
+    _messages = None
+    _message_count = None
+
+    def __init__(self, id, title=''):
+        super(MessageBox, self).__init__(id, title)
+        self._messages = LOBTree()
+        self._message_count = Length()
+
+
+    def _getMessages(self):
+        if self._messages is None:
+            self._messages = LOBTree()
+        return self._messages
+
+
+    def _nextKey(self, key):
+        """ Return the first unused key not smaller than key. Keys are
+            unique and increasing per MessageBox.
+        """
+        try:
+            last_key = self._getMessages().maxKey()
+        except ValueError:
+            return key
+        return max(key, last_key + 1)
+
+
+    def _messageCount(self):
+        """ Return the amount of messages that were added to the box """
+        if self._message_count is None:
+            # BBB: Boxes created by older versions don't count their messages
+            return len(self._messages or ()) + self.objectCount()
+        return self._message_count()
+
+
+    def _getMessageCount(self):
+        if self._message_count is None:
+            self._message_count = Length(self._messageCount())
+        return self._message_count
+
+
+    def addMessage(self, text, author, fullname, key=None):
+        """ Add a message to the MessageBox 
+
+            key is the message's key as handed out by the container's
+            Sequence. The current time is used if it's not given.
+        """
+        if key is None:
+            key = timestamp_to_key(time.time())
+        key = self._nextKey(key)
+        message = MessageRecord(key, author, text, fullname)
+        self._getMessages()[key] = message.pack()
+        self._getMessageCount().change(1)
         return message 
 
+
+    def _getMessage(self, key):
+        """ Return the message stored in the LOBTree under key, or None """
+        if self._messages is None:
+            return None
+        value = self._messages.get(key)
+        if isinstance(value, tuple):
+            value = MessageRecord(key, *value)
+        return value
+
+
+    def _legacyItems(self, since, until):
+        """ Return (key, id) tuples of the messages stored as folder items,
+            sorted by key.
+        """
+        items = []
+        for id in self.objectIds():
+            key = timestamp_to_key(float(id))
+            if since < key <= until:
+                items.append((key, id))
+        items.sort()
+        return items
+
+
+    def _iterMessages(self, since, until):
+        """ Yield (key, message) tuples, ordered by key, for the messages
+            sent after 'since' and up to and including 'until'.
+
+            since and until are integer message keys.
+        """
+        # Messages stored as folder items predate those in the LOBTree
+        if self.objectCount():
+            for key, id in self._legacyItems(since, until):
+                yield key, self._getOb(id)
+
+        if self._messages is not None:
+            for key, value in self._messages.items(since+1, until):
+                if isinstance(value, tuple):
+                    value = MessageRecord(key, *value)
+                yield key, value
+
+
+    def _iterMessagesBackwards(self, since, until):
+        """ Like _iterMessages, but yield the newest messages first """
+        if self._messages is not None:
+            for key, value in iter_backwards(self._messages, since, until):
+                if isinstance(value, tuple):
+                    value = MessageRecord(key, *value)
+                yield key, value
+
+        if self.objectCount():
+            items = self._legacyItems(since, until)
+            items.reverse()
+            for key, id in items:
+                yield key, self._getOb(id)
+
+
+    def _lastKey(self, until):
+        """ Return the key of the last message sent up to and including
+            'until', or None if there isn't any.
+        """
+        if self._messages is not None:
+            try:
+                return self._messages.maxKey(until)
+            except ValueError:
+                pass
+
+        if self.objectCount():
+            items = self._legacyItems(config.NULL_KEY, until)
+            if items:
+                return items[-1][0]
+        return None
+
+
+    def _pruneMessages(self, until, limit):
+        """ Delete at most 'limit' of the messages sent up to and including
+            'until', oldest first. Returns the keys of the deleted messages.
+
+            The message count isn't decreased, it counts the messages that 
+            were ever added.
+        """
+        self._getMessageCount()
+        keys = []
+        if self.objectCount():
+            for key, id in self._legacyItems(config.NULL_KEY, until)[:limit]:
+                self._delObject(id)
+                keys.append(key)
+
+        if self._messages is not None and len(keys) < limit:
+            expired = islice(self._messages.keys(config.NULL_KEY, until), 
+                             limit - len(keys))
+            for key in list(expired):
+                del self._messages[key]
+                keys.append(key)
+        return keys
+
+
+    def _migrateMessages(self):
+        """ Convert the Message objects, stored as folder items or in the
+            LOBTree, into records in the LOBTree.
+            Returns the amount of messages that were converted.
+        """
+        messages = self._getMessages()
+        count = 0
+        for key, message in list(messages.items()):
+            if not isinstance(message, tuple):
+                messages[key] = self._pack(key, message)
+                count += 1
+
+        for id in list(self.objectIds()):
+            message = self._getOb(id)
+            try:
+                key = date_to_key(message.time)
+            except (ValueError, TypeError, AttributeError):
+                key = timestamp_to_key(float(id))
+
+            while key in messages:
+                key += 1
+            self._delOb(id)
+            messages[key] = self._pack(key, message)
+            count += 1
+        return count
+
+
+    def _pack(self, key, message):
+        """ Return the record for a Message object """
+        # BBB: Older messages don't have a fullname
+        fullname = getattr(message, 'fullname', message.author)
+        return MessageRecord(key, message.author, message.text, fullname).pack()
+
@@ -0,0 +1,166 @@
+import inspect
+import logging
+import threading
+import time
+import config
+
+log = logging.getLogger(__name__)
+
+class Metrics(object):
+    """ Process-wide, thread-safe counters and latency histograms of the
+        ChatService's methods.
+
+        Every call of an instrumented method is counted and timed. Counts
+        recorded during a call (e.g. the amount of messages scanned) are
+        attributed to the outermost instrumented method of the thread, i.e
+        to the public method that the client called.
+    """
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = config.METRICS_BUCKETS
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            # method -> [bucket counts..., +Inf count], sum of durations
+            self._histograms = {}
+            self._sums = {}
+            # (counter name, method) -> value
+            self._counters = {}
+        finally:
+            self._lock.release()
+
+
+    def observe(self, method, duration):
+        """ Record a call of the method that took 'duration' seconds """
+        self._lock.acquire()
+        try:
+            counts = self._histograms.get(method)
+            if counts is None:
+                counts = self._histograms[method] = [0] * (len(self.buckets) + 1)
+                self._sums[method] = 0.0
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[method] += duration
+        finally:
+            self._lock.release()
+
+
+    def count(self, name, amount=1, method=None):
+        """ Add 'amount' to the counter 'name' of the method, which defaults
+            to the method currently being called by this thread.
+        """
+        if method is None:
+            method = getattr(self._local, 'method', None)
+            if method is None:
+                return
+        self._lock.acquire()
+        try:
+            key = (name, method)
+            self._counters[key] = self._counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+
+    def call(self, method, func, *args):
+        """ Call func, recording the call as one of 'method' """
+        outer = getattr(self._local, 'method', None) is None
+        jar = None
+        if outer:
+            self._local.method = method
+            jar = getattr(args[0], '_p_jar', None)
+            if jar is not None:
+                loads = jar.getTransferCounts()[0]
+        start = time.time()
+        try:
+            try:
+                result = func(*args)
+            except:
+                self.count('errors', 1, method)
+                raise
+            if outer and isinstance(result, basestring):
+                self.count('response_bytes', len(result), method)
+            return result
+        finally:
+            self.observe(method, time.time() - start)
+            if outer:
+                self._local.method = None
+                if jar is not None:
+                    self.count('zodb_loads',
+                               jar.getTransferCounts()[0] - loads, method)
+
+
+    def render(self):
+        """ Return the metrics in the Prometheus text exposition format """
+        self._lock.acquire()
+        try:
+            histograms = dict([(m, list(c)) for m, c in self._histograms.items()])
+            sums = self._sums.copy()
+            counters = self._counters.copy()
+        finally:
+            self._lock.release()
+
+        lines = [
+            '# HELP babble_calls_total Calls of the chat service methods.',
+            '# TYPE babble_calls_total counter',
+            ]
+        for method in sorted(histograms):
+            lines.append('babble_calls_total{method="%s"} %d'
+                         % (method, histograms[method][-1]))
+
+        lines += [
+            '# HELP babble_call_duration_seconds Duration of the chat service calls.',
+            '# TYPE babble_call_duration_seconds histogram',
+            ]
+        for method in sorted(histograms):
+            counts = histograms[method]
+            for bound, count in zip(self.buckets, counts):
+                lines.append('babble_call_duration_seconds_bucket{method="%s",le="%s"} %d'
+                             % (method, repr(float(bound)), count))
+            lines.append('babble_call_duration_seconds_bucket{method="%s",le="+Inf"} %d'
+                         % (method, counts[-1]))
+            lines.append('babble_call_duration_seconds_sum{method="%s"} %s'
+                         % (method, repr(sums[method])))
+            lines.append('babble_call_duration_seconds_count{method="%s"} %d'
+                         % (method, counts[-1]))
+
+        names = sorted(set([name for name, method in counters]))
+        for name in names:
+            metric = 'babble_%s_total' % name
+            lines.append('# TYPE %s counter' % metric)
+            for (n, method), value in sorted(counters.items()):
+                if n == name:
+                    lines.append('%s{method="%s"} %d' % (metric, method, value))
+        return '\n'.join(lines) + '\n'
+
+
+def instrumented(func, name=None):
+    """ Return a function with the same signature as func, which records
+        its calls in the metrics.
+
+        The signature must be preserved, because the Zope publisher maps
+        the request's arguments onto it.
+    """
+    if name is None:
+        name = func.__name__
+    args, varargs, varkw, defaults = inspect.getargspec(func)
+    signature = inspect.formatargspec(args, varargs, varkw)[1:-1]
+    namespace = {'_call': metrics.call, '_func': func, '_name': name}
+    exec ('def %s(%s):\n    return _call(_name, _func, %s)\n'
+          % (func.__name__, signature, signature)) in namespace
+    wrapper = namespace[func.__name__]
+    wrapper.func_defaults = func.func_defaults
+    wrapper.__doc__ = func.__doc__
+    wrapper.__module__ = func.__module__
+    return wrapper
+
+
+metrics = Metrics()
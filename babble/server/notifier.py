@@ -0,0 +1,100 @@
+import logging
+import threading
+import transaction
+
+log = logging.getLogger(__name__)
+
+class Notifier(object):
+    """ Lets threads wait until a message arrives for a user.
+
+        Every user has a version number, which is increased whenever a
+        message for him is committed. A waiting thread remembers the
+        version before it looks for messages, and then waits until it
+        changes.
+
+        This only works within one process. Waiting threads should therefore
+        regularly check for messages themselves, to also pick up messages
+        that were sent via other ZEO clients.
+
+        Only the versions of the users for whom a thread is about to wait
+        are kept: getting the version registers the thread's interest, 
+        until it waits or releases it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+        self._interested = {}
+
+
+    def version(self, username):
+        """ Return the user's current version, and register interest in
+            his notifications until wait or release is called.
+        """
+        self._condition.acquire()
+        try:
+            self._interested[username] = self._interested.get(username, 0) + 1
+            return self._versions.get(username, 0)
+        finally:
+            self._condition.release()
+
+
+    def _release(self, username):
+        """ Must be called with the lock held """
+        count = self._interested.get(username, 0) - 1
+        if count > 0:
+            self._interested[username] = count
+        else:
+            self._interested.pop(username, None)
+            self._versions.pop(username, None)
+
+
+    def release(self, username):
+        """ Release the interest registered by version, without waiting """
+        self._condition.acquire()
+        try:
+            self._release(username)
+        finally:
+            self._condition.release()
+
+
+    def notify(self, usernames):
+        """ Wake up the threads waiting for any of the users """
+        self._condition.acquire()
+        try:
+            for username in usernames:
+                if username in self._interested:
+                    self._versions[username] = self._versions.get(username, 0) + 1
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+
+    def wait(self, username, version, timeout):
+        """ Wait at most 'timeout' seconds until the user's version differs
+            from 'version', as returned by the version method. Returns True
+            if it does.
+        """
+        self._condition.acquire()
+        try:
+            if self._versions.get(username, 0) == version:
+                self._condition.wait(timeout)
+            return self._versions.get(username, 0) != version
+        finally:
+            self._release(username)
+            self._condition.release()
+
+
+def _afterCommit(status, usernames):
+    if status:
+        notifier.notify(usernames)
+
+
+def notify_after_commit(usernames):
+    """ Notify the waiting threads of the users, once (and if) the current
+        transaction gets committed.
+    """
+    transaction.get().addAfterCommitHook(_afterCommit, (list(usernames),))
+
+
+notifier = Notifier()
@@ -0,0 +1,43 @@
+import logging
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+
+log = logging.getLogger(__name__)
+
+class PerUserStorage(Persistent):
+    """ Base class for the data that the chat service keeps per user (by
+        hashed username): the conversation and chatroom indexes, the 
+        inboxes and join keys, the read cursors and the change versions.
+
+        Every user gets his own BTree (or BTrees.Length) in an OOBTree, so
+        that writes for different users don't conflict with each other, 
+        and concurrent writes for the same user are resolved by the
+        conflict resolution of his BTree.
+    """
+
+    def __init__(self):
+        self._trees = OOBTree()
+
+
+    def _getTree(self, user, factory=None):
+        """ Return the user's tree. If he doesn't have one yet, it's created
+            with 'factory', or None is returned if no factory is given.
+        """
+        tree = self._trees.get(user)
+        if tree is None and factory is not None:
+            tree = self._trees[user] = factory()
+        return tree
+
+
+    def keys(self):
+        return self._trees.keys()
+
+
+    def delete(self, user):
+        """ Forget the user's tree, if he has one """
+        if user in self._trees:
+            del self._trees[user]
+
+
+    def clear(self):
+        self._trees.clear()
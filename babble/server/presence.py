@@ -0,0 +1,233 @@
+import collections
+import fcntl
+import heapq
+import logging
+import os
+import threading
+import time
+import simplejson as json
+from zope.component import queryUtility
+from zope.interface import implements
+from interfaces import IPresenceBackend
+import config
+
+log = logging.getLogger(__name__)
+
+class MemoryPresence(object):
+    """ Keeps the users' presence in memory.
+
+        It is shared by all the threads (and therefore all the ZODB 
+        connections) of the Zope process, but not between ZEO clients.
+
+        The window defaults to config.PRESENCE_WINDOW, which is then read
+        on every call.
+
+        Users are also put into buckets per 'resolution' seconds, according
+        to when they were last seen. The buckets are kept in a heap, so that
+        once a bucket is older than 'window' seconds, its users can be
+        forgotten without having to look at the other users. Looking up the
+        online users therefore takes time proportional to the amount of
+        users that are actually online.
+
+        To tell which users came online or went offline (see changes), it
+        also remembers since when every user is online, and when the
+        forgotten users went offline during the last 'window' seconds.
+    """
+    implements(IPresenceBackend)
+
+    def __init__(self, window=None, resolution=1):
+        self.window = window
+        self.resolution = resolution
+        self._lock = threading.Lock()
+        self._last_seen = {}
+        self._online_since = {}
+        self._went_offline = collections.deque()
+        self._buckets = {}
+        self._heap = []
+        self._started = time.time()
+
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.resolution)
+
+
+    def _window(self):
+        if self.window is None:
+            return config.PRESENCE_WINDOW
+        return self.window
+
+
+    def _evict(self, now):
+        """ Forget the users in the buckets that lie entirely before the
+            window. Must be called with the lock held.
+        """
+        window = self._window()
+        limit = self._bucket(now - window)
+        while self._heap and self._heap[0] < limit:
+            for username in self._buckets.pop(heapq.heappop(self._heap)):
+                last_seen = self._last_seen.pop(username)
+                del self._online_since[username]
+                self._went_offline.append((last_seen + window, username))
+
+        # The changes before the window are no longer needed (see changes)
+        while self._went_offline and self._went_offline[0][0] <= now - window:
+            self._went_offline.popleft()
+
+
+    def confirm(self, username, now):
+        """ See interfaces.IPresenceBackend """
+        with self._lock:
+            current = time.time()
+            window = self._window()
+            last_seen = self._last_seen.get(username)
+            if last_seen is not None:
+                self._buckets[self._bucket(last_seen)].discard(username)
+                if last_seen <= current - window:
+                    # He went offline, but hasn't been forgotten yet
+                    self._went_offline.append((last_seen + window, username))
+                    last_seen = None
+            if last_seen is None:
+                self._online_since[username] = current
+
+            bucket = self._bucket(now)
+            if bucket not in self._buckets:
+                self._buckets[bucket] = set()
+                heapq.heappush(self._heap, bucket)
+            self._buckets[bucket].add(username)
+            self._last_seen[username] = now
+            self._evict(current)
+
+
+    def lastSeen(self, username):
+        """ See interfaces.IPresenceBackend """
+        with self._lock:
+            self._evict(time.time())
+            return self._last_seen.get(username)
+
+
+    def users(self, since):
+        """ See interfaces.IPresenceBackend """
+        with self._lock:
+            self._evict(time.time())
+            return [u for u, t in self._last_seen.iteritems() if t > since]
+
+
+    def changes(self, since):
+        """ See interfaces.IPresenceBackend """
+        with self._lock:
+            now = time.time()
+            self._evict(now)
+            window = self._window()
+            if since < max(self._started, now - window):
+                return None
+
+            online = set([u for u, t in self._last_seen.iteritems() 
+                          if t > now - window])
+            came_online = [u for u in online if self._online_since[u] > since]
+            went_offline = set([u for t, u in self._went_offline 
+                                if since < t <= now])
+            went_offline.update([u for u, t in self._last_seen.iteritems() 
+                                 if since < t + window <= now])
+            return now, sorted(came_online), sorted(went_offline - online)
+
+
+
+class FilePresence(object):
+    """ Keeps the users' presence in a JSON file.
+
+        This allows all the Zope processes on the same host to share it,
+        which is useful for testing a setup with multiple ZEO clients. In
+        production, a backend that stores the presence in a shared network
+        service should be used instead.
+
+        Like MemoryPresence, the window defaults to config.PRESENCE_WINDOW
+        at the time of the call.
+    """
+    implements(IPresenceBackend)
+
+    def __init__(self, path, window=None):
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+
+
+    def _open(self, exclusive):
+        """ Open and lock the file. The lock is released when the file is
+            closed.
+        """
+        f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0600), 'r+')
+        fcntl.flock(f, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+        return f
+
+
+    def _read(self, f):
+        content = f.read()
+        if not content:
+            return {}
+        try:
+            return json.loads(content)
+        except ValueError:
+            log.warn("The presence file %s is corrupt, and will be reset." 
+                     % self.path)
+            return {}
+
+
+    def confirm(self, username, now):
+        """ See interfaces.IPresenceBackend """
+        with self._lock:
+            f = self._open(True)
+            try:
+                # Forget the users that were last seen before the window
+                window = self.window
+                if window is None:
+                    window = config.PRESENCE_WINDOW
+                cutoff = time.time() - window
+                last_seen = dict([(u, t) for u, t in self._read(f).items() 
+                                  if t > cutoff])
+                last_seen[username] = now
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(last_seen))
+            finally:
+                f.close()
+
+
+    def _lastSeen(self):
+        with self._lock:
+            f = self._open(False)
+            try:
+                return self._read(f)
+            finally:
+                f.close()
+
+
+    def lastSeen(self, username):
+        """ See interfaces.IPresenceBackend """
+        return self._lastSeen().get(username)
+
+
+    def users(self, since):
+        """ See interfaces.IPresenceBackend """
+        return [u for u, t in self._lastSeen().items() if t > since]
+
+
+    def changes(self, since):
+        """ See interfaces.IPresenceBackend 
+
+            The file doesn't record when users came online or went offline,
+            so this always returns None.
+        """
+        return None
+
+
+_default = MemoryPresence()
+
+def get_backend():
+    """ Return the registered IPresenceBackend utility, or, if there is none,
+        the process-wide MemoryPresence.
+    """
+    backend = queryUtility(IPresenceBackend)
+    if backend is None:
+        return _default
+    return backend
+
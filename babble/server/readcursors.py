@@ -0,0 +1,50 @@
+import logging
+from BTrees.OOBTree import OOBTree
+from peruser import PerUserStorage
+
+log = logging.getLogger(__name__)
+
+class ReadCursors(PerUserStorage):
+    """ Stores, per user and per conversation or chatroom, up to which 
+        message the user has cleared the messages.
+
+        A cursor is a (key, count) tuple: the integer key of the last 
+        cleared message and the amount of messages the user had received
+        in the container by then (see MessageContainer._receivedCount).
+
+        Previously the clearance date was stored on the user object in
+        acl_users, where every clear conflicted with logins and password
+        changes.
+    """
+
+    def get(self, user, container_id, default=None):
+        """ Return the user's cursor for the container """
+        cursors = self._getTree(user)
+        if cursors is None:
+            return default
+        return cursors.get(container_id, default)
+
+
+    def getAll(self, user):
+        """ Return the user's cursors, keyed by container id """
+        return self._getTree(user) or {}
+
+
+    def set(self, user, container_id, key, count):
+        """ Set the user's cursor for the container. Returns False if it 
+            was already set to these values, to avoid a pointless write.
+        """
+        cursors = self._getTree(user, OOBTree)
+        if cursors.get(container_id) == (key, count):
+            return False
+        cursors[container_id] = (key, count)
+        return True
+
+
+    def remove(self, user, container_id):
+        """ Remove the user's cursor for the container, e.g. because the
+            container was deleted.
+        """
+        cursors = self._getTree(user)
+        if cursors is not None and container_id in cursors:
+            del cursors[container_id]
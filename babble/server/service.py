@@ -1,22 +1,44 @@
 import logging
+import os
+import time
+import transaction
 import simplejson as json
-from datetime import datetime
-from datetime import timedelta
-from pytz import utc
 
 from zope.interface import implements
 
+from Acquisition import aq_base
 from AccessControl import ClassSecurityInfo
 from Globals import InitializeClass
 from OFS.Folder import Folder
 
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
 from Products.BTreeFolder2.BTreeFolder2 import manage_addBTreeFolder
 
 from interfaces import IChatService
 from conversation import Conversation
 from chatroom import ChatRoom
+from inbox import Inboxes
+from inbox import JoinKeys
+from index import ReverseIndex
+from readcursors import ReadCursors
+from events import get_channel
+from versions import ChangeVersions
+from metrics import instrumented
+from metrics import metrics
+from notifier import notifier
+from notifier import notify_after_commit
+from utils import create_token
+from utils import date_to_key
+from utils import decode_cursor
+from utils import encode_cursor
 from utils import hashed
+from utils import key_to_date
+from utils import parse_days
+from utils import parse_limit
+from utils import timestamp_to_key
+from utils import verify_token
 import config
+import presence
 
 log = logging.getLogger(__name__)
 
@@ -26,70 +48,545 @@ class ChatService(Folder):
     security = ClassSecurityInfo()
     security.declareObjectProtected('Use Chat Service')
 
+    _conversation_index = None
+    _chatroom_index = None
+    _token_secret = None
+    _inboxes = None
+    _join_keys = None
+    _read_cursors = None
+    _change_versions = None
+    # When fanout is enabled, a pointer to every message is added to the
+    # inboxes of its recipients. See _setFanout
+    fanout = False
+    # Whether the inboxes contain all the existing messages, i.e. whether
+    # they can be read from.
+    _inboxes_complete = True
+    # The amount of days after which messages are deleted, if not set on
+    # the chatroom. None means that config.RETENTION_DAYS applies.
+    retention_days = None
+
+    def __init__(self, id=None):
+        super(ChatService, self).__init__(id)
+        self._conversation_index = ReverseIndex()
+        self._chatroom_index = ReverseIndex()
+        self._token_secret = os.urandom(32).encode('hex')
+        self._read_cursors = ReadCursors()
+        self._change_versions = ChangeVersions()
+
+
+    def _getPresence(self):
+        """ Return the backend that stores when users were last confirmed
+            as online.
+
+            See babble.server.interfaces.py:IPresenceBackend
+        """
+        return presence.get_backend()
 
-    def _getUserAccessDict(self):
-        if not hasattr(self, '_v_user_access_dict'):
-            log.warn("_getUserAccessDict: Volatile User Access Dict was not found")
-            setattr(self, '_v_user_access_dict', {})
 
-        return getattr(self, '_v_user_access_dict')
+    def _setOnline(self, username):
+        """ Record that the user is currently online """
+        backend = self._getPresence()
+        now = time.time()
+        last_seen = backend.lastSeen(username)
+        if last_seen is None or last_seen + config.PRESENCE_THROTTLE < now:
+            backend.confirm(username, now)
 
 
-    def _setUserAccessDict(self, username):
-        """ """
-        now = datetime.now()
-        if hasattr(self, '_v_user_access_dict'):
-            uad = getattr(self, '_v_user_access_dict')
-            if uad.get(username, datetime.min) + timedelta(seconds=30) < now:
-                uad[username] = now
-        else:
-            log.warn("_setUserAccessDict: Volatile User Access Dict was not found")
-            setattr(self, '_v_user_access_dict', {username: now})
+    def _getFolder(self, id, title, create=True):
+        """ Return the BTreeFolder with the given id, which is recreated
+            if it doesn't exist. 
+            
+            If 'create' is False, an empty folder that isn't stored is
+            returned instead, so that reading never writes to the ZODB.
+        """
+        if not self.hasObject(id):
+            if not create:
+                return BTreeFolder2(id).__of__(self)
+            log.warn("The chatservice's '%s' folder did not exist, "
+                    "and has been automatically recreated." % title)
+            manage_addBTreeFolder(self, id, title)
 
+        return self._getOb(id)
 
-    def _getChatRoomsFolder(self):
-        """ The 'ChatRooms' folder is a BTreeFolder that contains IChatRoom objects.
+
+    def _getEvents(self, username):
+        """ Return the ephemeral events that haven't expired yet for the 
+            user. 
+
+            See babble.server.interfaces.py:IEventChannel
+        """
+        return get_channel().events(username, time.time())
+
+
+    def _publishEvent(self, recipients, event, ttl):
+        """ Deliver the event to the recipients for 'ttl' seconds, and wake
+            up their waiting threads. This doesn't touch the ZODB.
         """
-        if not self.hasObject('chatrooms'):
-            log.warn("The chatservice's 'ChatRooms' folder did not exist, "
-                    "and has been automatically recreated.")
-            manage_addBTreeFolder(self, 'chatrooms', 'ChatRooms')
+        recipients = set(recipients)
+        get_channel().publish(recipients, event, time.time() + ttl)
+        notifier.notify(recipients)
 
-        return self._getOb('chatrooms')
+
+    def _getChatRoomsFolder(self, create=True):
+        """ The 'ChatRooms' folder is a BTreeFolder that contains IChatRoom objects.
+        """
+        return self._getFolder('chatrooms', 'ChatRooms', create)
 
 
-    def _getConversationsFolder(self):
+    def _getConversationsFolder(self, create=True):
         """ The 'Conversations' folder is a BTreeFolder that contains
             IConversation objects.
 
             See babble.server.interfaces.py:IConversation
         """
-        if not self.hasObject('conversations'):
-            log.warn("The chatservice's 'Conversations' folder did not exist, "
-                    "and has been automatically recreated.")
-            manage_addBTreeFolder(self, 'conversations', 'Conversations')
+        return self._getFolder('conversations', 'Conversations', create)
+
+
+    def _getStorage(self, name, factory, create=True):
+        """ Return the per-user storage kept in the attribute 'name', which
+            is created by calling 'factory' if it doesn't exist. If 'create'
+            is False, the new one isn't stored, so that reading never writes
+            to the ZODB.
+
+            See babble.server.peruser.py:PerUserStorage
+        """
+        storage = getattr(aq_base(self), name, None)
+        if storage is None:
+            storage = factory()
+            if create:
+                setattr(self, name, storage)
+        return storage
+
 
-        return self._getOb('conversations')
+    def _getConversationIndex(self, create=True):
+        """ The conversation index maps a hashed username to the ids of the
+            conversations that the user takes part in. If it doesn't exist,
+            it is rebuilt.
+
+            See babble.server.index.py:ReverseIndex
+        """
+        return self._getStorage('_conversation_index', 
+                                self._newConversationIndex, create)
 
 
-    def _getConversation(self, user1, user2):
-        """ """
-        folder = self._getConversationsFolder()
+    def _newConversationIndex(self):
+        """ Build a conversation index from the existing conversations """
+        log.warn("The chatservice's conversation index did not exist, "
+                "and has been automatically rebuilt.")
+        index = ReverseIndex()
+        self._indexConversations(index)
+        return index
+
+
+    def _rebuildConversationIndex(self):
+        """ Recreate the conversation index from the ids of the existing
+            conversations.
+        """
+        index = self._conversation_index
+        if index is None:
+            index = self._conversation_index = ReverseIndex()
+        index.clear()
+        self._indexConversations(index)
+
+
+    def _indexConversations(self, index):
+        """ Add the existing conversations to the index """
+        for id in self._getConversationsFolder(False).objectIds():
+            for h in set(id.split('.')):
+                index.index(h, id)
+
+
+    def _getConversation(self, user1, user2, create=True):
+        """ Return the conversation between the two users, which is 
+            created if it doesn't exist yet. If 'create' is False, None is
+            returned instead.
+        """
+        folder = self._getConversationsFolder(create)
         id = '.'.join(sorted([hashed(user1), hashed(user2)]))
         if not folder.hasObject(id):
+            if not create:
+                return None
             folder._setObject(id, Conversation(id, user1, user2))
+            index = self._getConversationIndex()
+            index.index(hashed(user1), id)
+            index.index(hashed(user2), id)
         return folder._getOb(id)
 
 
     def _getConversationsFor(self, username):
-        """ """
-        f = self._getConversationsFolder()
-        username = hashed(username)
-        return [f._getOb(i) for i in f.objectIds() if username in i.split('.')]
+        """ Return the conversations in which the user takes part, as
+            registered in the conversation index.
+        """
+        f = self._getConversationsFolder(False)
+        ids = self._getConversationIndex(False).get(hashed(username))
+        return [c for c in [f._getOb(i, None) for i in ids] if c is not None]
+
+
+    def _getChatRoomIndex(self, create=True):
+        """ The chatroom index maps a hashed username to the ids of the
+            chatrooms that the user is a participant in. If it doesn't exist,
+            it is rebuilt.
+
+            See babble.server.index.py:ReverseIndex
+        """
+        return self._getStorage('_chatroom_index', 
+                                self._newChatRoomIndex, create)
+
+
+    def _newChatRoomIndex(self):
+        """ Build a chatroom index from the existing chatrooms """
+        log.warn("The chatservice's chatroom index did not exist, "
+                "and has been automatically rebuilt.")
+        index = ReverseIndex()
+        self._indexChatRooms(index)
+        return index
+
+
+    def _rebuildChatRoomIndex(self):
+        """ Recreate the chatroom index from the participants of the
+            existing chatrooms.
+        """
+        index = self._chatroom_index
+        if index is None:
+            index = self._chatroom_index = ReverseIndex()
+        index.clear()
+        self._indexChatRooms(index)
+
+
+    def _indexChatRooms(self, index):
+        """ Add the participants of the existing chatrooms to the index """
+        for chatroom in self._getChatRoomsFolder(False).values():
+            for p in chatroom._getParticipants():
+                index.index(hashed(p), chatroom.id)
+
+
+    def _setFanout(self, enabled):
+        """ Enable or disable fan-out on write. 
+
+            With fan-out, sending a message adds a pointer to it to the inbox
+            of every participant of the conversation or chatroom. Fetching
+            the new messages of all conversations and chatrooms then
+            requires only one range scan on the user's inbox, at the cost
+            of one write per recipient when sending.
+
+            Enabling fan-out fills the inboxes with the existing messages,
+            with a savepoint after every batch. To commit after every batch,
+            use Extensions/enable_fanout.py instead.
+        """
+        if enabled:
+            for count in self._enableFanout():
+                transaction.savepoint(optimistic=True)
+        else:
+            self.fanout = False
+            self._inboxes = None
+            self._join_keys = None
+
+
+    def _enableFanout(self, batch_size=None):
+        """ Enable fan-out and fill the inboxes with the existing messages.
+
+            This is a generator that adds at most 'batch_size' messages at a
+            time and then yields how many it added, so that the caller can
+            commit in between. Until it's done, new messages are already
+            added to the inboxes, but they aren't read from.
+        """
+        self.fanout = True
+        self._inboxes_complete = False
+        for count in self._rebuildInboxes(batch_size):
+            yield count
+        self._inboxes_complete = True
+
+
+    def _getInboxes(self, create=True):
+        """ See babble.server.inbox.py:Inboxes """
+        return self._getStorage('_inboxes', Inboxes, create)
+
+
+    def _getJoinKeys(self, create=True):
+        """ See babble.server.inbox.py:JoinKeys """
+        return self._getStorage('_join_keys', JoinKeys, create)
+
+
+    def _rebuildInboxes(self, batch_size=None):
+        """ Recreate the users' inboxes from the existing messages.
+
+            This is a generator that yields after every 'batch_size' 
+            messages, see _enableFanout.
+
+            The caller commits while we're suspended, and messages may be
+            sent in the meantime. We therefore don't keep iterating over 
+            any BTree across a yield: the ids of the containers and 
+            MessageBoxes, and the keys of a MessageBox's messages, are 
+            copied before they are processed.
+        """
+        if batch_size is None:
+            batch_size = config.FANOUT_BATCH_SIZE
+
+        inboxes = self._getInboxes()
+        inboxes.clear()
+        # The inboxes will contain the messages sent before users joined
+        # chatrooms as well
+        self._getJoinKeys().clear()
+        count = 0
+        for folder in [self._getConversationsFolder(), self._getChatRoomsFolder()]:
+            for id in list(folder.objectIds()):
+                container = folder._getOb(id, None)
+                if container is None:
+                    # It was deleted in the meantime
+                    continue
+                users = [hashed(u) for u in container._getPartners()]
+                for mbox_id in list(container.objectIds()):
+                    mbox = container._getOb(mbox_id, None)
+                    if mbox is None:
+                        continue
+                    keys = [key for key, m in 
+                            mbox._iterMessages(config.NULL_KEY, config.MAX_KEY)]
+                    for key in keys:
+                        pointer = (key, folder.getId(), container.id, mbox.id)
+                        for u in users:
+                            inboxes.add(u, pointer)
+                        count += 1
+                        if count >= batch_size:
+                            yield count
+                            count = 0
+        if count:
+            yield count
+
+
+    def _fanoutMessage(self, folder, container, message, usernames):
+        """ Add a pointer to the message to the inboxes of the users, if
+            fan-out is enabled.
+        """
+        if not self.fanout:
+            return
+        inboxes = self._getInboxes()
+        pointer = (message.key, folder.getId(), container.id, hashed(message.author))
+        for username in usernames:
+            inboxes.add(hashed(username), pointer)
+
+
+    def _fanoutHistory(self, chatroom, username):
+        """ Let the user read the existing messages of the chatroom from
+            his inbox, if fan-out is enabled. This is needed when he joins 
+            a chatroom.
+
+            Instead of adding all of them to his inbox, we only remember 
+            the chatroom's high-water mark, up to which they are read from
+            the chatroom itself (see inbox.JoinKeys).
+        """
+        if not self.fanout:
+            return
+        key = chatroom._highWaterMark()
+        if key > config.NULL_KEY:
+            self._getJoinKeys().set(hashed(username), chatroom.id, key)
+
+
+    def _getMessagesFromInbox(self, username, since, until):
+        """ Fetch the messages of all the user's conversations and chatrooms
+            from his inbox.
+
+            since may also be a function that returns the key for a given
+            container id (see _getMessagesFromContainers). The inbox is then
+            scanned from the smallest key of the user's containers.
+
+            The messages of chatrooms that were sent before the user joined
+            them are read from the chatrooms instead (see inbox.JoinKeys).
+
+            Returns the conversation messages, the chatroom messages and the
+            key of the latest message that was sent up to 'until'.
+        """
+        inboxes = self._getInboxes(False)
+        user = hashed(username)
+        join_keys = self._getJoinKeys(False).getAll(user)
+        container_since = since
+        if callable(since):
+            ids = list(self._getConversationIndex(False).get(user)) + \
+                  list(self._getChatRoomIndex(False).get(user))
+            since = min([container_since(id) for id in ids] or [config.NULL_KEY])
+        else:
+            container_since = None
+        folders = {}
+        msgs_dicts = {}
+        for folder in [self._getConversationsFolder(False), 
+                       self._getChatRoomsFolder(False)]:
+            folders[folder.getId()] = folder
+            msgs_dicts[folder.getId()] = {}
+
+        for key, folder_id, container_id, mbox_id in \
+                inboxes.pointers(user, since, until):
+            if container_since is not None and key <= container_since(container_id):
+                continue
+            if key <= join_keys.get(container_id, config.NULL_KEY):
+                # It's read from the chatroom below
+                continue
+            container = folders[folder_id]._getOb(container_id, None)
+            if container is None or not container._hasPartner(username):
+                continue
+            mbox = container._getOb(mbox_id, None)
+            m = mbox is not None and mbox._getMessage(key) or None
+            if m is None:
+                continue
+            msgs_dicts[folder_id].setdefault(container._getPartnerName(username), []).append(
+                    (m.author, m.text, m.time, m.fullname))
+
+        last_msg_key = inboxes.lastKey(user, until)
+        if last_msg_key is None:
+            last_msg_key = config.NULL_KEY
+
+        if join_keys:
+            chatroom_ids = set(self._getChatRoomIndex(False).get(user))
+        for container_id, join_key in join_keys.items():
+            if container_id not in chatroom_ids:
+                continue
+            start = since
+            if container_since is not None:
+                start = container_since(container_id)
+            end = min(join_key, until)
+            if start >= end and join_key <= until:
+                # There is nothing to read, so we don't load the chatroom
+                last_msg_key = max(last_msg_key, join_key)
+                continue
+            container = folders['chatrooms']._getOb(container_id, None)
+            if container is None:
+                continue
+            msgs = [(m.author, m.text, m.time, m.fullname) 
+                    for key, m in container._iterMessages(start, end)]
+            if msgs:
+                # They precede the ones in the inbox
+                name = container._getPartnerName(username)
+                msgs_dicts['chatrooms'][name] = \
+                        msgs + msgs_dicts['chatrooms'].get(name, [])
+            last_msg_key = max(last_msg_key, container._lastKey(end))
+
+        messages, chatroom_msgs = [
+                dict([(k, tuple(v)) for k, v in msgs_dicts[folder_id].items()])
+                for folder_id in ['conversations', 'chatrooms']]
+        return messages, chatroom_msgs, last_msg_key
+
+
+    def _getRetentionDays(self, container):
+        """ Return the amount of days after which the messages of the
+            conversation or chatroom expire, or None if they don't.
+        """
+        days = getattr(aq_base(container), 'retention_days', None)
+        if days is None:
+            days = self.retention_days
+        if days is None:
+            days = config.RETENTION_DAYS
+        return days
+
+
+    def _pruneMessages(self, now=None, batch_size=None):
+        """ Delete the messages that are older than the retention period of
+            their conversation or chatroom.
+
+            This is a generator that deletes at most 'batch_size' messages at
+            a time and then yields how many it deleted, so that the caller 
+            can commit in between. See Extensions/prune_messages.py
+        """
+        if now is None:
+            now = time.time()
+        if batch_size is None:
+            batch_size = config.PRUNE_BATCH_SIZE
+
+        count = 0
+        inboxes = self.fanout and self._getInboxes() or None
+        for folder in [self._getConversationsFolder(), self._getChatRoomsFolder()]:
+            # The caller commits while we're suspended, so we must not keep
+            # iterating over the folder's BTree, which may change in the
+            # meantime.
+            for id in list(folder.objectIds()):
+                container = folder._getOb(id, None)
+                if container is None:
+                    # It was deleted in the meantime
+                    continue
+                days = self._getRetentionDays(container)
+                if days is None:
+                    continue
+                until = timestamp_to_key(now - days*86400)
+                while True:
+                    pruned = container._pruneMessages(until, batch_size-count)
+                    if inboxes is not None:
+                        users = [hashed(u) for u in container._getPartners()]
+                        for key, mbox_id in pruned:
+                            pointer = (key, folder.getId(), container.id, mbox_id)
+                            for u in users:
+                                inboxes.remove(u, pointer)
+
+                    count += len(pruned)
+                    if count < batch_size:
+                        # There are no more expired messages in this container
+                        break
+                    yield count
+                    count = 0
+        if count:
+            yield count
+
+
+    def _getReadCursors(self, create=True):
+        """ See babble.server.readcursors.py:ReadCursors """
+        return self._getStorage('_read_cursors', ReadCursors, create)
+
+
+    def _clearMessages(self, username, container, until):
+        """ Mark the user's messages in the conversation or chatroom as
+            cleared, up to and including 'until' (an integer message key).
+        """
+        cursors = self._getReadCursors()
+        user = hashed(username)
+        cleared_key, cleared_count = \
+            cursors.get(user, container.id, (config.NULL_KEY, 0))
+        # Compare with the high-water mark, and not with the key of the last
+        # message, which may have been pruned.
+        key = max(cleared_key, min(until, container._highWaterMark()))
+        # A message may have been committed after a later one was cleared
+        # (see container.Sequence). It's then also counted as cleared.
+        count = container._receivedCountUntil(username, key)
+        if (key, count) != (cleared_key, cleared_count):
+            cursors.set(user, container.id, key, count)
+            self._bumpVersions([username])
+
+
+    def _getChangeVersions(self, create=True):
+        """ See babble.server.versions.py:ChangeVersions """
+        return self._getStorage('_change_versions', ChangeVersions, create)
+
+
+    def _getChatRoomVersions(self, create=True):
+        """ The versions of the chatrooms, keyed by chatroom id.
+
+            See babble.server.versions.py:ChangeVersions 
+        """
+        return self._getStorage('_chatroom_versions', ChangeVersions, create)
+
+
+    def _getVersion(self, username):
+        """ Return the version of the user's conversations and chatrooms.
+
+            It combines the user's own version with the sum of the versions
+            of his chatrooms, so that a chatroom message only has to bump
+            the chatroom's version. Joining or leaving a chatroom bumps the
+            user's version, so the same version is never returned twice for
+            different states.
+        """
+        user = hashed(username)
+        chatroom_versions = self._getChatRoomVersions(False)
+        chatrooms = sum([chatroom_versions.get(id) 
+                         for id in self._getChatRoomIndex(False).get(user)])
+        return '%d.%d' % (self._getChangeVersions(False).get(user), chatrooms)
+
+
+    def _bumpVersions(self, usernames):
+        """ Record that something changed in the conversations or chatrooms
+            of the users.
+        """
+        versions = self._getChangeVersions()
+        for username in usernames:
+            versions.bump(hashed(username))
 
 
     def _getChatRooms(self, ids):
-        folder = self._getChatRoomsFolder()
+        folder = self._getChatRoomsFolder(False)
         if type(ids) == str:
             ids= [ids]
         crs = []
@@ -99,30 +596,59 @@ class ChatService(Folder):
 
 
     def _getChatRoom(self, id):
-        folder = self._getChatRoomsFolder()
+        folder = self._getChatRoomsFolder(False)
         return folder._getOb(hashed(id))
 
 
     def _getChatRoomsFor(self, username):
-        folder = self._getChatRoomsFolder()
-        rooms = []
-        for chatroom in folder.values():
-            if username in chatroom.participants:
-                rooms.append(chatroom)
-        return rooms
+        """ Return the chatrooms in which the user is a participant, as
+            registered in the chatroom index.
+        """
+        folder = self._getChatRoomsFolder(False)
+        ids = self._getChatRoomIndex(False).get(hashed(username))
+        return [c for c in [folder._getOb(i, None) for i in ids] if c is not None]
 
 
     def _authenticate(self, username, password):
-        """ Authenticate the user with username and password """
+        """ Authenticate the user with username and password. 
+
+            Instead of the password, a session token as returned by 'login'
+            may be given. It is verified without consulting acl_users.
+        """
+        secret = getattr(aq_base(self), '_token_secret', None)
+        if secret is not None and \
+                verify_token(secret, username, password, time.time(),
+                             self._getTokenGeneration(username)):
+            return username
         return self.acl_users.authenticate(username, password, self.REQUEST)
 
 
-    def _isOnline(self, username, uad):
+    def _getTokenSecret(self):
+        """ The secret with which the session tokens are signed """
+        if getattr(aq_base(self), '_token_secret', None) is None:
+            self._token_secret = os.urandom(32).encode('hex')
+        return self._token_secret
+
+
+    def _getTokenGenerations(self, create=True):
+        """ The generations of the users' session tokens, keyed by hashed
+            username. Increasing a user's generation invalidates his tokens.
+
+            See babble.server.versions.py:ChangeVersions 
+        """
+        return self._getStorage('_token_generations', ChangeVersions, create)
+
+
+    def _getTokenGeneration(self, username):
+        return self._getTokenGenerations(False).get(hashed(username))
+
+
+    def _isOnline(self, username):
         """ Determine whether the user is (probably) currently online
         """
-        last_confirmed_date = uad.get(username, datetime.min)
-        cutoff_date = datetime.now() - timedelta(seconds=60)
-        return last_confirmed_date > cutoff_date
+        last_seen = self._getPresence().lastSeen(username)
+        return last_seen is not None and \
+                last_seen > time.time() - config.PRESENCE_WINDOW
 
 
     def _isRegistered(self, username):
@@ -137,6 +663,9 @@ class ChatService(Folder):
         folder = self._getChatRoomsFolder()
         id = hashed(path)
         folder._setObject(id, ChatRoom(id, path, participants))
+        index = self._getChatRoomIndex()
+        for p in participants:
+            index.index(hashed(p), id)
         return json.dumps({'status': config.SUCCESS})
 
     
@@ -155,8 +684,11 @@ class ChatService(Folder):
                     'status': config.NOT_FOUND, 
                     'errmsg': "Chatroom '%s' doesn't exist" % id, 
                     })
-        if participant not in chatroom.participants:
+        if not chatroom._isParticipant(participant):
             chatroom._addParticipant(participant)
+            self._getChatRoomIndex().index(hashed(participant), chatroom.id)
+            self._fanoutHistory(chatroom, participant)
+            self._bumpVersions([participant])
         return json.dumps({'status': config.SUCCESS})
 
 
@@ -173,10 +705,58 @@ class ChatService(Folder):
                     'errmsg': "Chatroom '%s' doesn't exist" % id, 
                     })
 
-        chatroom.participants = participants
-        chatroom.partner = {}
+        # Only add and remove the participants that changed, to keep the
+        # writes (and possible conflicts) to a minimum.
+        index = self._getChatRoomIndex()
+        participants = set(participants)
+        changed = []
+        for p in list(chatroom._getParticipants()):
+            if p not in participants:
+                chatroom._removeParticipant(p)
+                index.unindex(hashed(p), chatroom.id)
+                changed.append(p)
         for p in participants:
-            chatroom.partner[p] = chatroom.client_path
+            if not chatroom._isParticipant(p):
+                chatroom._addParticipant(p)
+                index.index(hashed(p), chatroom.id)
+                self._fanoutHistory(chatroom, p)
+                changed.append(p)
+        self._bumpVersions(changed)
+        return json.dumps({'status': config.SUCCESS})
+
+
+    def setChatRoomRetention(self, username, password, id, days):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('setChatRoomRetention: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+        try:
+            chatroom = self._getChatRoom(id)
+        except KeyError:
+            return json.dumps({
+                    'status': config.NOT_FOUND, 
+                    'errmsg': "Chatroom '%s' doesn't exist" % id, 
+                    })
+
+        try:
+            chatroom.retention_days = parse_days(days)
+        except ValueError:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Invalid amount of days', 
+                    })
+        return json.dumps({'status': config.SUCCESS})
+
+
+    def setRetention(self, days):
+        """ See interfaces.IChatService """
+        try:
+            self.retention_days = parse_days(days)
+        except ValueError:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Invalid amount of days', 
+                    })
         return json.dumps({'status': config.SUCCESS})
 
 
@@ -190,10 +770,39 @@ class ChatService(Folder):
         hid = hashed(id)
         if hid not in parent.keys():
             return json.dumps({'status': config.NOT_FOUND})
+
+        index = self._getChatRoomIndex()
+        cursors = self._getReadCursors(False)
+        join_keys = self._getJoinKeys(False)
+        participants = list(parent._getOb(hid)._getParticipants())
+        for p in participants:
+            index.unindex(hashed(p), hid)
+            # A chatroom that is created again at the same path must not
+            # inherit the read cursors or join keys.
+            cursors.remove(hashed(p), hid)
+            join_keys.remove(hashed(p), hid)
+        self._getChatRoomVersions(False).delete(hid)
+        self._bumpVersions(participants)
         parent.manage_delObjects([hid])
         return json.dumps({'status': config.SUCCESS})
 
 
+    def login(self, username, password):
+        """ See interfaces.IChatService """
+        if self.acl_users.authenticate(username, password, self.REQUEST) is None:
+            log.warn('login: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        expires = time.time() + config.TOKEN_LIFETIME
+        token = create_token(self._getTokenSecret(), username, expires, 
+                             self._getTokenGeneration(username))
+        return json.dumps({
+                'status': config.SUCCESS,
+                'token': token,
+                'expires': key_to_date(timestamp_to_key(int(expires))),
+                })
+
+
     def confirmAsOnline(self, username):
         """ See interfaces.IChatService """
         if username is None:
@@ -202,19 +811,18 @@ class ChatService(Folder):
                             'errmsg': 'Username may not be None',
                             })
 
-        self._setUserAccessDict(username)
+        self._setOnline(username)
         return json.dumps({'status': config.SUCCESS})
 
 
     def register(self, username, password):
         """ See interfaces.IChatService """
-        user = self.acl_users.userFolderAddUser(
+        self.acl_users.userFolderAddUser(
                                     username, 
                                     password, 
                                     roles=(), 
                                     domains=(), 
                                     last_msg_date=config.NULL_DATE )
-        user.last_cleared_date = config.NULL_DATE
         return json.dumps({'status': config.SUCCESS})
 
 
@@ -225,18 +833,28 @@ class ChatService(Folder):
                     'is_registered': self._isRegistered(username)})
 
 
+    def unregister(self, username):
+        """ See interfaces.IChatService """
+        if not self._isRegistered(username):
+            return json.dumps({'status': config.NOT_FOUND})
+        self.acl_users.userFolderDelUsers([username])
+        self._getTokenGenerations().bump(hashed(username))
+        return json.dumps({'status': config.SUCCESS})
+
+
     def setUserPassword(self, username, password):
         """ See interfaces.IChatService """
         self.acl_users.userFolderEditUser(
                 username, password, roles=(), domains=())
+        # Sessions must log in again with the new password
+        self._getTokenGenerations().bump(hashed(username))
         return json.dumps({'status': config.SUCCESS})
 
 
     def getOnlineUsers(self):
         """ See interfaces.IChatService """
-        uad = self._getUserAccessDict()
-        ou = [user for user in uad.keys() if self._isOnline(user, uad)]
-        return json.dumps({'status': config.SUCCESS, 'online_users': ou})
+        ou = self._getPresence().users(time.time() - config.PRESENCE_WINDOW)
+        return json.dumps({'status': config.SUCCESS, 'online_users': sorted(ou)})
 
 
     def sendMessage(self, username, password, fullname, recipient, message):
@@ -248,10 +866,84 @@ class ChatService(Folder):
                     'last_msg_date': config.NULL_DATE
                     })
 
+        msg = self._sendMessage(username, fullname, recipient, message)
+        notify_after_commit([username, recipient])
+        return json.dumps({
+                'status': config.SUCCESS, 
+                'last_msg_date': msg.time
+                })
+
+
+    def _sendMessage(self, username, fullname, recipient, message):
+        """ Add the message to the conversation between the user and the
+            recipient, and return it.
+
+            This is an internal method that assumes authentication has 
+            been done.
+        """
         conversation = self._getConversation(username, recipient)
-        last_msg_date = conversation.addMessage(message, username, fullname).time
+        msg = conversation.addMessage(message, username, fullname)
+        self._fanoutMessage(self._getConversationsFolder(), conversation, msg, 
+                            [username, recipient])
+        self._bumpVersions(set([username, recipient]))
+        return msg
+
+
+    def sendMessages(self, username, password, fullname, recipients, messages):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('sendMessages: authentication failed')
+            return json.dumps({
+                    'status': config.AUTH_FAIL, 
+                    'last_msg_date': config.NULL_DATE
+                    })
+
+        if isinstance(recipients, basestring):
+            recipients = [recipients]
+        if isinstance(messages, basestring):
+            messages = [messages]
+        if not isinstance(recipients, (list, tuple)) or not recipients:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Invalid recipients'
+                    })
+        if not isinstance(messages, (list, tuple)) or not messages or \
+                [m for m in messages if not isinstance(m, basestring)]:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Invalid messages'
+                    })
+        if len(recipients) * len(messages) > config.MAX_BATCH_SIZE:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Too many messages, the maximum is %d' \
+                                % config.MAX_BATCH_SIZE
+                    })
+
+        results = []
+        last_msg_date = config.NULL_DATE
+        for recipient in recipients:
+            if not recipient or not isinstance(recipient, basestring):
+                results.append({
+                        'recipient': recipient,
+                        'status': config.ERROR,
+                        'errmsg': 'Invalid recipient',
+                        })
+                continue
+            for message in messages:
+                msg = self._sendMessage(username, fullname, recipient, message)
+                last_msg_date = msg.time
+                results.append({
+                        'recipient': recipient,
+                        'status': config.SUCCESS, 
+                        'last_msg_date': msg.time
+                        })
+
+        notify_after_commit([username] + [r['recipient'] for r in results 
+                                          if r['status'] == config.SUCCESS])
         return json.dumps({
                 'status': config.SUCCESS, 
+                'results': results,
                 'last_msg_date': last_msg_date
                 })
 
@@ -272,111 +964,450 @@ class ChatService(Folder):
                     'errmsg': "Chatroom '%s' doesn't exist" % room_name, 
                     })
 
-        last_msg_date = chatroom.addMessage(message, username, fullname).time
+        msg = chatroom.addMessage(message, username, fullname)
+        self._fanoutMessage(self._getChatRoomsFolder(), chatroom, msg, 
+                            chatroom._getParticipants())
+        self._getChatRoomVersions().bump(chatroom.id)
+        notify_after_commit(chatroom._getParticipants())
         return json.dumps({
                 'status': config.SUCCESS, 
-                'last_msg_date': last_msg_date
+                'last_msg_date': msg.time
                 })
 
 
-    def _getMessagesFromContainers(self, containers, username, since, until):
+    def setStatus(self, username, password, status):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('setStatus: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        if status not in config.USER_STATUS:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': "Invalid status '%s'" % status, 
+                    })
+
+        recipients = set()
+        conversations, chatrooms = self._getContainers(username, '*', '*')
+        for container in conversations + chatrooms:
+            recipients.update(container._getPartners())
+        recipients.discard(username)
+
+        self._publishEvent(recipients, {
+                'sender': username,
+                'type': 'status',
+                'value': status,
+                'chatroom': None,
+                }, config.STATUS_TTL)
+        return json.dumps({'status': config.SUCCESS})
+
+
+    def setTyping(self, username, password, partner, chatroom, typing):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('setTyping: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        if partner:
+            recipients = [partner]
+            chatroom = None
+        elif chatroom:
+            try:
+                room = self._getChatRoom(chatroom)
+            except KeyError:
+                return json.dumps({
+                        'status': config.NOT_FOUND, 
+                        'errmsg': "Chatroom '%s' doesn't exist" % chatroom, 
+                        })
+            if not room._isParticipant(username):
+                return json.dumps({'status': config.AUTH_FAIL})
+            recipients = [p for p in room._getParticipants() if p != username]
+        else:
+            return json.dumps({
+                    'status': config.ERROR, 
+                    'errmsg': 'Either a partner or a chatroom is required', 
+                    })
+
+        # When the user stops typing, the event expires right away, which
+        # removes the previous one.
+        self._publishEvent(recipients, {
+                'sender': username,
+                'type': 'typing',
+                'value': bool(typing),
+                'chatroom': chatroom,
+                }, typing and config.TYPING_TTL or 0)
+        return json.dumps({'status': config.SUCCESS})
+
+
+    def _getMessagesFromContainers(self, containers, username, since, until, 
+                                   limit=None, newest_first=False, read_until=None):
         """ Generic conversation-type agnostic method that fetches messages.
+
+            since and until are integer message keys (see utils.date_to_key).
+            since may also be a function that returns the key for a given
+            container id. If limit is given, at most that many of the oldest (or, with 
+            newest_first, the newest) messages are returned per container.
+
+            If 'read_until' is a list, (container, key) tuples are appended
+            to it for the containers of which all the messages up to 'key'
+            were returned.
+
+            Returns the messages, the key of the latest message that was
+            sent up to 'until' and whether any container had more messages
+            than the limit.
         """
-        last_msg_date = config.NULL_DATE
+        last_msg_key = config.NULL_KEY
+        more = False
         msgs_dict = {}
         for container in containers:
-            if not container.partner.has_key(username):
+            if not container._hasPartner(username):
                 log.warn(u"The container '%s' doesn't have '%s' as a partner. "
                          u"This shouldn't happen!" % (container.id, username))
                 continue
 
-            msg_tuples = []
-            mbox_messages = []
-            for mbox in container.values():
-                for i in mbox.objectIds():
-                    i = float(i)
-                    mdate = datetime.utcfromtimestamp(i).replace(tzinfo=utc).isoformat()
-
-                    if mdate > until:
-                        continue
+            if callable(since):
+                container_since = since(container.id)
+            else:
+                container_since = since
+
+            # Skip the containers in which nothing was posted since 
+            # 'since', without loading their MessageBoxes.
+            high_water_mark = container._highWaterMark()
+            if high_water_mark <= container_since and high_water_mark <= until:
+                last_msg_key = max(last_msg_key, high_water_mark)
+                metrics.count('containers_skipped')
+                if read_until is not None:
+                    read_until.append((container, until))
+                continue
 
-                    if mdate > last_msg_date:
-                        # We want the latest date that's smaller than 'until'
-                        last_msg_date = mdate
+            # We want the latest date that's smaller than 'until'
+            last_msg_key = max(last_msg_key, container._lastKey(until))
+
+            mbox_messages, key, truncated = self._getContainerPage(
+                            container, container_since, until, limit, newest_first)
+            more = more or truncated
+            if read_until is not None:
+                if not truncated:
+                    read_until.append((container, until))
+                elif not newest_first:
+                    read_until.append((container, key))
+            if mbox_messages:
+                msgs_dict[container._getPartnerName(username)] = mbox_messages
 
-                    if mdate <= since:
-                        continue
+        return msgs_dict, last_msg_key, more
 
-                    m = mbox._getOb('%f' % i)
-                    msg_tuples.append((i, m))
-            
-            msg_tuples.sort()
-            for i, m in msg_tuples:
-                try:
-                    mbox_messages.append((m.author, m.text, m.time, m.fullname))
-                except AttributeError as e:
-                    # BBB
-                    if str(e) == 'fullname':
-                        mbox_messages.append((m.author, m.text, m.time, m.author))
-                    else:
-                        raise AttributeError, e
 
-            if mbox_messages:
-                msgs_dict[container.partner[username]] = tuple(mbox_messages)
+    def _getContainerPage(self, container, since, until, limit, newest_first=False):
+        """ Return at most 'limit' (if not None) messages of a conversation
+            or chatroom between 'since' and 'until', the oldest (or with 
+            newest_first, the newest) first.
 
-        return msgs_dict, last_msg_date
+            Returns the messages, the key of the last message on the page
+            (or None) and whether there are more messages beyond it.
+        """
+        if limit is None:
+            items = list(container._iterMessages(since, until, None, newest_first))
+            more = False
+        else:
+            items = list(container._iterMessages(since, until, limit+1, newest_first))
+            more = len(items) > limit
+            items = items[:limit]
+        last_key = items and items[-1][0] or None
+        metrics.count('containers_scanned')
+        return self._formatMessages(items), last_key, more
 
 
-    def _getMessages(self, username, partner, chatrooms, since, until): 
-        """ Returns messages within a certain date range
+    def _getUnseenMessages(self, container, since, until, seen, limit):
+        """ Return at most 'limit' (if not None) messages of a conversation
+            or chatroom between 'since' and 'until', the oldest first, 
+            skipping the ones in 'seen' (a set of (key, author) tuples).
 
-            This is an internal method that assumes authentication has 
-            been done.
-        """ 
-        if since is None:
-            since = config.NULL_DATE
-        elif not config.VALID_DATE_REGEX.search(since):
-            return {'status': config.ERROR, 
-                    'errmsg': 'Invalid date format',}
+            Returns the messages, (key, author) tuples for them and whether
+            there are more messages beyond them.
+        """
+        items = []
+        more = False
+        for key, m in container._iterMessages(since, until):
+            if (key, m.author) in seen:
+                continue
+            if limit is not None and len(items) >= limit:
+                more = True
+                break
+            items.append((key, m))
+        metrics.count('containers_scanned')
+        return self._formatMessages(items), [(k, m.author) for k, m in items], more
 
-        if until is None:
-            until = datetime.now(utc).isoformat()
-        elif not config.VALID_DATE_REGEX.search(until):
-            return {'status': config.ERROR, 
-                    'errmsg': 'Invalid date format',}
 
+    def _formatMessages(self, items):
+        """ Turn (key, message) tuples into a tuple of 
+            (author, text, time, fullname) tuples.
+        """
+        mbox_messages = []
+        for i, m in items:
+            try:
+                mbox_messages.append((m.author, m.text, m.time, m.fullname))
+            except AttributeError as e:
+                # BBB
+                if str(e) == 'fullname':
+                    mbox_messages.append((m.author, m.text, m.time, m.author))
+                else:
+                    raise AttributeError, e
+        metrics.count('messages_scanned', len(mbox_messages))
+        return tuple(mbox_messages)
+
+
+    def _getContainers(self, username, partner, chatrooms):
+        """ Return the conversations and chatrooms specified by 'partner'
+            and 'chatrooms' (see IChatService.getMessages).
+
+            A conversation with the partner is only created when the first 
+            message is sent, so that reading never writes to the ZODB.
+            Like a falsy 'partner', a falsy 'chatrooms' selects none.
+
+            Raises a KeyError if one of the chatrooms doesn't exist.
+        """
+        conversations = []
         if partner == '*':
             conversations = self._getConversationsFor(username)
         elif partner:
-            conversations = [self._getConversation(username, partner)]
-        else:
-            conversations = []
+            conversation = self._getConversation(username, partner, False)
+            if conversation is not None:
+                conversations = [conversation]
 
         if chatrooms == '*':
             chatrooms = self._getChatRoomsFor(username)
+        elif chatrooms:
+            chatrooms = self._getChatRooms(chatrooms)
         else:
-            try:
-                chatrooms = self._getChatRooms(chatrooms)
-            except KeyError, e:
+            chatrooms = []
+
+        return conversations, chatrooms
+
+
+    def _dateToKey(self, date):
+        """ Convert an iso8601 date string, as given by a client, to an
+            integer message key. Returns None if the date is invalid.
+        """
+        if not config.VALID_DATE_REGEX.search(date):
+            return None
+        try:
+            return date_to_key(date)
+        except ValueError:
+            # A well-formed, but impossible date, e.g. in the 13th month
+            return None
+
+
+    def _getMessages(self, username, partner, chatrooms, since, until, 
+                     limit=None, newest_first=False, uncleared=False, 
+                     read_until=None): 
+        """ Returns messages within a certain date range
+
+            If 'uncleared' is True, 'since' is ignored and the messages that
+            the user hasn't cleared yet are returned instead (see
+            readcursors.py).
+
+            read_until: see _getMessagesFromContainers
+
+            This is an internal method that assumes authentication has 
+            been done.
+        """ 
+        if limit is not None:
+            limit = parse_limit(limit)
+            if limit is None:
                 return {'status': config.ERROR, 
-                        'errmsg': "Chatroom %s doesn't exist" % e,}
+                        'errmsg': 'Invalid limit',}
+
+        if uncleared:
+            cursors = self._getReadCursors(False).getAll(hashed(username))
+            since = lambda container_id: \
+                cursors.get(container_id, (config.NULL_KEY, 0))[0]
+        elif since is None:
+            since = config.NULL_KEY
+        else:
+            since = self._dateToKey(since)
+            if since is None:
+                return {'status': config.ERROR, 
+                        'errmsg': 'Invalid date format',}
+
+        if until is None:
+            until = timestamp_to_key(time.time())
+        else:
+            until = self._dateToKey(until)
+            if until is None:
+                return {'status': config.ERROR, 
+                        'errmsg': 'Invalid date format',}
+
+        if self.fanout and self._inboxes_complete \
+                and partner == '*' and chatrooms == '*' \
+                and limit is None and not newest_first:
+            messages, chatroom_msgs, last_msg_key = \
+                self._getMessagesFromInbox(username, since, until)
+            if read_until is not None:
+                for containers in self._getContainers(username, '*', '*'):
+                    read_until.extend([(c, until) for c in containers])
+            return {'status': config.SUCCESS, 
+                    'messages': messages,
+                    'chatroom_messages': chatroom_msgs,
+                    'last_msg_date': key_to_date(last_msg_key) }
 
-        messages, last_msg_date = \
-            self._getMessagesFromContainers(conversations, username, since, until)
+        try:
+            conversations, chatrooms = \
+                self._getContainers(username, partner, chatrooms)
+        except KeyError, e:
+            return {'status': config.ERROR, 
+                    'errmsg': "Chatroom %s doesn't exist" % e,}
 
-        chatroom_msgs, last_chat_date = \
-            self._getMessagesFromContainers(chatrooms, username, since, until)
+        messages, last_msg_key, more = self._getMessagesFromContainers(
+                conversations, username, since, until, limit, newest_first,
+                read_until)
 
-        if last_chat_date > last_msg_date:
-            last_msg_date = last_chat_date
+        chatroom_msgs, last_chat_key, chat_more = self._getMessagesFromContainers(
+                chatrooms, username, since, until, limit, newest_first, 
+                read_until)
+
+        if last_chat_key > last_msg_key:
+            last_msg_key = last_chat_key
                 
-        return {'status': config.SUCCESS, 
+        result = {'status': config.SUCCESS, 
                 'messages': messages,
                 'chatroom_messages': chatroom_msgs,
-                'last_msg_date':last_msg_date }
+                'last_msg_date': key_to_date(last_msg_key) }
+        if limit is not None:
+            result['more'] = more or chat_more
+        return result
+
 
+    def _getMessagesByCursor(self, username, partner, chatrooms, cursor,
+                             limit=None, newest_first=False):
+        """ Returns the messages sent after the positions in 'cursor'.
 
-    def getMessages(self, username, password, partner, chatrooms, since, until):
+            The cursor stores, per conversation and chatroom, the key of the
+            last message that was returned. Keys aren't handed out in commit
+            order (see container.Sequence), so the messages of the last 
+            config.COMMIT_WINDOW seconds before it are looked at again, and
+            the cursor also stores which of those were already returned. No
+            messages are therefore missed or returned twice.
+
+            With newest_first, the cursor instead stores the key of the 
+            oldest message that was returned, and the messages sent before
+            it are returned, newest first, to page back through the history.
+
+            This is an internal method that assumes authentication has 
+            been done.
+        """
+        try:
+            positions = decode_cursor(cursor)
+        except ValueError:
+            return {'status': config.ERROR, 
+                    'errmsg': 'Invalid cursor',}
+
+        if limit is not None:
+            limit = parse_limit(limit)
+            if limit is None:
+                return {'status': config.ERROR, 
+                        'errmsg': 'Invalid limit',}
+
+        try:
+            conversations, chatrooms = \
+                self._getContainers(username, partner, chatrooms)
+        except KeyError, e:
+            return {'status': config.ERROR, 
+                    'errmsg': "Chatroom %s doesn't exist" % e,}
+
+        now = timestamp_to_key(time.time())
+        window = config.COMMIT_WINDOW * 1000000
+        next_positions = {}
+        last_msg_key = config.NULL_KEY
+        more = False
+        result = {'status': config.SUCCESS}
+        for name, containers in [('messages', conversations), 
+                                 ('chatroom_messages', chatrooms)]:
+            msgs_dict = {}
+            for container in containers:
+                if not container._hasPartner(username):
+                    log.warn(u"The container '%s' doesn't have '%s' as a partner. "
+                             u"This shouldn't happen!" % (container.id, username))
+                    continue
+
+                if newest_first:
+                    last_msg_key = max(last_msg_key, 
+                                       container._lastKey(config.MAX_KEY))
+                    before = positions.get(container.id, (config.MAX_KEY + 1,))[0]
+                    msgs, key, truncated = self._getContainerPage(
+                            container, config.NULL_KEY, before-1, limit, True)
+                    # Once a container is exhausted, we stay at its start
+                    next_positions[container.id] = \
+                        (truncated and key or config.NULL_KEY + 1, ())
+                    more = more or truncated
+                    if msgs:
+                        msgs_dict[container._getPartnerName(username)] = msgs
+                    continue
+
+                position, seen = positions.get(container.id, (config.NULL_KEY, ()))
+                # Only while there are recently returned messages, a message
+                # may still be committed before the position.
+                since = seen and position - window or position
+                # No message was posted after the high-water mark, so we
+                # don't need to look at the MessageBoxes to find the last one
+                last_key = max(position, container._highWaterMark())
+                last_msg_key = max(last_msg_key, last_key)
+
+                returned = []
+                if last_key > since:
+                    msgs, returned, truncated = self._getUnseenMessages(
+                                        container, since, last_key, seen, limit)
+                    if truncated:
+                        last_key = max(position, returned[-1][0])
+                        more = True
+                    if msgs:
+                        msgs_dict[container._getPartnerName(username)] = msgs
+
+                if last_key > now - window:
+                    seen = [(k, a) for k, a in list(seen) + returned 
+                            if k > last_key - window]
+                else:
+                    seen = ()
+                if last_key > config.NULL_KEY:
+                    next_positions[container.id] = (last_key, seen)
+            result[name] = msgs_dict
+
+        result['last_msg_date'] = key_to_date(last_msg_key)
+        result['next_cursor'] = encode_cursor(next_positions)
+        if limit is not None:
+            result['more'] = more
+        return result
+
+
+    def getMessagesByCursor(self, username, password, partner, chatrooms, cursor,
+                            limit=None, newest_first=False):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('getMessagesByCursor: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        return json.dumps(self._getMessagesByCursor(
+                                        username, 
+                                        partner, 
+                                        chatrooms, 
+                                        cursor,
+                                        limit,
+                                        newest_first))
+
+
+    def getNewMessagesByCursor(self, username, password, cursor):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('getNewMessagesByCursor: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        result = self._getMessagesByCursor(username, '*', '*', cursor)
+        if result['status'] == config.SUCCESS:
+            result['events'] = self._getEvents(username)
+        return json.dumps(result)
+
+
+    def getMessages(self, username, password, partner, chatrooms, since, until,
+                    limit=None, newest_first=False):
         """ See interfaces.IChatService """
         if self._authenticate(username, password) is None:
             log.warn('getMessages: authentication failed')
@@ -386,41 +1417,215 @@ class ChatService(Folder):
                                         username, 
                                         partner, 
                                         chatrooms, 
-                                        since, until))
+                                        since, until,
+                                        limit, newest_first))
 
 
-    def getNewMessages(self, username, password, since):
+    def getNewMessages(self, username, password, since, version=None):
         """ See interfaces.IChatService """
         if self._authenticate(username, password) is None:
             log.warn('getNewMessages: authentication failed')
             return json.dumps({'status': config.AUTH_FAIL})
 
-        if since == config.NULL_DATE:
-            user = self.acl_users.getUser(username)
-            since = user.last_cleared_date
-
-        user = self.acl_users.getUser(username)
-        result = self._getMessages(username, '*', '*', since, None)
+        current = self._getVersion(username)
+        if version is not None and str(version) == str(current):
+            return json.dumps({'status': config.NOT_MODIFIED, 
+                               'version': current,
+                               'events': self._getEvents(username)})
+
+        result = self._getMessages(username, '*', '*', since, None, 
+                                   uncleared=(since == config.NULL_DATE))
+        if result['status'] == config.SUCCESS:
+            result['version'] = current
+            result['events'] = self._getEvents(username)
         return json.dumps(result)
 
 
-    def getUnclearedMessages(self, username, password, partner, chatrooms, until, clear):
+    def waitForNewMessages(self, username, password, since, timeout):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('waitForNewMessages: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        if timeout is None:
+            timeout = config.MAX_WAIT_TIMEOUT
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            return json.dumps({'status': config.ERROR, 
+                               'errmsg': 'Invalid timeout',})
+        if timeout != timeout:
+            # NaN
+            return json.dumps({'status': config.ERROR, 
+                               'errmsg': 'Invalid timeout',})
+        timeout = min(max(timeout, 0), config.MAX_WAIT_TIMEOUT)
+
+        uncleared = (since == config.NULL_DATE)
+        deadline = time.time() + timeout
+        events = self._getEvents(username)
+        result = None
+        while True:
+            # Get the version before looking for messages, so that we don't
+            # miss a notification that arrives in between. Unless we wait,
+            # the interest it registers must be released again.
+            version = notifier.version(username)
+            waiting = False
+            try:
+                # As long as nothing changed in the user's conversations and
+                # chatrooms, there is no need to look for messages again.
+                current = self._getVersion(username)
+                if result is None or result['version'] != current:
+                    result = self._getMessages(username, '*', '*', since, None, 
+                                               uncleared=uncleared)
+                    if result['status'] != config.SUCCESS:
+                        return json.dumps(result)
+                    result['version'] = current
+                    if result['messages'] or result['chatroom_messages']:
+                        result['events'] = self._getEvents(username)
+                        return json.dumps(result)
+
+                # A change of the events, e.g. a user that starts typing, 
+                # also ends the wait.
+                result['events'] = self._getEvents(username)
+                if result['events'] != events:
+                    return json.dumps(result)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    result['status'] = config.TIMEOUT
+                    return json.dumps(result)
+
+                # We wake up regularly, to also find messages that were sent
+                # via other ZEO clients, which don't notify us.
+                waiting = True
+                notifier.wait(username, version, 
+                              min(remaining, config.WAIT_INTERVAL))
+            finally:
+                if not waiting:
+                    notifier.release(username)
+            # Abort the (read-only) transaction, so that we see the changes
+            # committed in the meantime.
+            transaction.abort()
+
+
+    def getUnclearedMessages(self, username, password, partner, chatrooms, until, clear,
+                             limit=None, newest_first=False):
         """ See interfaces.IChatService """
         if self._authenticate(username, password) is None:
             log.warn('getUnclearedMessages: authentication failed')
             return json.dumps({'status': config.AUTH_FAIL})
 
-        user = self.acl_users.getUser(username)
-        if not hasattr(user, 'last_cleared_date'):
-            user.last_cleared_date = config.NULL_DATE
+        read_until = []
+        result = self._getMessages(username, partner, chatrooms, None, until,
+                                   limit, newest_first, uncleared=True, 
+                                   read_until=read_until)
+        if clear and result['status'] == config.SUCCESS:
+            # Only clear the messages that were returned
+            for container, key in read_until:
+                self._clearMessages(username, container, key)
+
+        return json.dumps(result)
 
-        since = user.last_cleared_date
-        result = self._getMessages(username, partner, chatrooms, since, until)
-        if clear:
-            user.last_cleared_date = result['last_msg_date']
 
+    def getUnreadCounts(self, username, password):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('getUnreadCounts: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        result = {'status': config.SUCCESS}
+        conversations, chatrooms = self._getContainers(username, '*', '*')
+        for name, containers in [('messages', conversations), 
+                                 ('chatroom_messages', chatrooms)]:
+            counts = {}
+            cursors = self._getReadCursors(False).getAll(hashed(username))
+            for container in containers:
+                cleared_key, cleared_count = \
+                    cursors.get(container.id, (config.NULL_KEY, 0))
+                count = container._unreadCount(username, cleared_count)
+                if count:
+                    counts[container._getPartnerName(username)] = count
+            result[name] = counts
         return json.dumps(result)
 
 
+    def sync(self, username, password, cursor, clear=False, online_cursor=None):
+        """ See interfaces.IChatService """
+        if self._authenticate(username, password) is None:
+            log.warn('sync: authentication failed')
+            return json.dumps({'status': config.AUTH_FAIL})
+
+        since = None
+        if online_cursor:
+            try:
+                since = float(online_cursor)
+            except (TypeError, ValueError):
+                return json.dumps({'status': config.ERROR, 
+                                   'errmsg': 'Invalid online cursor',})
+
+        self._setOnline(username)
+        history = None
+        if not cursor:
+            # Start at the newest messages, instead of returning the whole
+            # history at once
+            positions, history = {}, {}
+            for containers in self._getContainers(username, '*', '*'):
+                for container in containers:
+                    keys = [k for k, m in container._iterMessages(
+                                    config.NULL_KEY, config.MAX_KEY, 
+                                    config.SYNC_HISTORY+1, True)]
+                    if len(keys) > config.SYNC_HISTORY:
+                        positions[container.id] = (keys[-1], ())
+                        history[container.id] = (keys[-2], ())
+                    else:
+                        history[container.id] = (config.NULL_KEY + 1, ())
+            cursor = encode_cursor(positions)
+
+        result = self._getMessagesByCursor(username, '*', '*', cursor)
+        if result['status'] != config.SUCCESS:
+            return json.dumps(result)
+        if history is not None:
+            result['history_cursor'] = encode_cursor(history)
+
+        if clear:
+            # Clear the messages up to the ones that were just returned
+            positions = decode_cursor(result['next_cursor'])
+            for containers in self._getContainers(username, '*', '*'):
+                for container in containers:
+                    if container.id in positions:
+                        self._clearMessages(username, container, 
+                                            positions[container.id][0])
+
+        backend = self._getPresence()
+        changes = since is not None and backend.changes(since) or None
+        if changes is None:
+            now = time.time()
+            result['came_online'] = sorted(
+                        backend.users(now - config.PRESENCE_WINDOW))
+            result['went_offline'] = []
+            result['online_reset'] = True
+        else:
+            now, result['came_online'], result['went_offline'] = changes
+            result['online_reset'] = False
+        result['online_cursor'] = '%.6f' % now
+        result['events'] = self._getEvents(username)
+        return json.dumps(result)
+
+
+    def getStats(self):
+        """ See interfaces.IChatService """
+        response = getattr(self, 'REQUEST', None) is not None and \
+                        self.REQUEST.RESPONSE or None
+        if response is not None:
+            response.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.render()
+
+
+# Record the calls of the public methods and of the internal hot paths in
+# the metrics (see getStats).
+for name in [n for n in IChatService.names() if n != 'getStats'] + \
+        ['_authenticate', '_getMessagesFromContainers', '_getConversationsFor']:
+    setattr(ChatService, name, instrumented(getattr(ChatService, name).im_func))
+
 InitializeClass(ChatService)
 
@@ -1 +0,0 @@
-# stress tests
@@ -0,0 +1,324 @@
+""" A reproducible benchmark of the chat service.
+
+    Populates a chat service with users, conversations and chatrooms, and
+    then lets a number of threads call the IChatService methods like
+    clients would. For every method it reports the throughput, the latency
+    percentiles, the rate of ConflictErrors and the amount of objects
+    loaded from the ZODB per call.
+
+    Run it with the Python of a Zope2 instance (e.g. bin/zopepy):
+
+        python -m babble.server.tests.benchmark --users 100 --threads 8
+
+    By default a DemoStorage is used. Pass --filestorage to benchmark
+    against a FileStorage, and --output to write the results as JSON, so
+    that they can be compared between releases.
+"""
+import optparse
+import random
+import sys
+import threading
+import time
+import transaction
+import simplejson as json
+
+from Testing import makerequest
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+from OFS.Application import Application
+
+from babble.server.service import ChatService
+from babble.server import config
+
+# The relative frequency with which the clients call the methods
+WEIGHTS = [
+    ('getNewMessages', 40),
+    ('confirmAsOnline', 15),
+    ('getOnlineUsers', 10),
+    ('sendMessage', 10),
+    ('sendChatRoomMessage', 5),
+    ('getUnreadCounts', 5),
+    ('getUnclearedMessages', 10),
+    ('getMessages', 5),
+    ('sync', 10),
+    ]
+
+PASSWORD = 'secret'
+# Like the Zope publisher, retry a call up to 3 times after a ConflictError
+RETRIES = 3
+
+
+def ms(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1000, 3)
+
+
+def percentile(values, p):
+    """ Return the p-th percentile (nearest rank) of the sorted values """
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * len(values) + 0.5))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Stats(object):
+    """ The measurements of one method """
+
+    def __init__(self):
+        self.latencies = []
+        self.conflicts = 0
+        self.errors = 0
+        self.loads = 0
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        return {
+            'calls': calls,
+            'throughput': round(calls / elapsed, 2),
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p95_ms': ms(percentile(latencies, 95)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(latencies and latencies[-1] or None),
+            'conflicts': self.conflicts,
+            'conflict_rate': calls and round(float(self.conflicts) / calls, 4) or 0,
+            'errors': self.errors,
+            'loads_per_call': calls and round(float(self.loads) / calls, 2) or 0,
+            }
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.users = ['user%d' % i for i in range(options.users)]
+        self.rooms = ['/benchmark/chatrooms/room%d' % i for i in range(options.rooms)]
+        self.random = random.Random(options.seed)
+        self.stats = {}
+        self.lock = threading.Lock()
+        if options.filestorage:
+            storage = FileStorage(options.filestorage)
+        else:
+            storage = DemoStorage()
+        self.db = DB(storage)
+
+
+    def open(self):
+        conn = self.db.open()
+        app = makerequest.makerequest(conn.root()['Application'])
+        return conn, app.chatservice
+
+
+    def populate(self):
+        """ Create the chat service, its users, chatrooms and conversations """
+        conn = self.db.open()
+        root = conn.root()
+        if 'Application' not in root:
+            root['Application'] = Application()
+            transaction.commit()
+        app = root['Application']
+        if 'chatservice' in app.objectIds():
+            app._delObject('chatservice')
+        app._setObject('chatservice', ChatService('chatservice'))
+        transaction.commit()
+        conn.close()
+
+        conn, service = self.open()
+        for user in self.users:
+            service.register(user, PASSWORD)
+        transaction.commit()
+
+        rnd = self.random
+        size = min(self.options.room_size, len(self.users))
+        self.participants = {}
+        for path in self.rooms:
+            participants = rnd.sample(self.users, size)
+            self.participants[path] = participants
+            service.createChatRoom(participants[0], PASSWORD, path, participants)
+            for i in range(self.options.room_messages):
+                user = rnd.choice(participants)
+                service.sendChatRoomMessage(user, PASSWORD, user, path, 'message %d' % i)
+            transaction.commit()
+
+        for user in self.users:
+            for partner in rnd.sample(self.users, min(self.options.partners, len(self.users))):
+                if partner == user:
+                    continue
+                for i in range(self.options.conversation_size):
+                    sender, recipient = rnd.choice([(user, partner), (partner, user)])
+                    service.sendMessage(sender, PASSWORD, sender, recipient, 'message %d' % i)
+            transaction.commit()
+        conn.close()
+
+
+    def call(self, service, method, rnd):
+        """ Call the method with plausible arguments """
+        user = rnd.choice(self.users)
+        if method == 'getNewMessages':
+            return service.getNewMessages(user, PASSWORD, config.NULL_DATE)
+        elif method == 'confirmAsOnline':
+            return service.confirmAsOnline(user)
+        elif method == 'getOnlineUsers':
+            return service.getOnlineUsers()
+        elif method == 'sendMessage':
+            return service.sendMessage(user, PASSWORD, user, rnd.choice(self.users), 'hello')
+        elif method == 'sendChatRoomMessage':
+            if not self.rooms:
+                return service.sendMessage(user, PASSWORD, user, rnd.choice(self.users), 'hello')
+            path = rnd.choice(self.rooms)
+            user = rnd.choice(self.participants[path])
+            return service.sendChatRoomMessage(user, PASSWORD, user, path, 'hello')
+        elif method == 'getUnreadCounts':
+            return service.getUnreadCounts(user, PASSWORD)
+        elif method == 'getUnclearedMessages':
+            return service.getUnclearedMessages(user, PASSWORD, '*', '*', None, True)
+        elif method == 'getMessages':
+            return service.getMessages(user, PASSWORD, rnd.choice(self.users), None, None, None)
+        elif method == 'sync':
+            return service.sync(user, PASSWORD, None, False, None)
+        raise ValueError(method)
+
+
+    def worker(self, number):
+        rnd = random.Random('%s-%d' % (self.options.seed, number))
+        choices = []
+        for method, weight in WEIGHTS:
+            choices.extend([method] * weight)
+
+        stats = {}
+        conn, service = self.open()
+        try:
+            for i in range(self.options.calls):
+                method = rnd.choice(choices)
+                s = stats.setdefault(method, Stats())
+                conn.getTransferCounts(True)
+                start = time.time()
+                result = None
+                for attempt in range(RETRIES + 1):
+                    try:
+                        result = self.call(service, method, rnd)
+                        transaction.commit()
+                        break
+                    except ConflictError:
+                        s.conflicts += 1
+                        transaction.abort()
+                        result = None
+                    except Exception:
+                        transaction.abort()
+                        result = None
+                        break
+                s.latencies.append(time.time() - start)
+                s.loads += conn.getTransferCounts(True)[0]
+                if result is None:
+                    s.errors += 1
+                elif json.loads(result).get('status') not in \
+                        (config.SUCCESS, config.TIMEOUT):
+                    s.errors += 1
+        finally:
+            transaction.abort()
+            conn.close()
+
+        self.lock.acquire()
+        try:
+            for method, s in stats.items():
+                total = self.stats.setdefault(method, Stats())
+                total.latencies.extend(s.latencies)
+                total.conflicts += s.conflicts
+                total.errors += s.errors
+                total.loads += s.loads
+        finally:
+            self.lock.release()
+
+
+    def run(self):
+        self.populate()
+        # Start every run with a cold cache, like a restarted instance
+        self.db.cacheMinimize()
+
+        threads = [threading.Thread(target=self.worker, args=(i,))
+                   for i in range(self.options.threads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        total = Stats()
+        for s in self.stats.values():
+            total.latencies.extend(s.latencies)
+            total.conflicts += s.conflicts
+            total.errors += s.errors
+            total.loads += s.loads
+
+        options = self.options
+        return {
+            'options': {
+                'users': options.users,
+                'rooms': options.rooms,
+                'room_size': options.room_size,
+                'room_messages': options.room_messages,
+                'partners': options.partners,
+                'conversation_size': options.conversation_size,
+                'threads': options.threads,
+                'calls': options.calls,
+                'seed': options.seed,
+                'storage': options.filestorage and 'FileStorage' or 'DemoStorage',
+                },
+            'elapsed': round(elapsed, 3),
+            'total': total.report(elapsed),
+            'methods': dict([(m, s.report(elapsed)) for m, s in self.stats.items()]),
+            }
+
+
+def print_results(results, out=sys.stdout):
+    columns = ['calls', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms',
+               'conflict_rate', 'errors', 'loads_per_call']
+    print >> out, '%-22s' % 'method' + ''.join(['%15s' % c for c in columns])
+    rows = sorted(results['methods'].items()) + [('total', results['total'])]
+    for method, report in rows:
+        print >> out, '%-22s' % method + ''.join(['%15s' % report[c] for c in columns])
+    print >> out, 'Elapsed: %ss' % results['elapsed']
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--users', type='int', default=50)
+    parser.add_option('--rooms', type='int', default=5)
+    parser.add_option('--room-size', dest='room_size', type='int', default=20,
+                      help='The amount of participants per chatroom')
+    parser.add_option('--room-messages', dest='room_messages', type='int', default=100,
+                      help='The amount of messages initially in every chatroom')
+    parser.add_option('--partners', type='int', default=5,
+                      help='The amount of conversations per user')
+    parser.add_option('--conversation-size', dest='conversation_size', type='int',
+                      default=20, help='The amount of messages initially in every conversation')
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--calls', type='int', default=500,
+                      help='The amount of calls made by every thread')
+    parser.add_option('--seed', default='babble',
+                      help='The seed of the random generators, for reproducible runs')
+    parser.add_option('--filestorage', default=None,
+                      help='Path of a FileStorage to use instead of a DemoStorage')
+    parser.add_option('--output', default=None,
+                      help='Write the results as JSON to this file ("-" for stdout)')
+    options, args = parser.parse_args(args)
+
+    results = Benchmark(options).run()
+    if options.output == '-':
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+    print_results(results)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
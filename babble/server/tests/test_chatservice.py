@@ -1,10 +1,17 @@
 import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
 import simplejson as json
 from pytz import utc
 
 from Testing import ZopeTestCase as ztc
 from zExceptions import Unauthorized
 
+from Acquisition import aq_base
+from zope.component import getGlobalSiteManager
 from zope.interface.verify import verifyObject
 
 from Products.Five import zcml
@@ -20,12 +27,52 @@ from babble.server import config
 from babble.server import interfaces
 from babble.server.conversation import Conversation
 from babble.server.chatroom import ChatRoom
+from babble.server.message import Message
+from babble.server.messagebox import MessageBox
+from babble.server.metrics import metrics
+from babble.server.events import MemoryEvents
+from babble.server.interfaces import IEventChannel
+from babble.server.interfaces import IPresenceBackend
+from babble.server.notifier import Notifier
+from babble.server.notifier import notifier
+from babble.server.presence import FilePresence
+from babble.server.presence import MemoryPresence
+from babble.server.utils import create_token
+from babble.server.utils import date_to_key
+from babble.server.utils import encode_cursor
+from babble.server.utils import hashed
+from babble.server.utils import key_to_date
+from babble.server.utils import merge
+from babble.server.utils import timestamp_to_key
+from babble.server.utils import verify_token
 
 # Regex to test for ISO8601, i.e: '2011-09-30T15:49:35.417693+00:00'
 # RE = re.compile(r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}\.\d{6}[+-]\d{2}:\d{2}$')
 
+def r_date(service, text):
+    """ Return the date of the message with the given text """
+    for folder in [service._getConversationsFolder(), service._getChatRoomsFolder()]:
+        for container in folder.objectValues():
+            for key, m in container._iterMessages(config.NULL_KEY, config.MAX_KEY):
+                if m.text == text:
+                    return m.time
+
+
 class TestChatService(ztc.ZopeTestCase):
 
+    def afterSetUp(self):
+        # Every test gets its own presence backend and event channel
+        self.presence = MemoryPresence()
+        getGlobalSiteManager().registerUtility(self.presence, IPresenceBackend)
+        self.events = MemoryEvents()
+        getGlobalSiteManager().registerUtility(self.events, IEventChannel)
+
+
+    def beforeTearDown(self):
+        getGlobalSiteManager().unregisterUtility(provided=IPresenceBackend)
+        getGlobalSiteManager().unregisterUtility(provided=IEventChannel)
+
+
     def _create_chatservice(self):
         """ Adds a babble.server to the default fixture """
         if getattr(self.app, 'chat_service', None):
@@ -60,42 +107,90 @@ class TestChatService(ztc.ZopeTestCase):
         self.assertEquals(status['status'], config.SUCCESS)
 
 
-    def test_user_access_dict(self):
-        """ Test the '_getUserAccessDict' method
-        """ 
+    def test_presence_backends(self):
+        """ Test the in-memory and file based presence backends
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'presence.json')
+            for backend, other in [(MemoryPresence(120), None),
+                                   (FilePresence(path, 120), FilePresence(path, 120))]:
+                self.assertTrue(verifyObject(IPresenceBackend, backend))
+                now = time.time()
+                self.assertEqual(backend.lastSeen('max_musterman'), None)
+                self.assertEqual(backend.users(now - 60), [])
+
+                backend.confirm('max_musterman', now - 90)
+                backend.confirm('maxine_musterman', now)
+                self.assertEqual(backend.lastSeen('max_musterman'), now - 90)
+                self.assertEqual(backend.users(now - 60), ['maxine_musterman'])
+                self.assertEqual(sorted(backend.users(now - 100)), 
+                                 ['max_musterman', 'maxine_musterman'])
+
+                if other is not None:
+                    # Backends using the same file share the presence
+                    self.assertEqual(other.lastSeen('maxine_musterman'), now)
+                    other.confirm('max_musterman', now)
+                    self.assertEqual(backend.lastSeen('max_musterman'), now)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        # Without a registered utility, the process-wide default is used
+        # Users are forgotten once they were last seen before the window
+        backend = MemoryPresence(60)
+        now = time.time()
+        backend.confirm('user1', now - 120)
+        backend.confirm('user2', now - 90)
+        backend.confirm('user3', now - 30)
+        backend.confirm('user4', now)
+        self.assertEqual(backend.lastSeen('user1'), None)
+        self.assertEqual(sorted(backend._last_seen.keys()), ['user3', 'user4'])
+        self.assertEqual(sorted(backend.users(now - 60)), ['user3', 'user4'])
+        backend.confirm('user2', now)
+        self.assertEqual(sorted(backend.users(now - 60)), ['user2', 'user3', 'user4'])
+
+        backend = MemoryPresence(60)
+        backend.confirm('user1', now - 30)
+        self.assertEqual(backend.users(now - 60), ['user1'])
+        backend._evict(now + 31)
+        self.assertEqual(backend.users(now - 60), [])
+        self.assertEqual(backend._heap, [])
+
+        # Without a window, config.PRESENCE_WINDOW is read on every call
+        backend = MemoryPresence()
+        backend.confirm('user1', now - 30)
+        self.assertEqual(backend.users(now - 60), ['user1'])
+        presence_window = config.PRESENCE_WINDOW
+        config.PRESENCE_WINDOW = 10
+        try:
+            self.assertEqual(backend.lastSeen('user1'), None)
+        finally:
+            config.PRESENCE_WINDOW = presence_window
+
+        # The changes since a timestamp within the window are known
+        backend = MemoryPresence(60)
+        backend.confirm('user1', time.time())
+        backend.confirm('user2', time.time())
+        backend.confirm('user3', time.time() - 59.5)
+        since, came_online, went_offline = backend.changes(time.time())
+        self.assertEqual((came_online, went_offline), ([], []))
+        time.sleep(0.5)
+        backend.confirm('user4', time.time())
+        backend.confirm('user2', time.time() - 60)
+        now, came_online, went_offline = backend.changes(since)
+        self.assertEqual(came_online, ['user4'])
+        self.assertEqual(went_offline, ['user2', 'user3'])
+        # Users that come back online are no longer reported as offline
+        backend.confirm('user2', time.time())
+        self.assertEqual(backend.changes(since)[1:], (['user2', 'user4'], ['user3']))
+        self.assertEqual(backend.changes(now)[1:], (['user2'], []))
+        self.assertEqual(backend.changes(time.time() - 61), None)
+        self.assertEqual(FilePresence(path).changes(now), None)
+
+        getGlobalSiteManager().unregisterUtility(provided=IPresenceBackend)
         s = self._create_chatservice() 
-        uad = s._getUserAccessDict()
-
-        # The cache should be set and it's expiry date must be in the future
-        self.assertEqual(getattr(s, '_v_user_access_dict'), {})
-
-        now = datetime.datetime.now()
-
-        # Put a user into the UAD
-        s._setUserAccessDict('max_musterman')
-
-        # Test that he is there
-        uad = s._getUserAccessDict()
-        self.assertEqual(uad.keys(), ['max_musterman'])
-
-        # Test that he is also in the cache (first make sure that the cache
-        # timeout is in the future)
-        delta = datetime.timedelta(seconds=30)
-        cache_timeout = now + delta
-        setattr(s, '_v_cache_timeout', cache_timeout)
-
-        # Wipe the UAD
-        s._v_user_access_dict = {}
-
-        # Put a user into the UAD
-        s._setUserAccessDict('maxine_musterman')
-
-        # Test that he is there and in the cache...
-        uad = s._getUserAccessDict()
-        self.assertEqual(uad.keys(), ['maxine_musterman'])
-
-        now = datetime.datetime.now()
-        assert(getattr(s, '_v_cache_timeout') > now)
+        self.assertTrue(isinstance(s._getPresence(), MemoryPresence))
+        self.assertTrue(s._getPresence() is s._getPresence())
 
 
     def test_registration(self):
@@ -131,31 +226,88 @@ class TestChatService(ztc.ZopeTestCase):
         self.assertEqual(auth.name, 'username')
 
 
+    def test_login(self):
+        """ Test that the session token returned by 'login' can be used 
+            instead of the password.
+        """
+        s = self._create_chatservice() 
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+
+        r = json.loads(s.login('user1', 'wrongpass'))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+
+        r = json.loads(s.login('user1', 'secret'))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertTrue(bool(config.VALID_DATE_REGEX.search(r['expires'])))
+        token = r['token']
+
+        self.assertEqual(s._authenticate('user1', token), 'user1')
+        self.assertEqual(s._authenticate('user2', token), None)
+        self.assertEqual(s._authenticate('user1', token[:-1]+'x'), None)
+
+        r = json.loads(s.sendMessage('user1', token, 'User 1', 'user2', 'hello'))
+        self.assertEqual(r['status'], config.SUCCESS)
+        um = json.loads(s.getNewMessages('user1', token, config.NULL_DATE))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages']['user2'][0][1], 'hello')
+
+        # A token can't be used to log in again
+        r = json.loads(s.login('user1', token))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+
+        # Expired tokens are refused
+        secret = s._getTokenSecret()
+        expired = create_token(secret, 'user1', time.time() - 1)
+        self.assertEqual(s._authenticate('user1', expired), None)
+        self.assertTrue(verify_token(secret, 'user1', token, time.time()))
+        self.assertFalse(verify_token(secret, 'user1', token, 
+                            time.time() + config.TOKEN_LIFETIME + 1))
+        self.assertFalse(verify_token(secret, 'user1', token, time.time(), 1))
+
+        # Changing the password invalidates the existing tokens
+        s.setUserPassword('user1', 'newpass')
+        self.assertEqual(s._authenticate('user1', token), None)
+        r = json.loads(s.sendMessage('user1', token, 'User 1', 'user2', 'hello'))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+        token = json.loads(s.login('user1', 'newpass'))['token']
+        self.assertEqual(s._authenticate('user1', token), 'user1')
+
+        # So does unregistering the user, also if he registers again
+        token2 = json.loads(s.login('user2', 'secret'))['token']
+        r = json.loads(s.unregister('user2'))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertEqual(s._authenticate('user2', token2), None)
+        r = json.loads(s.unregister('user2'))
+        self.assertEqual(r['status'], config.NOT_FOUND)
+        s.register('user2', 'secret')
+        self.assertEqual(s._authenticate('user2', token2), None)
+        self.assertEqual(s._authenticate('user1', token), 'user1')
+
+
     def test_online(self):
         """ Test the 'confirmAsOnline', '_isOnline' and 'getOnlineUsers' methods """
         s = self._create_chatservice() 
         u = 'username'
         s.register(u, u)
-        uad = s._getUserAccessDict()
-        self.assertEqual(s._isOnline(u, uad), False)
+        backend = s._getPresence()
+        self.assertTrue(backend is self.presence)
+        self.assertEqual(s._isOnline(u), False)
 
         r = s.confirmAsOnline(None)
         r = json.loads(r)
         self.assertEquals(r['status'], config.ERROR)
 
-        # Test that a user entry was made into the 'user access dict'
+        # Test that a user entry was made into the presence backend
         s.confirmAsOnline(u)
-        self.assertEqual(uad.get(u, None) != None, True)
+        self.assertEqual(backend.lastSeen(u) != None, True)
 
-        self.assertEqual(s._isOnline(u, uad), True)
+        self.assertEqual(s._isOnline(u), True)
 
-        now = datetime.datetime.now()
-        
         # Test that a user that was confirmed as online 59 seconds ago (i.e
         # less than a minute) is still considered as online.
-        delta = datetime.timedelta(seconds=59)
-        uad[u] = datetime.datetime.now() - delta
-        self.assertEqual(s._isOnline(u, uad), True)
+        backend.confirm(u, time.time() - 59)
+        self.assertEqual(s._isOnline(u), True)
 
         ou = s.getOnlineUsers()
         ou = json.loads(ou)
@@ -164,9 +316,8 @@ class TestChatService(ztc.ZopeTestCase):
 
         # Test that a user that was confirmed as online one minute ago (i.e
         # at least a minute) is now considered as offline.
-        delta = datetime.timedelta(minutes=1)
-        uad[u] = datetime.datetime.now() - delta
-        self.assertEqual(s._isOnline(u, uad), False)
+        backend.confirm(u, time.time() - 60)
+        self.assertEqual(s._isOnline(u), False)
 
         ou = s.getOnlineUsers()
         ou = json.loads(ou)
@@ -183,7 +334,13 @@ class TestChatService(ztc.ZopeTestCase):
         ou = s.getOnlineUsers()
         ou = json.loads(ou)
         self.assertEquals(ou['status'], config.SUCCESS)
-        self.assertEquals(ou['online_users'], ['username', 'another'])
+        self.assertEquals(ou['online_users'], ['another', 'username'])
+
+        # Confirmations within 30 seconds of the last one aren't recorded
+        last_seen = time.time() - 20
+        backend.confirm(u, last_seen)
+        s.confirmAsOnline(u)
+        self.assertEqual(backend.lastSeen(u), last_seen)
 
 
     def test_chatroom(self):
@@ -207,11 +364,17 @@ class TestChatService(ztc.ZopeTestCase):
         s.register('sender', 'secret')
         s.register('recipient', 'secret')
 
-        # Delete the Conversations folder to check that it gets recreated.
+        # Delete the Conversations folder to check that it gets recreated,
+        # but only when a message is sent.
         s.manage_delObjects(['conversations'])
         um = json.loads(s.getMessages('recipient', 'secret', '*', [], config.NULL_DATE, None,))
         self.assertEqual(um['status'], config.SUCCESS)
-        self.assertTrue(hasattr(s, 'conversations'))
+        self.assertFalse(s.hasObject('conversations'))
+        um = json.loads(s.getMessages('recipient', 'secret', 'sender', [], config.NULL_DATE, None,))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertFalse(s.hasObject('conversations'))
+        s._getConversation('sender', 'recipient')
+        self.assertTrue(s.hasObject('conversations'))
 
         um = s.getMessages('recipient', 'secret', '*', [], config.NULL_DATE, None)
         um = json.loads(um)
@@ -239,6 +402,12 @@ class TestChatService(ztc.ZopeTestCase):
         um = json.loads(s.getMessages('recipient', 'secret', 'sender', [], None, '123512512351235'))
         self.assertEqual(um['status'], config.ERROR)
         self.assertEqual(um['errmsg'], 'Invalid date format')
+
+        # Dates that match the format, but don't exist, are also invalid
+        um = json.loads(s.getMessages('recipient', 'secret', 'sender', [], 
+                                      '2011-13-01T00:00:00+00:00', None))
+        self.assertEqual(um['status'], config.ERROR)
+        self.assertEqual(um['errmsg'], 'Invalid date format')
         
         # test valid message sending
         response = s.sendMessage('sender', 'secret', 'Sender McSend', 'recipient', 'This is the message')
@@ -258,8 +427,12 @@ class TestChatService(ztc.ZopeTestCase):
         #     'messages': {
         #             'sender': [ ['sender', 'This is the message', '2011-10-19T10:08:02.164873+00:00'] ]
         #             },
+        #     'version': '1.0',
+        #     'events': [],
         # }
-        self.assertEqual(um.keys(), ['status', 'messages', 'last_msg_date', 'chatroom_messages'])
+        self.assertEqual(sorted(um.keys()), 
+                ['chatroom_messages', 'events', 'last_msg_date', 'messages', 
+                 'status', 'version'])
         self.assertEqual(um['last_msg_date'], message_timestamp)
 
         msgdict = um['messages'] 
@@ -274,9 +447,12 @@ class TestChatService(ztc.ZopeTestCase):
         self.assertEqual(msgdict['sender'][0][2], message_timestamp)
         self.assertTrue(bool(config.VALID_DATE_REGEX.search(msgdict['sender'][0][2])))
 
-        # Test that we get the same results again.
+        # Test that we get the same results again. getMessages doesn't
+        # return the version and events that getNewMessages adds.
+        payload = dict([(k, um[k]) for k in 
+                    ['status', 'messages', 'last_msg_date', 'chatroom_messages']])
         db = json.loads(s.getMessages( 'recipient', 'secret', '*', [], None, None, ))
-        self.assertEqual(db, um)
+        self.assertEqual(db, payload)
 
         # Test exact 'since' dates. 
         db = json.loads(s.getMessages( 'recipient', 'secret', '*', [], um['last_msg_date'], None, ))
@@ -284,7 +460,7 @@ class TestChatService(ztc.ZopeTestCase):
 
         # Test exact 'until' date. This must return the message
         db = json.loads(s.getMessages( 'recipient', 'secret', '*', [], None, um['last_msg_date'], ))
-        self.assertEqual(db, um)
+        self.assertEqual(db, payload)
 
         # Test that the sender also gets the same results
         db = json.loads(s.getMessages( 'sender', 'secret', '*', [], None, um['last_msg_date'], ))
@@ -434,9 +610,1064 @@ class TestChatService(ztc.ZopeTestCase):
         self.assertEqual(um['messages'], {})
         self.assertEqual(um['last_msg_date'], last_msg_date)
 
+        # Clearing is recorded in the read cursors, not on the user object
+        s.getUnclearedMessages('sender2', 'secret', '*', [], None, True)
         user = s.acl_users.getUser('sender2')
-        last_cleared = user.last_cleared_date
+        self.assertFalse(hasattr(aq_base(user), 'last_cleared_date'))
+        um = json.loads(s.getNewMessages('sender2', 'secret', config.NULL_DATE))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['last_msg_date'], last_msg_date)
+
+
+
+    def test_conversation_index(self):
+        """ Test that conversations are indexed per user and that the index
+            can be rebuilt.
+        """
+        s = self._create_chatservice()
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+        s.register('user3', 'secret')
+
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'hello user2')
+        s.sendMessage('user1', 'secret', 'User 1', 'user3', 'hello user3')
+
+        index = s._getConversationIndex()
+        self.assertEqual(len(index.get(hashed('user1'))), 2)
+        self.assertEqual(len(index.get(hashed('user2'))), 1)
+        self.assertEqual(len(index.get(hashed('nobody'))), 0)
+
+        conv_ids = [c.id for c in s._getConversationsFor('user1')]
+        self.assertEqual(sorted(conv_ids), sorted(s.conversations.objectIds()))
+        conv_ids = [c.id for c in s._getConversationsFor('user3')]
+        self.assertEqual(conv_ids, [s._getConversation('user1', 'user3').id])
+
+        # Sites created before the index existed get it rebuilt, but it's
+        # only stored when writing.
+        s._conversation_index = None
+        um = json.loads(s.getMessages('user2', 'secret', '*', [], None, None))
+        self.assertEqual(um['messages']['user1'][0][1], 'hello user2')
+        self.assertEqual(s._conversation_index, None)
+        self.assertEqual(len(s._getConversationIndex().get(hashed('user1'))), 2)
+        self.assertNotEqual(s._conversation_index, None)
+
+
+    def test_chatroom_index(self):
+        """ Test that the chatroom index is kept in sync with the
+            participants of the chatrooms.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+
+        path1 = '/Plone/chatrooms/chatroom1'
+        path2 = '/Plone/chatrooms/chatroom2'
+        s.createChatRoom('user1', 'secret', path1, ['user1', 'user2'])
+        s.createChatRoom('user1', 'secret', path2, ['user1'])
+
+        def rooms(username):
+            return sorted([c.client_path for c in s._getChatRoomsFor(username)])
+
+        self.assertEqual(rooms('user1'), [path1, path2])
+        self.assertEqual(rooms('user2'), [path1])
+        self.assertEqual(rooms('user3'), [])
+
+        s.addChatRoomParticipant('user1', 'secret', path2, 'user3')
+        self.assertEqual(rooms('user3'), [path2])
+
+        s.editChatRoom('user1', 'secret', path1, ['user1', 'user3'])
+        self.assertEqual(rooms('user2'), [])
+        self.assertEqual(rooms('user3'), [path1, path2])
+
+        s.removeChatRoom('user1', 'secret', path2)
+        self.assertEqual(rooms('user1'), [path1])
+        self.assertEqual(rooms('user3'), [path1])
+
+        # Sites created before the index existed get it rebuilt
+        s._chatroom_index = None
+        self.assertEqual(rooms('user3'), [path1])
+        self.assertEqual(rooms('user2'), [])
+
+
+    def test_chatroom_participants(self):
+        """ Test the storage of chatroom participants, and the migration of
+            chatrooms that store them in a list.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user2', 'user1'])
+        chatroom = s._getChatRoom(path)
+        self.assertEqual(list(chatroom._getParticipants()), ['user1', 'user2'])
+        self.assertTrue(chatroom._hasPartner('user2'))
+        self.assertFalse(chatroom._hasPartner('user3'))
+        self.assertEqual(chatroom._getPartnerName('user2'), path)
+        self.assertFalse(hasattr(aq_base(chatroom), 'partner'))
+
+        # Chatrooms created by older versions
+        del chatroom._participants
+        chatroom.participants = ['user1', 'user2']
+        chatroom.partner = {'user1': path, 'user2': path}
+        self.assertEqual(list(chatroom._getParticipants()), ['user1', 'user2'])
+        self.assertTrue(chatroom._isParticipant('user1'))
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'hello')
+        r = json.loads(s.getMessages('user1', 'secret', None, '*', None, None))
+        self.assertEqual(r['chatroom_messages'][path][0][1], 'hello')
+
+        s.addChatRoomParticipant('user1', 'secret', path, 'user3')
+        self.assertEqual(list(chatroom._getParticipants()), ['user1', 'user2', 'user3'])
+        self.assertFalse(hasattr(aq_base(chatroom), 'participants'))
+        self.assertFalse(hasattr(aq_base(chatroom), 'partner'))
+        self.assertFalse(chatroom._migrateParticipants())
+
+
+    def test_messagebox_storage(self):
+        """ Test that messages are stored under integer keys and that
+            messages from older MessageBoxes can be migrated.
+        """
+        mbox = MessageBox('mbox')
+        m1 = mbox.addMessage('first', 'user1', 'User 1')
+        m2 = mbox.addMessage('second', 'user1', 'User 1')
+        k1 = date_to_key(m1.time)
+        k2 = date_to_key(m2.time)
+        self.assertTrue(k2 > k1)
+        self.assertEqual(key_to_date(k1), m1.time)
+        self.assertEqual(list(mbox._messages.keys()), [k1, k2])
+        # Messages are stored as compact tuples, not as persistent objects
+        self.assertEqual(mbox._messages[k1], ('user1', 'first', 'User 1'))
+
+        self.assertEqual([m.text for k, m in mbox._iterMessages(config.NULL_KEY, k2)], 
+                         ['first', 'second'])
+        self.assertEqual([m.text for k, m in mbox._iterMessages(k1, k2)], ['second'])
+        self.assertEqual([m.text for k, m in mbox._iterMessages(config.NULL_KEY, k1)], ['first'])
+        self.assertEqual(mbox._lastKey(k2), k2)
+        self.assertEqual(mbox._lastKey(k2-1), k1)
+        self.assertEqual(mbox._lastKey(k1-1), None)
+
+        # Messages stored as folder items by older versions
+        old = Message('old message', 'user1', 'User 1')
+        old_key = timestamp_to_key(float(old.id))
+        mbox._setObject(old.id, old)
+        self.assertEqual(mbox._lastKey(k1-1), None)
+        self.assertEqual([m.text for k, m in mbox._iterMessages(config.NULL_KEY, k2)], 
+                         ['first', 'second'])
+        self.assertEqual(mbox._lastKey(old_key), old_key)
+        self.assertEqual([m.text for k, m in mbox._iterMessages(k2, old_key)], 
+                         ['old message'])
+
+        # Message objects stored in the LOBTree by older versions
+        mbox._messages[k2+1] = Message('older message', 'user1', 'User 1', k2+1)
+        self.assertEqual([m.text for k, m in mbox._iterMessages(k1, k2+1)], 
+                         ['second', 'older message'])
+
+        self.assertEqual(mbox._migrateMessages(), 2)
+        self.assertEqual(mbox.objectIds(), [])
+        self.assertEqual(mbox._messages[k2+1], ('user1', 'older message', 'User 1'))
+        self.assertEqual([m.text for k, m in mbox._iterMessages(config.NULL_KEY, old_key+1)], 
+                         ['first', 'second', 'older message', 'old message'])
+
+
+    def test_merge(self):
+        """ Test the lazy merging of sorted messageboxes """
+        consumed = []
+        def box(name, keys):
+            for k in keys:
+                consumed.append((name, k))
+                yield k, name
+
+        boxes = [box('a', [1, 4, 7]), box('b', [2, 3, 9]), box('c', [])]
+        self.assertEqual(list(merge(boxes)), 
+                [(1, 'a'), (2, 'b'), (3, 'b'), (4, 'a'), (7, 'a'), (9, 'b')])
+
+        # With a limit, the boxes are only consumed as far as necessary
+        del consumed[:]
+        boxes = [box('a', [1, 4, 7]), box('b', [2, 3, 9])]
+        self.assertEqual(list(merge(boxes, 2)), [(1, 'a'), (2, 'b')])
+        self.assertEqual(sorted(consumed), [('a', 1), ('a', 4), ('b', 2)])
+
+
+    def test_cursors(self):
+        """ Test getMessagesByCursor and getNewMessagesByCursor """
+        s = self._create_chatservice()
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+
+        um = json.loads(s.getNewMessagesByCursor('user1', 'wrongpass', None))
+        self.assertEqual(um['status'], config.AUTH_FAIL)
+
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', 'bogus'))
+        self.assertEqual(um['status'], config.ERROR)
+        self.assertEqual(um['errmsg'], 'Invalid cursor')
+
+        # Keys that can't be dates are rejected as well
+        for key in [config.NULL_KEY - 1, config.MAX_DATE_KEY + 1, 2**64]:
+            cursor = encode_cursor({'chatroom1': (key, ())})
+            um = json.loads(s.getNewMessagesByCursor('user1', 'secret', cursor))
+            self.assertEqual(um['status'], config.ERROR)
+            self.assertEqual(um['errmsg'], 'Invalid cursor')
+
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', None))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['chatroom_messages'], {})
+        self.assertEqual(um['last_msg_date'], config.NULL_DATE)
+        cursor = um['next_cursor']
+
+        # Messages sent within the same microsecond get different keys.
+        conv = s._getConversation('user1', 'user2')
+        m1 = conv.addMessage('first', 'user2', 'User 2')
+        m2 = conv.addMessage('second', 'user2', 'User 2')
+        self.assertTrue(date_to_key(m2.time) > date_to_key(m1.time))
+        self.assertEqual(conv._getSequence().value, date_to_key(m2.time))
+        # Concurrent senders don't conflict on the Sequence, the larger
+        # value wins.
+        self.assertEqual(conv._getSequence()._p_resolveConflict(
+                            {'value': 1}, {'value': 3}, {'value': 2}), {'value': 3})
+        self.assertEqual(conv._getSequence()._p_resolveConflict(
+                            {'value': 1}, {'value': 2}, {'value': 3}), {'value': 3})
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'room message')
+
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', cursor))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual([m[1] for m in um['messages']['user2']], ['first', 'second'])
+        self.assertEqual([m[1] for m in um['chatroom_messages'][path]], ['room message'])
+        self.assertEqual(um['last_msg_date'], um['chatroom_messages'][path][0][2])
+        cursor = um['next_cursor']
+
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', cursor))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['chatroom_messages'], {})
+        self.assertEqual(um['next_cursor'], cursor)
+
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'third')
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', cursor))
+        self.assertEqual([m[1] for m in um['messages']['user2']], ['third'])
+        self.assertEqual(um['chatroom_messages'], {})
+
+        # A message that is committed after one with a larger key was 
+        # returned, is still returned, but only once.
+        third_key = conv._highWaterMark()
+        conv._getMessageBox('user2').addMessage('late', 'user2', 'User 2', third_key-1)
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', um['next_cursor']))
+        self.assertEqual([m[1] for m in um['messages']['user2']], ['late'])
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', um['next_cursor']))
+        self.assertEqual(um['messages'], {})
+
+        # The cursor can be restricted to a partner or chatrooms
+        um = json.loads(s.getMessagesByCursor('user2', 'secret', None, [path], None))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual([m[1] for m in um['chatroom_messages'][path]], ['room message'])
+        um = json.loads(s.getMessagesByCursor('user2', 'secret', None, [path], um['next_cursor']))
+        self.assertEqual(um['chatroom_messages'], {})
+
+        um = json.loads(s.getMessagesByCursor('user2', 'secret', 'user1', [], None))
+        self.assertEqual([m[1] for m in um['messages']['user1']], 
+                         ['first', 'second', 'late', 'third'])
+
+
+    def test_wait_for_messages(self):
+        """ Test waitForNewMessages and the Notifier """
+        s = self._create_chatservice()
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+
+        um = json.loads(s.waitForNewMessages('user1', 'wrongpass', None, 0))
+        self.assertEqual(um['status'], config.AUTH_FAIL)
+
+        um = json.loads(s.waitForNewMessages('user1', 'secret', None, 0))
+        self.assertEqual(um['status'], config.TIMEOUT)
+        self.assertEqual(um['messages'], {})
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'hello')
+        um = json.loads(s.waitForNewMessages('user1', 'secret', None, 10))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages']['user2'][0][1], 'hello')
+
+        um = json.loads(s.waitForNewMessages('user1', 'secret', um['last_msg_date'], 0))
+        self.assertEqual(um['status'], config.TIMEOUT)
+
+        # Timeouts passed as strings are parsed, and negative ones are
+        # treated as 0
+        start = time.time()
+        for timeout in ['0.01', -5]:
+            um = json.loads(s.waitForNewMessages('user1', 'secret', um['last_msg_date'], timeout))
+            self.assertEqual(um['status'], config.TIMEOUT)
+        self.assertTrue(time.time() - start < 5)
+        for timeout in ['soon', 'nan', []]:
+            um = json.loads(s.waitForNewMessages('user1', 'secret', None, timeout))
+            self.assertEqual(um['status'], config.ERROR)
+
+        # A waiting thread gets woken up by a notification for its user
+        n = Notifier()
+        version = n.version('user1')
+        self.assertFalse(n.wait('user1', version, 0.01))
+        version = n.version('user1')
+        n.notify(['user2'])
+        self.assertEqual(n.version('user1'), version)
+        n.release('user1')
+
+        t = threading.Timer(0.1, n.notify, [['user1', 'user2']])
+        t.start()
+        start = time.time()
+        self.assertTrue(n.wait('user1', version, 10))
+        self.assertTrue(time.time() - start < 5)
+        t.join()
+
+        # Only the versions of the users that are waited for are kept
+        self.assertEqual(n._versions, {})
+        self.assertEqual(n._interested, {})
+        version = n.version('user1')
+        n.notify(['user1', 'user2'])
+        self.assertEqual(n._versions, {'user1': version + 1})
+        n.release('user1')
+        self.assertEqual(n._versions, {})
+        self.assertEqual(n._interested, {})
+
+        # waitForNewMessages releases its interest, also when it returns
+        # without waiting
+        self.assertFalse('user1' in notifier._interested)
+
+
+    def test_unread_counts(self):
+        """ Test getUnreadCounts and its reset by getUnclearedMessages """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2', 'user3'])
+
+        r = json.loads(s.getUnreadCounts('user1', 'wrongpass'))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r, {'status': config.SUCCESS, 'messages': {}, 'chatroom_messages': {}})
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'one')
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'two')
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'reply')
+        s.sendMessage('user3', 'secret', 'User 3', 'user1', 'three')
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'room one')
+        s.sendChatRoomMessage('user1', 'secret', 'User 1', path, 'room two')
+
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {'user2': 2, 'user3': 1})
+        self.assertEqual(r['chatroom_messages'], {path: 1})
+        r = json.loads(s.getUnreadCounts('user2', 'secret'))
+        self.assertEqual(r['messages'], {'user1': 1})
+        self.assertEqual(r['chatroom_messages'], {path: 1})
+
+        # Clearing resets the counts of the fetched containers
+        s.getUnclearedMessages('user1', 'secret', 'user2', path, None, True)
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {'user3': 1})
+        self.assertEqual(r['chatroom_messages'], {})
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'four')
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'five')
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {'user2': 2, 'user3': 1})
+
+        # Clearing until a date leaves the later messages unread
+        s.getUnclearedMessages('user1', 'secret', '*', [], r_date(s, 'four'), True)
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {'user2': 1})
+
+        # Containers created by older versions don't have counters yet
+        conv = s._getConversation('user1', 'user2')
+        cleared_key, cleared_count = s._getReadCursors().get(hashed('user1'), conv.id)
+        self.assertEqual(cleared_key, date_to_key(r_date(s, 'four')))
+        self.assertEqual(conv._messageCount(), 5)
+        conv._message_count = None
+        for mbox in conv.values():
+            mbox._message_count = None
+        self.assertEqual(conv._messageCount(), 5)
+        self.assertEqual(conv._unreadCount('user1', cleared_count), 1)
+        conv.addMessage('six', 'user2', 'User 2')
+        self.assertEqual(conv._messageCount(), 6)
+        self.assertEqual(conv._unreadCount('user1', cleared_count), 2)
+
+        # Clearing is per conversation and chatroom
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'room three')
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', '*', '*', None, False))
+        self.assertEqual(r['messages'].keys(), ['user2'])
+        self.assertEqual([m[1] for m in r['messages']['user2']], ['five', 'six'])
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], ['room three'])
+        s.getUnclearedMessages('user1', 'secret', 'user2', None, None, True)
+        r = json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE))
+        self.assertEqual(r['messages'], {})
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], ['room three'])
+
+        # Removing a chatroom also removes its read cursors and version, so
+        # that a chatroom created again at the same path starts unread
+        s.getUnclearedMessages('user1', 'secret', None, path, None, True)
+        self.assertNotEqual(s._getReadCursors().get(hashed('user1'), hashed(path)), None)
+        s.removeChatRoom('user1', 'secret', path)
+        self.assertEqual(s._getReadCursors().get(hashed('user1'), hashed(path)), None)
+        self.assertEqual(s._getChatRoomVersions().get(hashed(path)), 0)
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'new room')
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['chatroom_messages'], {path: 1})
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', None, path, None, False))
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], ['new room'])
+
+
+    def test_chatroom_timeline(self):
+        """ Test that reading a chatroom via its timeline gives the same
+            results as merging its messageboxes.
+        """
+        s = self._create_chatservice()
+        users = ['user%d' % i for i in range(5)]
+        for u in users:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user0', 'secret', path, users)
+        for i in range(10):
+            u = users[(i*3) % 5]
+            s.sendChatRoomMessage(u, 'secret', u, path, 'msg%d' % i)
+
+        chatroom = s._getChatRoom(path)
+        self.assertEqual(len(chatroom._timeline), 10)
+        since = date_to_key(r_date(s, 'msg2'))
+        until = date_to_key(r_date(s, 'msg7'))
+
+        def results():
+            return [
+                [(k, m.text) for k, m in chatroom._iterMessages(config.NULL_KEY, config.MAX_KEY)],
+                [(k, m.text) for k, m in chatroom._iterMessages(since, until)],
+                [(k, m.text) for k, m in chatroom._iterMessages(since, until, 2)],
+                [(k, m.text) for k, m in chatroom._iterMessages(since, until, 2, True)],
+                [(k, m.text) for k, m in chatroom._iterMessages(config.NULL_KEY, until, None, True)],
+                chatroom._lastKey(config.MAX_KEY),
+                chatroom._lastKey(until),
+                chatroom._lastKey(config.NULL_KEY),
+                ]
+
+        with_timeline = results()
+        self.assertEqual([t for k, t in with_timeline[1]], ['msg3', 'msg4', 'msg5', 'msg6', 'msg7'])
+        self.assertEqual([t for k, t in with_timeline[3]], ['msg7', 'msg6'])
+        self.assertEqual(with_timeline[6], until)
+        self.assertEqual(with_timeline[7], config.NULL_KEY)
+
+        chatroom._disableTimeline()
+        self.assertEqual(results(), with_timeline)
+        # Existing chatrooms can get a timeline
+        chatroom._enableTimeline()
+        self.assertEqual(len(chatroom._timeline), 10)
+        self.assertEqual(results(), with_timeline)
+
+        # Pruned messages are removed from the timeline
+        chatroom._pruneMessages(since, 100)
+        self.assertEqual(len(chatroom._timeline), 7)
+        self.assertEqual(chatroom._iterMessages(config.NULL_KEY, config.MAX_KEY).next()[1].text, 'msg3')
+
+
+    def test_send_messages(self):
+        """ Test sending messages to multiple recipients at once """
+        s = self._create_chatservice()
+        for u in ['bot', 'user1', 'user2']:
+            s.register(u, 'secret')
+
+        r = json.loads(s.sendMessages('bot', 'wrongpass', 'Bot', ['user1'], 'hi'))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+
+        r = json.loads(s.sendMessages('bot', 'secret', 'Bot', ['user1', '', 'user2'], 
+                                      ['hi', 'there']))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertEqual([(i['recipient'], i['status']) for i in r['results']],
+                         [('user1', config.SUCCESS), ('user1', config.SUCCESS),
+                          ('', config.ERROR), 
+                          ('user2', config.SUCCESS), ('user2', config.SUCCESS)])
+        self.assertEqual(r['last_msg_date'], r['results'][-1]['last_msg_date'])
+
+        for u in ['user1', 'user2']:
+            um = json.loads(s.getMessages(u, 'secret', 'bot', None, None, None))
+            self.assertEqual([m[1] for m in um['messages']['bot']], ['hi', 'there'])
+
+        r = json.loads(s.sendMessages('bot', 'secret', 'Bot', 'user1', 'single'))
+        self.assertEqual(len(r['results']), 1)
+
+        for recipients, messages, errmsg in [
+                    (None, 'hi', 'Invalid recipients'),
+                    ([], 'hi', 'Invalid recipients'),
+                    (42, 'hi', 'Invalid recipients'),
+                    ('user1', None, 'Invalid messages'),
+                    ('user1', [], 'Invalid messages'),
+                    ('user1', ['hi', None], 'Invalid messages'),
+                    ('user1', [{'text': 'hi'}], 'Invalid messages'),
+                    ]:
+            r = json.loads(s.sendMessages('bot', 'secret', 'Bot', recipients, messages))
+            self.assertEqual(r['status'], config.ERROR)
+            self.assertEqual(r['errmsg'], errmsg)
+        um = json.loads(s.getMessages('user1', 'secret', 'bot', None, None, None))
+        self.assertEqual([m[1] for m in um['messages']['bot']], ['hi', 'there', 'single'])
+
+        r = json.loads(s.sendMessages('bot', 'secret', 'Bot', 
+                        ['user%d' % i for i in range(config.MAX_BATCH_SIZE+1)], 'hi'))
+        self.assertEqual(r['status'], config.ERROR)
+
+
+    def test_paging(self):
+        """ Test the 'limit' and 'newest_first' parameters of getMessages 
+            and getMessagesByCursor.
+        """
+        s = self._create_chatservice()
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+        for i in range(5):
+            author = ['user1', 'user2'][i % 2]
+            s.sendMessage(author, 'secret', author, ['user2', 'user1'][i % 2], str(i))
+
+        texts = lambda r: [m[1] for m in r['messages'].get('user2', [])]
+
+        r = json.loads(s.getMessages('user1', 'secret', 'user2', None, None, None, 0))
+        self.assertEqual(r['status'], config.ERROR)
+        self.assertEqual(r['errmsg'], 'Invalid limit')
+
+        r = json.loads(s.getMessages('user1', 'secret', 'user2', None, None, None, 2))
+        self.assertEqual(texts(r), ['0', '1'])
+        self.assertEqual(r['more'], True)
+        self.assertEqual(r['last_msg_date'], r_date(s, '4'))
+
+        r = json.loads(s.getMessages('user1', 'secret', 'user2', None, None, None, 2, True))
+        self.assertEqual(texts(r), ['4', '3'])
+        self.assertEqual(r['more'], True)
+
+        r = json.loads(s.getMessages('user1', 'secret', 'user2', None, 
+                                     r_date(s, '2'), None, 5, True))
+        self.assertEqual(texts(r), ['4', '3'])
+        self.assertEqual(r['more'], False)
+
+        r = json.loads(s.getMessages('user1', 'secret', 'user2', None, None, None))
+        self.assertEqual(texts(r), ['0', '1', '2', '3', '4'])
+        self.assertFalse('more' in r)
+
+        # Page forwards with the cursor
+        pages = []
+        cursor = None
+        while True:
+            r = json.loads(s.getMessagesByCursor('user1', 'secret', 'user2', None, cursor, 2))
+            pages.append(texts(r))
+            cursor = r['next_cursor']
+            if not r['more']:
+                break
+        self.assertEqual(pages, [['0', '1'], ['2', '3'], ['4']])
+        r = json.loads(s.getMessagesByCursor('user1', 'secret', 'user2', None, cursor, 2))
+        self.assertEqual(texts(r), [])
+
+        # And backwards, through the history
+        pages = []
+        cursor = None
+        while True:
+            r = json.loads(s.getMessagesByCursor('user1', 'secret', 'user2', None, cursor, 2, True))
+            pages.append(texts(r))
+            cursor = r['next_cursor']
+            if not r['more']:
+                break
+        self.assertEqual(pages, [['4', '3'], ['2', '1'], ['0']])
+        r = json.loads(s.getMessagesByCursor('user1', 'secret', 'user2', None, cursor, 2, True))
+        self.assertEqual(texts(r), [])
+        self.assertEqual(r['more'], False)
+
+        # Clearing with a limit only clears the returned messages
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', 'user2', None, None, True, 2))
+        self.assertEqual(texts(r), ['0', '1'])
+        self.assertEqual(r['more'], True)
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', 'user2', None, None, False))
+        self.assertEqual(texts(r), ['2', '3', '4'])
+        # With newest_first, the older messages weren't returned, so nothing
+        # is cleared.
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', 'user2', None, None, True, 2, True))
+        self.assertEqual(texts(r), ['4', '3'])
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', 'user2', None, None, True, 3, True))
+        self.assertEqual(texts(r), ['4', '3', '2'])
+        self.assertEqual(r['more'], False)
+        r = json.loads(s.getUnclearedMessages('user1', 'secret', 'user2', None, None, False))
+        self.assertEqual(texts(r), [])
+
+
+    def test_retention(self):
+        """ Test the pruning of expired messages """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+        for i in range(3):
+            s.sendMessage('user1', 'secret', 'User 1', 'user2', 'msg%d' % i)
+            s.sendMessage('user2', 'secret', 'User 2', 'user1', 'reply%d' % i)
+            s.sendMessage('user3', 'secret', 'User 3', 'user1', 'other%d' % i)
+            s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'room%d' % i)
+        s._setFanout(True)
+
+        # By default, messages are kept forever
+        self.assertEqual(list(s._pruneMessages(time.time() + 365*86400)), [])
+
+        r = json.loads(s.setChatRoomRetention('user1', 'secret', path, 'x'))
+        self.assertEqual(r['status'], config.ERROR)
+        r = json.loads(s.setChatRoomRetention('user1', 'secret', 'bogus/path', 10))
+        self.assertEqual(r['status'], config.NOT_FOUND)
+        r = json.loads(s.setChatRoomRetention('user1', 'secret', path, 10))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertEqual(s._getChatRoom(path).retention_days, 10)
+
+        # Only the conversations' messages have expired. They are deleted
+        # in batches.
+        r = json.loads(s.setRetention(-1))
+        self.assertEqual(r['status'], config.ERROR)
+        r = json.loads(s.setRetention('1'))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertEqual(s.retention_days, 1)
+        pruning = s._pruneMessages(time.time() + 2*86400, 4)
+        self.assertEqual(pruning.next(), 4)
+        # Conversations created while the job is suspended are left for 
+        # its next run
+        s.sendMessage('user2', 'secret', 'User 2', 'user3', 'meanwhile')
+        self.assertEqual(list(pruning), [4, 1])
+        self.assertEqual(list(s._pruneMessages(time.time() + 2*86400, 4)), [1])
+        self.assertEqual(list(s._pruneMessages(time.time() + 2*86400, 4)), [])
+
+        r = json.loads(s.getMessages('user1', 'secret', '*', '*', None, None))
+        self.assertEqual(r['messages'], {})
+        self.assertEqual(len(r['chatroom_messages'][path]), 3)
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user1')]), 3)
+
+        # The expired messages count as unread until they are cleared, 
+        # which also works when all of a conversation's messages expired.
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {'user2': 3, 'user3': 3})
+        s.getUnclearedMessages('user1', 'secret', '*', None, None, True)
+        r = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(r['messages'], {})
+
+        self.assertEqual(list(s._pruneMessages(time.time() + 11*86400)), [3])
+        r = json.loads(s.getMessages('user1', 'secret', '*', '*', None, None))
+        self.assertEqual(r['chatroom_messages'], {})
+
+
+    def test_fanout(self):
+        """ Test that fetching all new messages from the users' inboxes
+            gives the same results as fetching them from the containers.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'before')
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'room before')
+
+        # Enabling fan-out fills the inboxes with the existing messages
+        s._setFanout(True)
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user1')]), 2)
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'after')
+        s.sendMessage('user3', 'secret', 'User 3', 'user1', 'other')
+        s.sendChatRoomMessage('user1', 'secret', 'User 1', path, 'room after')
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user1')]), 5)
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user3')]), 1)
+
+        since = r_date(s, 'room before')
+        results = {}
+        for fanout in [True, False]:
+            s.fanout = fanout
+            for u in ['user1', 'user2', 'user3']:
+                for d in [None, since, config.NULL_DATE]:
+                    results[(fanout, u, d)] = json.loads(
+                                s.getNewMessages(u, 'secret', d))
+
+        for (fanout, u, d), r in results.items():
+            self.assertEqual(r, results[(False, u, d)])
+
+        r = results[(True, 'user1', since)]
+        self.assertEqual([m[1] for m in r['messages']['user2']], ['after'])
+        self.assertEqual([m[1] for m in r['messages']['user3']], ['other'])
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], ['room after'])
+        self.assertEqual(r['last_msg_date'], r_date(s, 'room after'))
+
+        # Clearing also works with the inboxes
+        s.fanout = True
+        s.getUnclearedMessages('user1', 'secret', '*', '*', None, True)
+        s.sendMessage('user3', 'secret', 'User 3', 'user1', 'uncleared')
+        r = json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE))
+        self.assertEqual(r['messages'].keys(), ['user3'])
+        self.assertEqual([m[1] for m in r['messages']['user3']], ['uncleared'])
+        self.assertEqual(r['chatroom_messages'], {})
+        s.fanout = False
+        self.assertEqual(json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE)), r)
+
+        # Removed participants no longer get the chatroom's messages
+        s.fanout = True
+        s.editChatRoom('user1', 'secret', path, ['user1'])
+        r = json.loads(s.getNewMessages('user2', 'secret', None))
+        self.assertEqual(r['chatroom_messages'], {})
+
+        # New participants get the chatroom's existing messages. They are
+        # read from the chatroom, instead of being added to their inboxes.
+        s.addChatRoomParticipant('user1', 'secret', path, 'user3')
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user3')]), 2)
+        chatroom = s._getChatRoom(path)
+        self.assertEqual(dict(s._getJoinKeys().getAll(hashed('user3'))), 
+                         {chatroom.id: chatroom._lastKey(config.MAX_KEY)})
+        r = json.loads(s.getNewMessages('user3', 'secret', None))
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], 
+                         ['room before', 'room after'])
+
+        s.sendChatRoomMessage('user1', 'secret', 'User 1', path, 'room later')
+        since = r_date(s, 'room before')
+        for d in [None, since, r_date(s, 'room after'), config.NULL_DATE]:
+            s.fanout = True
+            r = json.loads(s.getNewMessages('user3', 'secret', d))
+            s.fanout = False
+            self.assertEqual(r, json.loads(s.getNewMessages('user3', 'secret', d)))
+        s.fanout = True
+        r = json.loads(s.getNewMessages('user3', 'secret', since))
+        self.assertEqual([m[1] for m in r['chatroom_messages'][path]], 
+                         ['room after', 'room later'])
+        self.assertEqual(r['last_msg_date'], r_date(s, 'room later'))
+
+        s._setFanout(False)
+        self.assertEqual(s._inboxes, None)
+
+        # The inboxes are filled in batches, and only read from once they
+        # are complete.
+        batches = s._enableFanout(2)
+        self.assertEqual(batches.next(), 2)
+        self.assertEqual(s.fanout, True)
+        self.assertEqual(s._inboxes_complete, False)
+        r = json.loads(s.getNewMessages('user1', 'secret', None))
+        self.assertEqual([m[1] for m in r['messages']['user3']], ['other', 'uncleared'])
+        # Messages sent in the meantime, also to new conversations, don't
+        # disturb the rebuild and are added to the inboxes by the sender.
+        s.sendMessage('user2', 'secret', 'User 2', 'user3', 'meanwhile')
+        self.assertEqual(list(batches), [2, 2, 1])
+        self.assertEqual(s._inboxes_complete, True)
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user1')]), 7)
+        # The rebuilt inboxes also contain the messages sent before users
+        # joined chatrooms
+        self.assertEqual(dict(s._getJoinKeys().getAll(hashed('user3'))), {})
+        self.assertEqual(len(s._getInboxes()._trees[hashed('user3')]), 6)
+        r = json.loads(s.getNewMessages('user3', 'secret', None))
+        self.assertEqual([m[1] for m in r['messages']['user2']], ['meanwhile'])
+
+
+    def test_metrics(self):
+        """ Test the metrics returned by getStats """
+        metrics.reset()
+        s = self._create_chatservice()
+        s.register('user1', 'secret')
+        s.register('user2', 'secret')
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'hello')
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'hi')
+        s.getMessages('user1', 'wrongpass', 'user2', None, None, None)
+        response = s.getMessages('user1', 'secret', 'user2', None, None, None)
+
+        # The signatures of the instrumented methods are preserved
+        code = s.getMessages.im_func.func_code
+        self.assertEqual(code.co_varnames[:code.co_argcount], 
+                ('self', 'username', 'password', 'partner', 'chatrooms', 
+                 'since', 'until', 'limit', 'newest_first'))
+
+        stats = s.getStats()
+        lines = stats.splitlines()
+        self.assertTrue('babble_calls_total{method="getMessages"} 2' in lines)
+        self.assertTrue('babble_calls_total{method="sendMessage"} 2' in lines)
+        self.assertTrue('babble_calls_total{method="_authenticate"} 4' in lines)
+        self.assertTrue('babble_call_duration_seconds_bucket{method="getMessages",le="+Inf"} 2' in lines)
+        self.assertTrue('babble_call_duration_seconds_count{method="getMessages"} 2' in lines)
+        self.assertTrue('babble_containers_scanned_total{method="getMessages"} 1' in lines)
+        self.assertTrue('babble_messages_scanned_total{method="getMessages"} 2' in lines)
+        failed = len(json.dumps({'status': config.AUTH_FAIL}))
+        self.assertTrue('babble_response_bytes_total{method="getMessages"} %d' 
+                        % (failed + len(response)) in lines)
+        # Calls of getStats itself aren't recorded
+        self.assertFalse('getStats' in s.getStats())
+
+
+    def test_high_water_marks(self):
+        """ Test that conversations and chatrooms without new messages are
+            skipped.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'hello user2')
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'hello room')
+        s.sendMessage('user1', 'secret', 'User 1', 'user3', 'hello user3')
+
+        conversation = s._getConversation('user1', 'user3')
+        self.assertEqual(conversation._highWaterMark(), 
+                         conversation._lastKey(config.MAX_KEY))
+        # Containers created by older versions don't have a Sequence
+        sequence = conversation._sequence
+        conversation._sequence = None
+        self.assertEqual(conversation._highWaterMark(), sequence.value)
+        conversation._sequence = sequence
+
+        um = json.loads(s.getMessages('user1', 'secret', '*', '*', None, None))
+        last_msg_date = um['last_msg_date']
+
+        metrics.reset()
+        um = json.loads(s.getMessages('user1', 'secret', '*', '*', last_msg_date, None))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['chatroom_messages'], {})
+        self.assertEqual(um['last_msg_date'], last_msg_date)
+        lines = s.getStats().splitlines()
+        self.assertTrue('babble_containers_skipped_total{method="getMessages"} 3' in lines)
+        self.assertEqual([l for l in lines if l.startswith('babble_containers_scanned')], [])
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'hello user1')
+        metrics.reset()
+        um = json.loads(s.getMessages('user1', 'secret', '*', '*', last_msg_date, None))
+        self.assertEqual(um['messages']['user2'][0][1], 'hello user1')
+        self.assertEqual(um['chatroom_messages'], {})
+        lines = s.getStats().splitlines()
+        self.assertTrue('babble_containers_skipped_total{method="getMessages"} 2' in lines)
+        self.assertTrue('babble_containers_scanned_total{method="getMessages"} 1' in lines)
+
+
+    def test_change_versions(self):
+        """ Test that getNewMessages returns NOT_MODIFIED as long as
+            nothing changed in the user's conversations and chatrooms.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+
+        um = json.loads(s.getNewMessages('user1', 'secret', None))
+        self.assertEqual(um['status'], config.SUCCESS)
+        version = um['version']
+        um = json.loads(s.getNewMessages('user1', 'secret', None, version))
+        self.assertEqual(um, {'status': config.NOT_MODIFIED, 'version': version, 
+                              'events': []})
+        # The version may also be passed in as a string, e.g from a form
+        um = json.loads(s.getNewMessages('user1', 'secret', None, str(version)))
+        self.assertEqual(um['status'], config.NOT_MODIFIED)
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'hello')
+        um = json.loads(s.getNewMessages('user1', 'secret', None, version))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages']['user2'][0][1], 'hello')
+        self.assertNotEqual(um['version'], version)
+        version = um['version']
+
+        # Messages between other users don't change the version
+        s.sendMessage('user2', 'secret', 'User 2', 'user3', 'hello')
+        um = json.loads(s.getNewMessages('user1', 'secret', None, version))
+        self.assertEqual(um['status'], config.NOT_MODIFIED)
+
+        # Chatroom messages, clearing and joining chatrooms do. A chatroom
+        # message only bumps the chatroom's version, not those of all its
+        # participants.
+        user_version = s._getChangeVersions().get(hashed('user1'))
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'hello room')
+        self.assertEqual(s._getChangeVersions().get(hashed('user1')), user_version)
+        um = json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE, version))
+        self.assertEqual(um['chatroom_messages'][path][0][1], 'hello room')
+        self.assertNotEqual(um['version'], version)
+        version = um['version']
+
+        s.getUnclearedMessages('user1', 'secret', '*', '*', None, True)
+        um = json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE, version))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['chatroom_messages'], {})
+        version = um['version']
+
+        v3 = json.loads(s.getNewMessages('user3', 'secret', None))['version']
+        s.addChatRoomParticipant('user1', 'secret', path, 'user3')
+        um = json.loads(s.getNewMessages('user3', 'secret', None, v3))
+        self.assertEqual(um['chatroom_messages'][path][0][1], 'hello room')
+        um = json.loads(s.getNewMessages('user1', 'secret', config.NULL_DATE, version))
+        self.assertEqual(um['status'], config.NOT_MODIFIED)
+
+
+    def test_sync(self):
+        """ Test the combined sync call """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2'])
+        s.confirmAsOnline('user2')
+
+        r = json.loads(s.sync('user1', 'wrongpass', None))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+        self.assertFalse(s._isOnline('user1'))
+        r = json.loads(s.sync('user1', 'secret', 'invalid', False, None))
+        self.assertEqual(r['status'], config.ERROR)
+        r = json.loads(s.sync('user1', 'secret', None, False, 'invalid'))
+        self.assertEqual(r['status'], config.ERROR)
+
+        s.sendMessage('user2', 'secret', 'User 2', 'user1', 'hello')
+        r = json.loads(s.sync('user1', 'secret', None))
+        self.assertEqual(r['status'], config.SUCCESS)
+        self.assertTrue(s._isOnline('user1'))
+        self.assertEqual(r['messages']['user2'][0][1], 'hello')
+        self.assertEqual(r['chatroom_messages'], {})
+        self.assertEqual(r['came_online'], ['user1', 'user2'])
+        self.assertEqual(r['went_offline'], [])
+        self.assertTrue(r['online_reset'])
+
+        # Only the changes are returned
+        self.presence.confirm('user2', time.time() - config.PRESENCE_WINDOW)
+        s.confirmAsOnline('user3')
+        s.sendChatRoomMessage('user2', 'secret', 'User 2', path, 'hello room')
+        r = json.loads(s.sync('user1', 'secret', r['next_cursor'], True, 
+                              r['online_cursor']))
+        self.assertEqual(r['messages'], {})
+        self.assertEqual(r['chatroom_messages'][path][0][1], 'hello room')
+        self.assertEqual(r['came_online'], ['user3'])
+        self.assertEqual(r['went_offline'], ['user2'])
+        self.assertFalse(r['online_reset'])
+        self.assertFalse('history_cursor' in r)
+
+        # The returned messages were cleared
+        um = json.loads(s.getUnreadCounts('user1', 'secret'))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(um['chatroom_messages'], {})
+
+        r = json.loads(s.sync('user1', 'secret', r['next_cursor'], True, 
+                              r['online_cursor']))
+        self.assertEqual(r['messages'], {})
+        self.assertEqual(r['chatroom_messages'], {})
+        self.assertEqual(r['came_online'], [])
+        self.assertEqual(r['went_offline'], [])
+
+        # Once the changes are no longer known, all the online users are
+        # returned again
+        r = json.loads(s.sync('user1', 'secret', r['next_cursor'], False, 
+                              '%.6f' % (time.time() - 2*config.PRESENCE_WINDOW)))
+        self.assertEqual(r['came_online'], ['user1', 'user3'])
+        self.assertTrue(r['online_reset'])
+
+        # The first call only returns the newest messages, and the older
+        # ones can be paged through with the history cursor
+        for i in range(4):
+            s.sendMessage('user3', 'secret', 'User 3', 'user1', 'message %d' % i)
+        sync_history = config.SYNC_HISTORY
+        config.SYNC_HISTORY = 3
+        try:
+            r = json.loads(s.sync('user3', 'secret', None))
+        finally:
+            config.SYNC_HISTORY = sync_history
+        self.assertEqual([m[1] for m in r['messages']['user1']], 
+                         ['message 1', 'message 2', 'message 3'])
+        um = json.loads(s.getMessagesByCursor('user3', 'secret', '*', '*', 
+                                    r['history_cursor'], None, True))
+        self.assertEqual([m[1] for m in um['messages']['user1']], ['message 0'])
+        s.sendMessage('user1', 'secret', 'User 1', 'user3', 'message 4')
+        r = json.loads(s.sync('user3', 'secret', r['next_cursor']))
+        self.assertEqual([m[1] for m in r['messages']['user1']], ['message 4'])
+
+
+    def test_events(self):
+        """ Test the ephemeral status and typing events """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3', 'user4']:
+            s.register(u, 'secret')
+        path = '/Plone/chatrooms/chatroom1'
+        s.createChatRoom('user1', 'secret', path, ['user1', 'user2', 'user3'])
+        s.sendMessage('user1', 'secret', 'User 1', 'user4', 'hello')
+        version = s._getVersion('user2')
+
+        r = json.loads(s.setStatus('user1', 'wrongpass', u'Away'))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+        r = json.loads(s.setStatus('user1', 'secret', u'Bogus'))
+        self.assertEqual(r['status'], config.ERROR)
+        r = json.loads(s.setTyping('user1', 'secret', None, None, True))
+        self.assertEqual(r['status'], config.ERROR)
+        r = json.loads(s.setTyping('user1', 'secret', None, '/bogus/path', True))
+        self.assertEqual(r['status'], config.NOT_FOUND)
+        r = json.loads(s.setTyping('user4', 'secret', None, path, True))
+        self.assertEqual(r['status'], config.AUTH_FAIL)
+
+        # Status changes go to everyone that shares a conversation or 
+        # chatroom with the user
+        r = json.loads(s.setStatus('user1', 'secret', u'Away'))
+        self.assertEqual(r['status'], config.SUCCESS)
+        status = {'sender': 'user1', 'type': 'status', 'value': 'Away', 'chatroom': None}
+        for u in ['user2', 'user3', 'user4']:
+            um = json.loads(s.getNewMessages(u, 'secret', None))
+            self.assertEqual(um['events'], [status])
+        um = json.loads(s.getNewMessages('user1', 'secret', None))
+        self.assertEqual(um['events'], [])
+
+        # Typing notifications go to the partner or chatroom
+        s.setTyping('user2', 'secret', None, path, True)
+        s.setTyping('user4', 'secret', 'user1', None, True)
+        um = json.loads(s.getNewMessagesByCursor('user1', 'secret', None))
+        self.assertEqual(um['events'], [
+                {'sender': 'user2', 'type': 'typing', 'value': True, 'chatroom': path},
+                {'sender': 'user4', 'type': 'typing', 'value': True, 'chatroom': None},
+                ])
+        um = json.loads(s.sync('user3', 'secret', None))
+        self.assertEqual([e['sender'] for e in um['events']], ['user1', 'user2'])
+
+        s.setTyping('user4', 'secret', 'user1', None, False)
+        um = json.loads(s.getNewMessages('user1', 'secret', None, s._getVersion('user1')))
+        self.assertEqual(um['status'], config.NOT_MODIFIED)
+        self.assertEqual([e['sender'] for e in um['events']], ['user2'])
+
+        since = json.loads(s.getNewMessages('user1', 'secret', None))['last_msg_date']
+        um = json.loads(s.waitForNewMessages('user1', 'secret', since, 0))
+        self.assertEqual(um['status'], config.TIMEOUT)
+        self.assertEqual([e['sender'] for e in um['events']], ['user2'])
+
+        # Events expire, and are never stored in the ZODB
+        self.events.publish(['user1'], status, time.time() - 1)
+        self.assertEqual(len(self.events.events('user1', time.time())), 2)
+        self.assertEqual(self.events.events('user1', time.time() + config.TYPING_TTL), [])
+        self.assertEqual(s._getVersion('user2'), version)
+
+
+    def test_read_only(self):
+        """ Test that fetching messages and unread counts doesn't create
+            any objects.
+        """
+        s = self._create_chatservice()
+        for u in ['user1', 'user2', 'user3']:
+            s.register(u, 'secret')
+        s.sendMessage('user1', 'secret', 'User 1', 'user2', 'hello')
+
+        # There is no conversation between user1 and user3
+        um = json.loads(s.getMessages('user1', 'secret', 'user3', [], None, None))
+        self.assertEqual(um['status'], config.SUCCESS)
+        self.assertEqual(um['messages'], {})
+        um = json.loads(s.getMessagesByCursor('user3', 'secret', 'user1', [], None))
+        self.assertEqual(um['messages'], {})
+        um = json.loads(s.getUnclearedMessages('user3', 'secret', 'user1', [], None, True))
+        self.assertEqual(um['messages'], {})
+        self.assertEqual(len(s.conversations.objectIds()), 1)
+        self.assertEqual(len(s._getConversationIndex().get(hashed('user3'))), 0)
+
+        # Nor are the read cursors created
+        s._read_cursors = None
+        um = json.loads(s.getNewMessages('user2', 'secret', config.NULL_DATE))
+        self.assertEqual(um['messages']['user1'][0][1], 'hello')
+        um = json.loads(s.getUnreadCounts('user2', 'secret'))
+        self.assertEqual(um['messages'], {'user1': 1})
+        self.assertEqual(s._read_cursors, None)
+
+        # Until the messages are cleared
+        s.getUnclearedMessages('user2', 'secret', '*', [], None, True)
+        self.assertNotEqual(s._read_cursors, None)
+        um = json.loads(s.getUnreadCounts('user2', 'secret'))
+        self.assertEqual(um['messages'], {})
 
+        # The conversation is created when the first message is sent
+        s.sendMessage('user3', 'secret', 'User 3', 'user1', 'hello')
+        self.assertEqual(len(s.conversations.objectIds()), 2)
+        um = json.loads(s.getMessages('user1', 'secret', 'user3', [], None, None))
+        self.assertEqual(um['messages']['user3'][0][1], 'hello')
 
 
     def test_chatroom_messaging(self):
@@ -468,25 +1699,25 @@ class TestChatService(ztc.ZopeTestCase):
         resp = json.loads(s.createChatRoom('user1', 'secret', chatroom1_path, ['user1']))
         self.assertEqual(resp['status'], config.SUCCESS)
 
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1'])
 
         # Lets add some participants. Authentication is required, but this can
         # be any registered user.
         resp = json.loads(s.addChatRoomParticipant('user1', 'secret', chatroom1_path, 'unregistered_user'))
         self.assertEqual(resp['status'], config.AUTH_FAIL)
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1'])
 
         resp = json.loads(s.addChatRoomParticipant('unknown_user', 'secret', chatroom1_path, 'user2'))
         self.assertEqual(resp['status'], config.AUTH_FAIL)
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1'])
 
         resp = json.loads(s.addChatRoomParticipant('user1', 'secret', 'bogus/path', 'user2'))
         self.assertEqual(resp['status'], config.NOT_FOUND)
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1'])
 
         resp = json.loads(s.addChatRoomParticipant('user1', 'secret', chatroom1_path, 'user2'))
         self.assertEqual(resp['status'], config.SUCCESS)
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1', 'user2'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1', 'user2'])
 
         # Now we add a new list of participants by calling editChatRoom
         participants = ['user1','user2', 'user3', 'user4']
@@ -499,7 +1730,7 @@ class TestChatService(ztc.ZopeTestCase):
 
         resp = json.loads(s.editChatRoom('user1', 'secret', chatroom1_path, participants))
         self.assertEqual(resp['status'], config.SUCCESS)
-        self.assertEqual(s._getChatRoom(chatroom1_path).participants, ['user1', 'user2', 'user3', 'user4'])
+        self.assertEqual(list(s._getChatRoom(chatroom1_path)._getParticipants()), ['user1', 'user2', 'user3', 'user4'])
         
         # test valid message sending
         resp = json.loads(s.sendChatRoomMessage('user1', 'secret', 'User 1', chatroom1_path, 'This is the message'))
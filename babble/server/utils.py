@@ -1,7 +1,227 @@
+import base64
+import heapq
+import hmac
+import re
+import simplejson as json
+from datetime import datetime
+from datetime import timedelta
 from hashlib import sha224
+from hashlib import sha256
+from pytz import utc
+import config
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+# 2011-09-30T15:49:35.417693+00:00
+DATE_REGEX = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[ T](\d{2}):(\d{2}):(\d{2})'
+                        r'(?:\.(\d{6}))?([+-])(\d{2}):(\d{2})$')
 
 def hashed(str):
     try:
         return sha224(str).hexdigest()
     except UnicodeEncodeError:
         return sha224(str.encode('utf-8')).hexdigest()
+
+
+def timestamp_to_key(ts):
+    """ Convert a time.time() timestamp to an integer message key, i.e the
+        amount of microseconds since the epoch.
+    """
+    return int(round(ts * 1000000))
+
+
+def key_to_date(key):
+    """ Convert an integer message key to an iso8601 date string """
+    return (EPOCH + timedelta(microseconds=key)).isoformat()
+
+
+def date_to_key(date):
+    """ Convert an iso8601 date string (as validated by
+        config.VALID_DATE_REGEX) to an integer message key.
+    """
+    m = DATE_REGEX.search(date)
+    if m is None:
+        raise ValueError("Invalid date format: %s" % date)
+
+    year, month, day, hour, minute, second, micro, sign, oh, om = m.groups()
+    delta = datetime(int(year), int(month), int(day), int(hour), int(minute),
+                     int(second), int(micro or 0)) - EPOCH.replace(tzinfo=None)
+    key = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    offset = (int(oh) * 60 + int(om)) * 60 * 1000000
+    if sign == '+':
+        return key - offset
+    return key + offset
+
+
+def merge(iterables, limit=None, reverse=False):
+    """ Lazily merge iterables of (key, value) tuples, each of which must
+        already be sorted by key, into one sequence sorted by key.
+
+        If reverse is True, the iterables (and the result) are sorted by
+        descending key instead. The keys must then be numbers.
+
+        Only one item per iterable is held in memory at a time, and nothing
+        more is consumed once 'limit' items have been yielded.
+    """
+    sign = reverse and -1 or 1
+    heap = []
+    for i, it in enumerate(iterables):
+        it = iter(it)
+        for key, value in it:
+            # 'i' breaks ties between equal keys, so that the values never
+            # get compared.
+            heap.append((sign*key, i, value, it))
+            break
+    heapq.heapify(heap)
+    if limit is not None and limit <= 0:
+        return
+
+    count = 0
+    while heap:
+        key, i, value, it = heap[0]
+        yield sign*key, value
+        count += 1
+        if limit is not None and count >= limit:
+            return
+        for key, value in it:
+            heapq.heapreplace(heap, (sign*key, i, value, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def iter_backwards(tree, since, until):
+    """ Yield the (key, value) items of the BTree with keys larger than 
+        'since' and up to and including 'until', largest key first.
+
+        Older BTrees can't be iterated in reverse, so we step back through
+        the keys with maxKey, one O(log n) lookup per item. The keys must be
+        integers.
+    """
+    key = until
+    while key > since:
+        try:
+            key = tree.maxKey(key)
+        except ValueError:
+            return
+        if key <= since:
+            return
+        yield key, tree[key]
+        key -= 1
+
+
+def parse_limit(limit):
+    """ Return the page size 'limit' as a positive integer, or None if it
+        isn't valid.
+    """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return None
+    if limit < 1:
+        return None
+    return limit
+
+
+def parse_days(days):
+    """ Return the retention period 'days' as a non-negative integer, or
+        None. Raises a ValueError if it isn't valid.
+    """
+    if days is None:
+        return None
+    try:
+        days = int(days)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid amount of days: %r" % (days,))
+    if days < 0:
+        raise ValueError("Invalid amount of days: %r" % (days,))
+    return days
+
+
+def encode_cursor(positions):
+    """ Encode a dict into an opaque cursor string. The dict maps container
+        ids to (key, seen) tuples, where key is the key of the last message
+        returned from the container and seen is a sequence of (key, author)
+        tuples of messages that were already returned.
+    """
+    values = {}
+    for id, (key, seen) in positions.items():
+        if seen:
+            values[id] = [key] + sorted([[k, a] for k, a in seen])
+        else:
+            values[id] = key
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',',':')))
+
+
+def decode_cursor(cursor):
+    """ Decode a cursor created by encode_cursor into a dict of 
+        (key, seen) tuples, where seen is a set. An empty cursor means that
+        no messages have been returned yet.
+
+        Raises a ValueError if the cursor is invalid.
+    """
+    if not cursor:
+        return {}
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+    if not isinstance(values, dict):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    positions = {}
+    for id, value in values.items():
+        if not isinstance(value, list):
+            value = [value]
+        seen = value[1:]
+        if not value or not isinstance(value[0], (int, long)) or \
+                not config.NULL_KEY <= value[0] <= config.MAX_DATE_KEY or \
+                [s for s in seen if not isinstance(s, list) or len(s) != 2 or 
+                 not isinstance(s[0], (int, long)) or 
+                 not isinstance(s[1], basestring)]:
+            raise ValueError("Invalid cursor: %s" % cursor)
+        positions[id] = (value[0], set([(k, a) for k, a in seen]))
+    return positions
+
+
+def _sign(secret, username, expires, generation):
+    if isinstance(username, unicode):
+        username = username.encode('utf-8')
+    return hmac.new(secret, '%s\0%d\0%d' % (username, generation, expires), 
+                    sha256).hexdigest()
+
+
+def create_token(secret, username, expires, generation=0):
+    """ Return a session token for username, signed with 'secret' and valid
+        until 'expires' (a time.time() timestamp). 
+        
+        The token is only valid for the user's current 'generation', which
+        is increased to invalidate his tokens, e.g. when his password 
+        changes.
+    """
+    expires = int(expires)
+    return '%d.%s' % (expires, _sign(secret, username, expires, generation))
+
+
+def verify_token(secret, username, token, now, generation=0):
+    """ Check that token was created by create_token for username, with the
+        same secret and generation, and hasn't expired at 'now'.
+    """
+    try:
+        expires, signature = str(token).split('.', 1)
+        expires = int(expires)
+    except (ValueError, UnicodeError):
+        return False
+
+    if expires < now:
+        return False
+
+    expected = _sign(secret, username, expires, generation)
+    if len(signature) != len(expected):
+        return False
+    # Compare in constant time, to not leak how much of the signature
+    # matched.
+    result = 0
+    for x, y in zip(signature, expected):
+        result |= ord(x) ^ ord(y)
+    return result == 0
@@ -0,0 +1,35 @@
+import logging
+from BTrees.Length import Length
+from peruser import PerUserStorage
+
+log = logging.getLogger(__name__)
+
+class ChangeVersions(PerUserStorage):
+    """ Stores, per user, a version number that is increased whenever
+        something changes in the user's conversations: a message is sent
+        to one of them, the user clears his messages, or he joins or leaves
+        a chatroom. The chat service keeps the versions of the chatrooms,
+        which are increased by every message, in another instance (see
+        ChatService._getVersion).
+
+        Clients that poll for new messages pass back the version that they
+        got with their last result. As long as it's still the same, there
+        is nothing new, which can be answered without loading any
+        conversation, chatroom or MessageBox.
+
+        The versions are BTrees.Length objects, which resolve conflicts 
+        between concurrent senders. Versions only ever increase, so that a
+        client can't get a stale version confirmed.
+    """
+
+    def get(self, user):
+        """ Return the user's version """
+        version = self._getTree(user)
+        if version is None:
+            return 0
+        return version()
+
+
+    def bump(self, user):
+        """ Increase the user's version """
+        self._getTree(user, Length).change(1)